@@ -1,12 +1,30 @@
 """
 NeatJSON - Pretty-print JSON with more power than json.dumps provides.
 
-This module provides a single function, `neat_json`, which generates
-formatted JSON strings with extensive customization options.
+`neat_json` generates formatted JSON strings with extensive customization
+options. The same output is available in other forms:
+
+- `iter_neat_json`, `neat_dump` and `neat_dump_into` write it in chunks, to
+  a file, or into a reusable buffer as UTF-8.
+- `neat_reformat` reformats JSON text read from a file without loading it
+  as Python values.
+- `neat_json_async` and `aiter_neat_json` let other asyncio tasks run while
+  a large value is formatted.
+- `neat_json_many` formats many values, and `neat_json_parallel` one large
+  value, in worker processes.
+- `NeatEncoder` resolves a set of options once for formatting many values,
+  and `NeatDocument` formats a document again incrementally as it is
+  edited.
+- `SubtreeCache` remembers the text of repeated arrays and objects, and
+  `FormatStats` collects counters and timings.
+- `register_type` and `register_field_adapter` teach it other types.
+
+The `neatjson` command (or `python -m neatjson`) reformats JSON files from
+the command line.
 
 Example:
     >>> from neatjson import neat_json
-    >>> print(neat_json({"a": 1, "b": [2, 3]}, sort=True, wrap=40))
+    >>> print(neat_json({"a": 1, "b": [2, 3]}, sort=True, wrap=15))
     {
       "a":1,
       "b":[2,3]
@@ -15,19 +33,58 @@ Example:
 
 from __future__ import annotations
 
-import dataclasses
-import inspect
-import json
-import math
-import re
-from collections.abc import Callable, Iterable
-from decimal import Decimal
-from enum import Enum
-from fractions import Fraction
-from typing import Any
+import codecs
+import functools
+import io
+import itertools
+import operator
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable, Hashable, Iterable, Iterator
+from typing import IO, TYPE_CHECKING, Any, TypeGuard, cast
+
+# Modules needed only for some values or options (dataclasses, Decimal, a sort
+# function, neat_reformat, worker pools) are imported when they are first
+# needed, so that importing neatjson stays cheap. The json package imports re
+# and enum, so its C accelerator is used directly where there is one.
+try:
+    from _json import encode_basestring, encode_basestring_ascii, scanstring
+    from _json import make_encoder as c_make_encoder
+except ImportError:
+    from json.decoder import scanstring
+    from json.encoder import c_make_encoder, encode_basestring, encode_basestring_ascii
+
+if TYPE_CHECKING:
+    import concurrent.futures
+    import json
+    import re
+    from enum import Enum
 
 __version__ = "0.10.7"
-__all__ = ["neat_json", "__version__"]
+__all__ = [
+    "neat_json",
+    "iter_neat_json",
+    "neat_json_async",
+    "aiter_neat_json",
+    "neat_dump",
+    "neat_dump_into",
+    "neat_reformat",
+    "neat_json_many",
+    "neat_json_parallel",
+    "NeatEncoder",
+    "NeatDocument",
+    "SubtreeCache",
+    "FormatStats",
+    "register_type",
+    "unregister_type",
+    "register_field_adapter",
+    "unregister_field_adapter",
+    "slot_fields",
+    "__version__",
+]
 
 
 def neat_json(
@@ -39,11 +96,14 @@ def neat_json(
     short: bool = False,
     sort: bool | Callable[..., Any] = False,
     sorted: bool | Callable[..., Any] | None = None,  # noqa: A002 - alias for sort
+    sort_cache: int = 256,
     aligned: bool = False,
+    table: bool = False,
     decimals: int | None = None,
     trim_trailing_zeros: bool = False,
     force_floats: bool = False,
     force_floats_in: list[str] | None = None,
+    ensure_ascii: bool = True,
     padding: int = 0,
     array_padding: int | None = None,
     object_padding: int | None = None,
@@ -59,6 +119,8 @@ def neat_json(
     around_colon_n: int | None = None,
     before_colon_n: int | None = None,
     after_colon_n: int | None = None,
+    cache: SubtreeCache | None = None,
+    stats: FormatStats | None = None,
 ) -> str:
     """
     Generate a formatted JSON string representation of a value.
@@ -77,7 +139,15 @@ def neat_json(
               for custom sorting. The callable receives 1-3 arguments:
               (key), (key, value), or (key, value, obj). Default: False
         sorted: Alias for sort.
+        sort_cache: Number of distinct sets of string object keys whose
+                    layout (sorted order and escaped key text) is
+                    remembered and reused by objects with the same keys.
+                    Not used with a sort callable taking values. 0 disables
+                    it. Default: 256
         aligned: When wrapping objects, align the colons. Default: False
+        table: When wrapping an array of objects that all have the same
+               keys, write each object on one line with its members padded
+               into columns, if every line fits. Default: False
         decimals: Decimal precision for floats. None keeps values precise.
                   Default: None
         trim_trailing_zeros: Remove trailing zeros from decimals output.
@@ -86,6 +156,10 @@ def neat_json(
                       Default: False
         force_floats_in: List of object key names under which integers are
                          written as floats. Default: None
+        ensure_ascii: Escape non-ASCII characters in strings as \\uXXXX, as
+                      json.dumps does. With False they are written as is, and
+                      count as one character each toward the wrap width.
+                      Default: True
         padding: Shorthand for both array_padding and object_padding.
                  Default: 0
         array_padding: Spaces inside brackets for arrays. Default: 0
@@ -107,6 +181,10 @@ def neat_json(
         before_colon_n: Spaces before colons for multi-line objects.
                         Default: 0
         after_colon_n: Spaces after colons for multi-line objects. Default: 0
+        cache: A SubtreeCache used to reuse the formatting of repeated
+               arrays and objects across calls. Default: None
+        stats: A FormatStats that collects counters and timings for the
+               call. Default: None
 
     Returns:
         A formatted JSON string.
@@ -121,278 +199,3443 @@ def neat_json(
         >>> neat_json({"a": 1}, wrap=True)
         '{\\n  "a":1\\n}'
     """
-    # Handle wrap special values
-    wrap_width: int | None
-    if wrap is True:
-        wrap_width = -1  # Always wrap
-    elif wrap is False:
-        wrap_width = None  # Never wrap
-    else:
-        wrap_width = wrap
-
-    # Resolve option cascades
-    _array_padding = array_padding if array_padding is not None else padding
-    _object_padding = object_padding if object_padding is not None else padding
-    _before_comma = before_comma if before_comma is not None else around_comma
-    _after_comma = after_comma if after_comma is not None else around_comma
-    _before_colon = before_colon if before_colon is not None else around_colon
-    _after_colon = after_colon if after_colon is not None else around_colon
-    _before_colon_1 = (
-        before_colon_1
-        if before_colon_1 is not None
-        else (around_colon_1 if around_colon_1 is not None else _before_colon)
-    )
-    _after_colon_1 = (
-        after_colon_1
-        if after_colon_1 is not None
-        else (around_colon_1 if around_colon_1 is not None else _after_colon)
-    )
-    _before_colon_n = (
-        before_colon_n
-        if before_colon_n is not None
-        else (around_colon_n if around_colon_n is not None else _before_colon)
-    )
-    _after_colon_n = (
-        after_colon_n
-        if after_colon_n is not None
-        else (around_colon_n if around_colon_n is not None else _after_colon)
+    options = (
+        wrap,
+        indent,
+        indent_last,
+        short,
+        sort,
+        sorted,
+        sort_cache,
+        aligned,
+        table,
+        decimals,
+        trim_trailing_zeros,
+        force_floats,
+        force_floats_in,
+        ensure_ascii,
+        padding,
+        array_padding,
+        object_padding,
+        around_comma,
+        before_comma,
+        after_comma,
+        around_colon,
+        before_colon,
+        after_colon,
+        around_colon_1,
+        before_colon_1,
+        after_colon_1,
+        around_colon_n,
+        before_colon_n,
+        after_colon_n,
     )
+    encoder = None
+    if cache is None and stats is None:
+        # Encoders are reused by calls with the same options, which saves
+        # resolving them again for every small value
+        try:
+            encoder = _shared_encoder(*options)
+        except TypeError:
+            # An option that cannot be hashed, such as a force_floats_in list
+            pass
+    if encoder is None:
+        encoder = NeatEncoder(**dict(zip(_OPTION_NAMES, options)), cache=cache, stats=stats)
+    return encoder.encode(value)
 
-    # Handle sort/sorted alias
-    sort_opt = sorted if sorted is not None else sort
-
-    # Normalize force_floats_in to empty list if None
-    _force_floats_in: list[str] = force_floats_in if force_floats_in is not None else []
-
-    # Pre-compute formatting strings
-    apad = " " * _array_padding
-    opad = " " * _object_padding
-    comma = f"{' ' * _before_comma},{' ' * _after_comma}"
-    colon1 = f"{' ' * _before_colon_1}:{' ' * _after_colon_1}"
-    colonn = f"{' ' * _before_colon_n}:{' ' * _after_colon_n}"
-
-    # Memoization cache keyed by (id(obj), indent, floats_forced)
-    # Only used for arrays and objects where recursion can repeat
-    memo: dict[tuple[int, str, bool], str] = {}
-
-    def build(obj: Any, ind: str, floats_forced: bool) -> str:
-        """Recursively build the JSON string for an object."""
-        # Only memoize complex objects (arrays/dicts) where caching helps
-        # Simple values like int/float can have id() collisions with temporary objects
-        if isinstance(obj, (list, tuple, set, frozenset, dict)):
-            cache_key = (id(obj), ind, floats_forced)
-            if cache_key in memo:
-                return memo[cache_key]
-            result = _build_value(obj, ind, floats_forced)
-            memo[cache_key] = result
-            return result
 
-        return _build_value(obj, ind, floats_forced)
+def iter_neat_json(value: Any, **opts: Any) -> Iterator[str]:
+    """
+    Generate the formatted JSON for a value as a sequence of string chunks.
 
-    def _build_value(obj: Any, ind: str, floats_forced: bool) -> str:
-        """Build the JSON string for a single value."""
-        match obj:
-            case str():
-                return f"{ind}{json.dumps(obj)}"
+    Chunks are produced as soon as the layout of each line is known, so the
+    full output never has to be held in memory. Joining the chunks gives the
+    same result as `neat_json(value, **opts)`.
 
-            case bool():
-                # Must come before int check since bool is subclass of int
-                return f"{ind}{str(obj).lower()}"
+    Args:
+        value: The value to serialize to JSON.
+        **opts: Any of the keyword options accepted by `neat_json`.
 
-            case int():
-                if floats_forced:
-                    return build(float(obj), ind, floats_forced)
-                return f"{ind}{obj}"
+    Returns:
+        An iterator of JSON text chunks.
 
-            case float():
-                # Handle infinity and NaN
-                if math.isinf(obj):
-                    return f"{ind}{'-9e9999' if obj < 0 else '9e9999'}"
-                if math.isnan(obj):
-                    return f'{ind}"NaN"'
-
-                # Check if float is equivalent to integer (and not forced)
-                if not floats_forced and obj == int(obj) and not re.search(r"e", str(obj), re.IGNORECASE):
-                    return build(int(obj), ind, floats_forced)
-
-                if decimals is not None:
-                    if trim_trailing_zeros:
-                        return f"{ind}{round(obj, decimals)}"
-                    else:
-                        return f"{ind}{obj:.{decimals}f}"
-                else:
-                    return f"{ind}{obj}"
+    Examples:
+        >>> "".join(iter_neat_json([1, 2, 3], wrap=True))
+        '[\\n  1,\\n  2,\\n  3\\n]'
+    """
+    return NeatEncoder(**opts).iterencode(value)
 
-            case Decimal() | Fraction():
-                # Convert to float for JSON serialization
-                float_val = float(obj)
-                return build(float_val, ind, floats_forced)
 
-            case None:
-                return f"{ind}null"
+async def neat_json_async(value: Any, *, interval: float = 0.01, **opts: Any) -> str:
+    """
+    Generate the formatted JSON for a value without blocking the event loop.
 
-            case list() | set() | frozenset():
-                return _build_array(list(obj), ind, floats_forced)
+    Formatting runs in the calling thread, but hands control back to the
+    event loop at least every `interval` seconds, so other tasks keep
+    running while a large value is formatted. The result is the same as
+    `neat_json(value, **opts)`.
 
-            case tuple():
-                # Check for namedtuple (has _asdict and _fields)
-                if hasattr(obj, "_asdict") and hasattr(obj, "_fields"):
-                    return _build_value(getattr(obj, "_asdict")(), ind, floats_forced)
-                return _build_array(list(obj), ind, floats_forced)
+    Args:
+        value: The value to serialize to JSON.
+        interval: Longest time in seconds to format before letting other
+                  tasks run. Default: 0.01
+        **opts: Any of the keyword options accepted by `neat_json`.
 
-            case dict():
-                return _build_object(obj, ind, floats_forced)
+    Returns:
+        A formatted JSON string.
 
-            case _:
-                # Check for __json__ method first
-                if hasattr(obj, "__json__"):
-                    json_value = obj.__json__()
-                    # Don't memoize __json__ result - build it directly
-                    return _build_value(json_value, ind, floats_forced)
+    Examples:
+        >>> import asyncio
+        >>> asyncio.run(neat_json_async({"a": [1, 2]}))
+        '{"a":[1,2]}'
+    """
+    return "".join([chunk async for chunk in NeatEncoder(**opts).aiterencode(value, interval)])
 
-                # Enum: use the value
-                if isinstance(obj, Enum):
-                    return _build_value(obj.value, ind, floats_forced)
 
-                # Dataclass: convert to dict
-                if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
-                    return _build_value(dataclasses.asdict(obj), ind, floats_forced)
+def aiter_neat_json(
+    value: Any, *, interval: float = 0.01, chunk_size: int = 65536, **opts: Any
+) -> AsyncIterator[str]:
+    """
+    Generate the formatted JSON for a value as an async iterator of string chunks.
 
-                # Other iterables (range, deque, generators, etc.): convert to list
-                if isinstance(obj, Iterable):
-                    return _build_array(list(obj), ind, floats_forced)
+    Like `neat_json_async`, control is handed back to the event loop at
+    least every `interval` seconds. The output is gathered into chunks of
+    about `chunk_size` characters, suitable for writing to a stream;
+    joining them gives the same result as `neat_json(value, **opts)`.
 
-                # Fall back to json.dumps for other types
-                return f"{ind}{json.dumps(obj)}"
+    Args:
+        value: The value to serialize to JSON.
+        interval: Longest time in seconds to format before letting other
+                  tasks run. Default: 0.01
+        chunk_size: Number of characters gathered before a chunk is
+                    yielded. Default: 65536
+        **opts: Any of the keyword options accepted by `neat_json`.
+
+    Returns:
+        An async iterator of JSON text chunks.
+
+    Examples:
+        >>> async def write(response, data):
+        ...     async for chunk in aiter_neat_json(data, wrap=40):
+        ...         await response.write(chunk.encode())
+    """
+    return NeatEncoder(**opts).aiterencode(value, interval, chunk_size)
 
-    def _build_array(arr: list[Any], ind: str, floats_forced: bool) -> str:
-        """Build the JSON string for an array."""
-        if not arr:
-            return f"{ind}[]"
 
-        pieces = [build(v, "", floats_forced) for v in arr]
-        one_line = f"{ind}[{apad}{comma.join(pieces)}{apad}]"
+def neat_dump(value: Any, fp: IO[str] | IO[bytes], **opts: Any) -> None:
+    """
+    Write the formatted JSON for a value to a file object incrementally.
 
-        if wrap_width is None or len(one_line) <= wrap_width:
-            return one_line
+    Text file objects receive the chunks from `iter_neat_json` directly;
+    binary file objects receive them encoded as UTF-8.
 
-        if short:
-            indent2 = f"{ind} {apad}"
-            pieces = [build(v, indent2, floats_forced) for v in arr]
-            pieces[0] = pieces[0].replace(indent2, f"{ind}[{apad}", 1)
-            pieces[-1] = f"{pieces[-1]}{apad}]"
-            return ",\n".join(pieces)
+    Args:
+        value: The value to serialize to JSON.
+        fp: A text or binary file object with a `write` method.
+        **opts: Any of the keyword options accepted by `neat_json`.
+
+    Examples:
+        >>> import io
+        >>> buf = io.StringIO()
+        >>> neat_dump({"a": 1}, buf)
+        >>> buf.getvalue()
+        '{"a":1}'
+    """
+    _write_chunks(NeatEncoder(**opts).iterencode(value), fp)
+
+
+def neat_dump_into(value: Any, buffer: bytearray | io.BytesIO, **opts: Any) -> memoryview:
+    """
+    Write the formatted JSON for a value into a reusable buffer as UTF-8.
+
+    The output is encoded a chunk at a time straight into the buffer, so
+    no bytes object is made for the whole document, and wrapped output is
+    never held as one string either. Afterwards the buffer holds exactly
+    the formatted JSON: a bytearray is overwritten from its start, and so
+    is an io.BytesIO, whose position is left at the end. The space a buffer
+    already has is reused, so formatting into the same buffer again only
+    reallocates it when the output grows, or shrinks to less than half its
+    size.
+
+    Args:
+        value: The value to serialize to JSON.
+        buffer: A bytearray or io.BytesIO to write the output to.
+        **opts: Any of the keyword options accepted by `neat_json`.
+
+    Returns:
+        A memoryview of the output in the buffer, for writing it out without
+        copying it. Release the view (or use it in a `with` block) before
+        using the buffer again, since a buffer cannot grow while it is viewed.
+
+    Examples:
+        >>> buf = bytearray()
+        >>> with neat_dump_into({"a": "é"}, buf, ensure_ascii=False) as view:
+        ...     bytes(view)
+        b'{"a":"\\xc3\\xa9"}'
+    """
+    return NeatEncoder(**opts).encode_into(value, buffer)
+
+
+def neat_reformat(fp_in: IO[str] | IO[bytes], fp_out: IO[str] | IO[bytes], **opts: Any) -> None:
+    """
+    Reformat the JSON read from one file object, writing it to another.
+
+    The input is read and written incrementally, without loading the whole
+    document: an array or object is only read ahead until it is known
+    whether it fits on one line, so memory use is bounded by the wrap width
+    rather than the size of the document. The exceptions are objects whose
+    keys are sorted or aligned and, with `table`, arrays of objects, which
+    are read in full before they are written.
+
+    Numbers are written exactly as they appear in the input, unless
+    `decimals` is given or floats are forced for them. Otherwise the output
+    is the same as `neat_json(json.load(fp_in), **opts)`, except that an
+    object may be written with all of its repeated keys.
+
+    Args:
+        fp_in: A text or binary (UTF-8) file object to read JSON from.
+        fp_out: A text or binary file object to write the formatted JSON to.
+        **opts: Any of the keyword options accepted by `neat_json`.
+
+    Raises:
+        ValueError: If the input is not valid JSON. Output written before
+                    the error was found is left in fp_out.
+
+    Examples:
+        >>> import io
+        >>> out = io.StringIO()
+        >>> neat_reformat(io.StringIO('{"a": [1.50, 2e3]}'), out)
+        >>> out.getvalue()
+        '{"a":[1.50,2e3]}'
+    """
+    NeatEncoder(**opts).reformat(fp_in, fp_out)
+
+
+# Characters of output gathered before they are encoded into a buffer
+_ENCODE_CHUNK_SIZE = 65536
+
+
+def _gather_chunks(chunks: Iterable[str], size: int) -> Iterator[str]:
+    """Join text chunks into chunks of about size characters."""
+    pending: list[str] = []
+    total = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            yield "".join(pending)
+            pending.clear()
+            total = 0
+    if pending:
+        yield "".join(pending)
+
+
+def _write_chunks(chunks: Iterable[str], fp: IO[str] | IO[bytes]) -> None:
+    """Write text chunks to a text file object, or encoded as UTF-8 to a binary one."""
+    if isinstance(fp, (io.RawIOBase, io.BufferedIOBase)) or "b" in getattr(fp, "mode", ""):
+        write_bytes = cast(IO[bytes], fp).write
+        for chunk in chunks:
+            write_bytes(chunk.encode("utf-8"))
+    else:
+        write_text = cast(IO[str], fp).write
+        for chunk in chunks:
+            write_text(chunk)
+
+
+def neat_json_many(
+    values: Iterable[Any],
+    *,
+    workers: int | None = None,
+    chunksize: int = 64,
+    threads: bool = False,
+    **opts: Any,
+) -> Iterator[str]:
+    """
+    Format many independent values in parallel, yielding results in order.
+
+    Values are taken from the iterable lazily, in chunks, with only a few
+    chunks per worker in flight at a time, so arbitrarily long iterables can
+    be processed in bounded memory. Each result is identical to
+    `neat_json(value, **opts)`.
+
+    By default the work is spread over a pool of processes, each of which
+    creates one `NeatEncoder` for the options; the values, the options and
+    the results must then be picklable (so `sort` must be a module-level
+    function, not a lambda), and converters added with `register_type` must
+    be registered in the worker processes too (for example at import time).
+    With `threads=True` a thread pool sharing a single encoder is used
+    instead, which only runs in parallel on free-threaded Python builds.
+
+    Args:
+        values: The values to serialize to JSON.
+        workers: Number of worker processes or threads. Default: the
+                 number of CPUs. With 1, values are formatted serially.
+        chunksize: Number of values sent to a worker at a time. Default: 64
+        threads: Use a thread pool instead of a process pool. Default: False
+        **opts: Any of the keyword options accepted by `neat_json`.
+
+    Returns:
+        An iterator of formatted JSON strings, one per value.
+
+    Examples:
+        >>> list(neat_json_many([[1, 2], {"a": 3}], workers=1))
+        ['[1,2]', '{"a":3}']
+    """
+    encoder = NeatEncoder(**opts)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return map(encoder.encode, values)
+    return _neat_json_many(values, encoder, opts, workers, chunksize, threads)
+
+
+def _neat_json_many(
+    values: Iterable[Any],
+    encoder: NeatEncoder,
+    opts: dict[str, Any],
+    workers: int,
+    chunksize: int,
+    threads: bool,
+) -> Iterator[str]:
+    """Run neat_json_many on a pool, keeping at most two chunks per worker in flight."""
+    import concurrent.futures
+
+    executor: concurrent.futures.Executor
+    encode_chunk: Callable[[list[Any]], list[str]]
+    if threads:
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        encode_chunk = functools.partial(_encode_chunk, encoder)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker_encoder, initargs=(opts,)
+        )
+        encode_chunk = _encode_chunk_in_worker
+
+    pending: deque[concurrent.futures.Future[list[str]]] = deque()
+    it = iter(values)
+    try:
+        while chunk := list(itertools.islice(it, chunksize)):
+            pending.append(executor.submit(encode_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+# The encoder used by each neat_json_many worker process
+_worker_encoder: NeatEncoder | None = None
+
+
+def _init_worker_encoder(opts: dict[str, Any]) -> None:
+    """Create the encoder for a neat_json_many worker process."""
+    global _worker_encoder
+    _worker_encoder = NeatEncoder(**opts)
+
+
+def _encode_chunk_in_worker(chunk: list[Any]) -> list[str]:
+    """Format a chunk of values in a neat_json_many worker process."""
+    assert _worker_encoder is not None
+    return _encode_chunk(_worker_encoder, chunk)
+
+
+def _encode_chunk(encoder: NeatEncoder, chunk: list[Any]) -> list[str]:
+    """Format a chunk of values with an encoder."""
+    return [encoder.encode(value) for value in chunk]
+
+
+def neat_json_parallel(
+    value: Any,
+    *,
+    workers: int | None = None,
+    chunksize: int | None = None,
+    **opts: Any,
+) -> str:
+    """
+    Format one large array or object using several worker processes.
+
+    The members of the top-level array or object are split into chunks that
+    are formatted in parallel, each with the indentation it has in the full
+    document, and the results are joined with the same separators. The
+    output is identical to `neat_json(value, **opts)`. Values that fit on a
+    single line, and anything other than an array or object, are formatted
+    serially.
+
+    Where worker processes are forked (the default on Linux before Python
+    3.14) the document and options are shared with them without copying;
+    otherwise they must be picklable.
+
+    Args:
+        value: The value to serialize to JSON.
+        workers: Number of worker processes. Default: the number of CPUs.
+                 With 1, the value is formatted serially.
+        chunksize: Number of top-level members formatted per task. Default:
+                   enough for about four tasks per worker.
+        **opts: Any of the keyword options accepted by `neat_json`.
+
+    Returns:
+        A formatted JSON string.
+
+    Examples:
+        >>> neat_json_parallel(list(range(5)), workers=2, wrap=True, indent=" ")
+        '[\\n 0,\\n 1,\\n 2,\\n 3,\\n 4\\n]'
+    """
+    encoder = NeatEncoder(**opts)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return encoder.encode(value)
+    return encoder._encode_parallel(value, workers, chunksize)
+
+
+# The encoder, kind of part ("flat", "item" or "member"), indentation and
+# parts of the document formatted by neat_json_parallel worker processes
+_worker_parts: tuple[NeatEncoder, str, str, list[tuple[Any, ...]]] | None = None
+
+
+def _init_worker_parts(encoder: NeatEncoder, kind: str, ind: str, parts: list[tuple[Any, ...]]) -> None:
+    """Receive the parts of a document in a neat_json_parallel worker process."""
+    global _worker_parts
+    _worker_parts = (encoder, kind, ind, parts)
+
+
+def _format_parts_in_worker(start: int, stop: int) -> list[str]:
+    """Format a range of the parts of a document in a neat_json_parallel worker process."""
+    assert _worker_parts is not None
+    encoder, kind, ind, parts = _worker_parts
+    state = _EncodeState()
+    return [encoder._format_part(kind, ind, part, state) for part in parts[start:stop]]
+
+
+def register_type(cls: type, fn: Callable[[Any], Any]) -> None:
+    """
+    Register a converter for instances of a class (and its subclasses).
+
+    When a value of that class is serialized, fn is called with it and the
+    returned value is serialized in its place, the same way as the result of
+    a `__json__()` method. Registered converters take precedence over all
+    built-in handling of a type. fn is not applied to what it returns,
+    which may be of the same type (such as a float rounded to fewer
+    places); that is handled as it would be if fn were not registered.
+
+    Args:
+        cls: The class whose instances fn converts.
+        fn: A callable taking an instance and returning a JSON-compatible value.
+
+    Examples:
+        >>> class Point:
+        ...     def __init__(self, x, y):
+        ...         self.x, self.y = x, y
+        >>> register_type(Point, lambda p: [p.x, p.y])
+        >>> neat_json({"at": Point(1, 2)})
+        '{"at":[1,2]}'
+    """
+    _type_converters[cls] = fn
+    _type_dispatch.clear()
+
+
+def unregister_type(cls: type) -> None:
+    """
+    Remove the converter registered for a class with `register_type`.
+
+    Instances of the class are then serialized as they would have been had
+    the converter never been registered.
+
+    Raises:
+        KeyError: If no converter is registered for exactly that class.
+    """
+    del _type_converters[cls]
+    _type_dispatch.clear()
+
+
+def register_field_adapter(adapter: Callable[[type], Iterable[str] | None]) -> None:
+    """
+    Register a way to find the fields of classes from a modelling library.
+
+    Instances of a class that an adapter returns field names for are
+    serialized as objects, with a member for each field, read straight from
+    the instance. No intermediate copy of the object graph is made (as
+    `dataclasses.asdict` or a `model_dump()` method would), and the names
+    are only looked up once per class. Dataclasses, attrs classes and
+    Pydantic models are handled this way already.
+
+    Adapters are tried in the order they were registered, before the
+    built-in ones; converters added with `register_type` and `__json__()`
+    methods take precedence over all of them.
+
+    Args:
+        adapter: A callable taking a class and returning the names of the
+                 fields of its instances, or None if the class is not one
+                 it knows.
+
+    Examples:
+        >>> class Struct:
+        ...     __struct_fields__ = ("x", "y")
+        ...     def __init__(self, x, y):
+        ...         self.x, self.y = x, y
+        >>> register_field_adapter(lambda cls: getattr(cls, "__struct_fields__", None))
+        >>> neat_json([Struct(1, 2)])
+        '[{"x":1,"y":2}]'
+    """
+    _field_adapters.append(adapter)
+    _type_dispatch.clear()
+
+
+def unregister_field_adapter(adapter: Callable[[type], Iterable[str] | None]) -> None:
+    """
+    Remove an adapter added with `register_field_adapter`.
+
+    Raises:
+        ValueError: If the adapter is not registered.
+    """
+    _field_adapters.remove(adapter)
+    _type_dispatch.clear()
+
+
+def slot_fields(cls: type) -> list[str] | None:
+    """
+    Return the public __slots__ of a class whose instances have no __dict__.
+
+    Slotted classes are not serialized field by field unless asked for,
+    since their slots are often internal state. This is a field adapter
+    for them, to be registered with `register_field_adapter`, usually
+    limited to your own classes. Slots left unset are left out of the
+    object. Returns None for classes with a __dict__, classes from the
+    standard library (such as uuid.UUID and pathlib.Path), and classes
+    with no public slots; slots whose names start with an underscore are
+    never included.
+
+    Args:
+        cls: The class to find the slots of.
+
+    Examples:
+        >>> class Vector:
+        ...     __slots__ = ("x", "y", "_norm")
+        ...     def __init__(self, x, y):
+        ...         self.x, self.y = x, y
+        >>> register_field_adapter(lambda cls: slot_fields(cls) if issubclass(cls, Vector) else None)
+        >>> neat_json([Vector(1, 2)])
+        '[{"x":1,"y":2}]'
+    """
+    if cls.__dictoffset__ or cls.__module__.partition(".")[0] in sys.stdlib_module_names:
+        return None
+    names = []
+    for c in reversed(cls.__mro__):
+        slots = c.__dict__.get("__slots__", ())
+        names.extend(name for name in ((slots,) if isinstance(slots, str) else slots) if not name.startswith("_"))
+    return names or None
+
+
+# Converters added with register_type, keyed by class
+_type_converters: dict[type, Callable[[Any], Any]] = {}
+
+# Adapters added with register_field_adapter, in the order they were added
+_field_adapters: list[Callable[[type], Iterable[str] | None]] = []
+
+# How values of each type seen so far are resolved, keyed by exact type; see
+# _classify. Cleared whenever it grows too large or a converter is registered.
+_type_dispatch: dict[type, Callable[[Any], Any]] = {}
+_TYPE_DISPATCH_LIMIT = 1024
+
+
+def _as_is(obj: Any) -> Any:
+    """Serialize a value directly: built-in JSON types, and anything left for json.dumps."""
+    return obj
+
+
+def _call_json(obj: Any) -> Any:
+    """Serialize the result of a __json__() method."""
+    return obj.__json__()
+
+
+def _enum_value(obj: Enum) -> Any:
+    """Serialize an Enum member using its value."""
+    return obj.value
+
+
+# About how many values of a float32 (or float16) array _numpy_array
+# converts through text at once
+_NUMPY_CHUNK = 4096
+
+
+def _numpy_array(arr: Any) -> Any:
+    """Convert a NumPy array to nested lists of Python values, vectorized."""
+    if arr.dtype.kind != "f" or arr.dtype.itemsize == 8:
+        return arr.tolist()
+    if arr.ndim == 0:
+        return _numpy_scalar(arr[()])
+    # Go through the shortest text for each value at its own precision, so
+    # that float32 0.1 is written as 0.1 and not as 0.10000000149011612. The
+    # text takes far more room than the values, so it is made for a chunk of
+    # rows at a time rather than for the whole array.
+    step = max(1, _NUMPY_CHUNK * len(arr) // max(1, arr.size))
+    values = []
+    for start in range(0, len(arr), step):
+        values.extend(arr[start : start + step].astype(str).astype(float).tolist())
+    return values
+
+
+def _numpy_scalar(obj: Any) -> Any:
+    """Convert a NumPy scalar to the equivalent Python value."""
+    if obj.dtype.kind == "f":
+        # As for arrays, keep the shortest text at the value's own precision
+        return float(str(obj))
+    return obj.item()
+
+
+def _namedtuple_fields(fields: tuple[str, ...]) -> Callable[[Any], Any]:
+    """Return a converter using the fields of a namedtuple class as object keys."""
+    return lambda obj: dict(zip(fields, obj))
+
+
+class _Fields(dict[str, Any]):
+    """
+    The fields of an object (such as a dataclass instance), read when it is written.
+
+    These are read again each time the object is reached rather than kept
+    for the whole call, so source, the object they were read from, stands
+    in for them in the markers used to detect circular references.
+    """
+
+    __slots__ = ("source",)
+
+
+class _FieldConverter:
+    """
+    Converter making an object of the given attributes of a value.
+    Attributes that are not set (such as unassigned __slots__) are left out.
+    """
+
+    __slots__ = ("fields", "_getter")
+
+    def __init__(self, fields: tuple[str, ...]) -> None:
+        self.fields = fields
+        getter: Callable[[Any], tuple[Any, ...]]
+        if len(fields) > 1:
+            getter = operator.attrgetter(*fields)
+        elif fields:
+            get = operator.attrgetter(fields[0])
+            getter = lambda obj: (get(obj),)  # noqa: E731
         else:
-            indent2 = f"{ind}{indent}"
-            inner = ",\n".join(build(v, indent2, floats_forced) for v in arr)
-            close_ind = indent2 if indent_last else ind
-            return f"{ind}[\n{inner}\n{close_ind}]"
+            getter = lambda obj: ()  # noqa: E731
+        self._getter = getter
 
-    def _build_object(obj: dict[Any, Any], ind: str, floats_forced: bool) -> str:
-        """Build the JSON string for an object."""
-        if not obj:
-            return f"{ind}{{}}"
+    def __call__(self, obj: Any) -> _Fields:
+        fields = self.fields
+        try:
+            result = _Fields(zip(fields, self._getter(obj)))
+        except AttributeError:
+            result = _Fields((field, value) for field in fields if (value := getattr(obj, field, _UNSET)) is not _UNSET)
+        result.source = obj
+        return result
 
-        # Convert to list of items for potential sorting
-        items: list[tuple[Any, Any]] = list(obj.items())
+    def values(self, obj: Any) -> tuple[Any, ...] | None:
+        """Return the values of all of the fields of a value, or None if any is not set."""
+        try:
+            return self._getter(obj)
+        except AttributeError:
+            return None
 
-        # Handle sorting
-        if sort_opt:
-            if sort_opt is True:
-                items = builtins_sorted(items, key=lambda kv: str(kv[0]))
-            elif callable(sort_opt):
-                # Determine arity of sort function
-                try:
-                    sig = inspect.signature(sort_opt)
-                    # Count params that could accept positional arguments
-                    max_arity = len(
-                        [
-                            p
-                            for p in sig.parameters.values()
-                            if p.kind
-                            in (
-                                inspect.Parameter.POSITIONAL_ONLY,
-                                inspect.Parameter.POSITIONAL_OR_KEYWORD,
-                            )
-                        ]
-                    )
-                except (ValueError, TypeError):
-                    max_arity = 1
-
-                # sort_opt is confirmed callable at this point
-                sort_fn = sort_opt  # type: Callable[..., Any]
-                if max_arity >= 3:
-                    items = builtins_sorted(
-                        items, key=lambda kv: sort_fn(kv[0], kv[1], obj)
-                    )
-                elif max_arity >= 2:
-                    items = builtins_sorted(items, key=lambda kv: sort_fn(kv[0], kv[1]))
-                else:
-                    items = builtins_sorted(items, key=lambda kv: sort_fn(kv[0]))
 
-        # Get string keys for force_floats_in lookup
-        keys = [str(k) for k, _ in items]
+def _marker(obj: Any) -> int:
+    """Return the id() marking a resolved object while it is written, to detect circular references."""
+    return id(obj.source) if type(obj) is _Fields else id(obj)
 
-        # Build key-value strings for single line attempt
-        keyvals_1 = [
-            (json.dumps(str(k)), build(v, "", force_floats or keys[i] in _force_floats_in))
-            for i, (k, v) in enumerate(items)
-        ]
-        keyvals_str = comma.join(f"{k}{colon1}{v}" for k, v in keyvals_1)
-        one_line = f"{ind}{{{opad}{keyvals_str}{opad}}}"
-
-        if wrap_width is None or len(one_line) <= wrap_width:
-            return one_line
-
-        # Multi-line formatting
-        if short:
-            keyvals = [[f"{ind} {opad}{json.dumps(str(k))}", v, i] for i, (k, v) in enumerate(items)]
-            keyvals[0][0] = keyvals[0][0].replace(f"{ind} ", f"{ind}{{", 1)
-
-            if aligned:
-                longest = max(len(kv[0]) for kv in keyvals)
-                keyvals = [[kv[0].ljust(longest), kv[1], kv[2]] for kv in keyvals]
-
-            result_lines: list[str] = []
-            for k_str, v, idx in keyvals:
-                key_floats_forced = force_floats or keys[idx] in _force_floats_in
-                indent2 = " " * len(f"{k_str}{colonn}")
-                one_line_kv = f"{k_str}{colonn}{build(v, '', key_floats_forced)}"
-                if (
-                    wrap_width is not None
-                    and len(one_line_kv) > wrap_width
-                    and isinstance(v, (list, tuple, set, frozenset, dict))
-                ):
-                    result_lines.append(f"{k_str}{colonn}{build(v, indent2, key_floats_forced).lstrip()}")
-                else:
-                    result_lines.append(one_line_kv)
 
-            return f"{',\n'.join(result_lines)}{opad}}}"
+# Stands in for attributes that are not set
+_UNSET = object()
+
+
+def _dataclass_fields(cls: type) -> Iterable[str] | None:
+    """Return the names of the fields of a dataclass."""
+    dataclasses = sys.modules.get("dataclasses")
+    if dataclasses is None or not dataclasses.is_dataclass(cls):
+        return None
+    return [field.name for field in dataclasses.fields(cls)]
+
+
+def _attrs_fields(cls: type) -> Iterable[str] | None:
+    """Return the names of the fields of an attrs class."""
+    attributes = getattr(cls, "__attrs_attrs__", None)
+    return None if attributes is None else [attribute.name for attribute in attributes]
+
+
+def _pydantic_fields(cls: type) -> Iterable[str] | None:
+    """Return the names of the fields (and computed fields) of a Pydantic model."""
+    pydantic = sys.modules.get("pydantic")
+    if pydantic is None or not issubclass(cls, pydantic.BaseModel):
+        return None
+    if hasattr(cls, "model_fields"):
+        return [*cls.model_fields, *cls.model_computed_fields]
+    return list(cls.__fields__)  # Pydantic 1
+
+
+# The built-in adapters, tried after those added with register_field_adapter
+_BUILTIN_FIELD_ADAPTERS = (_dataclass_fields, _attrs_fields, _pydantic_fields)
+
+
+def _adapted_fields(cls: type) -> tuple[str, ...] | None:
+    """Return the field names the first adapter that knows a class gives for it, if any does."""
+    for adapter in (*_field_adapters, *_BUILTIN_FIELD_ADAPTERS):
+        fields = adapter(cls)
+        if fields is not None:
+            return tuple(fields)
+    return None
+
+
+def _loaded_class(module: str, name: str) -> tuple[type, ...]:
+    """
+    Return the class module.name, in a tuple for issubclass, if the module has
+    already been imported; its values cannot exist otherwise.
+    """
+    mod = sys.modules.get(module)
+    return (getattr(mod, name),) if mod is not None else ()
+
+
+def _builtin_conversion(cls: type) -> Callable[[Any], Any]:
+    """Choose how values of exactly the type cls are resolved when no converter is registered for it."""
+    convert: Callable[[Any], Any]
+    if issubclass(cls, (_RawNumber, _Stream)):
+        convert = _as_is
+    elif issubclass(cls, _loaded_class("decimal", "Decimal") + _loaded_class("fractions", "Fraction")) or (
+        issubclass(cls, float) and cls is not float
+    ):
+        # Convert to float for JSON serialization; float subclasses (such as
+        # numpy.float64) may override repr()
+        convert = float
+    elif issubclass(cls, (str, int, float, type(None), list, set, frozenset, dict)):
+        convert = _as_is
+    elif (numpy := sys.modules.get("numpy")) is not None and issubclass(cls, (numpy.ndarray, numpy.generic)):
+        # NumPy can only be in use if it has already been imported
+        convert = _numpy_array if issubclass(cls, numpy.ndarray) else _numpy_scalar
+    elif issubclass(cls, tuple):
+        # Check for namedtuple (has _asdict and _fields)
+        convert = _namedtuple_fields(cls._fields) if hasattr(cls, "_asdict") and hasattr(cls, "_fields") else _as_is
+    elif hasattr(cls, "__json__"):
+        convert = _call_json
+    elif issubclass(cls, _loaded_class("enum", "Enum")):
+        convert = _enum_value
+    elif (fields := _adapted_fields(cls)) is not None:
+        # Each object is read field by field when it is reached, rather than
+        # the whole graph being copied into dicts up front as
+        # dataclasses.asdict does
+        convert = _FieldConverter(fields)
+    elif issubclass(cls, Iterator):
+        # Generators, cursors and other one-shot iterators are read as they
+        # are written
+        convert = _Stream
+    elif issubclass(cls, Iterable):
+        # Other iterables (range, deque, etc.): convert to list
+        convert = list
+    else:
+        # Left for json.dumps to serialize
+        convert = _as_is
+    return convert
+
+
+def _classify(cls: type) -> Callable[[Any], Any]:
+    """Choose, and remember, how values of exactly the type cls are resolved."""
+    registered = next((c for c in cls.__mro__ if c in _type_converters), None)
+    convert = _type_converters[registered] if registered is not None else _builtin_conversion(cls)
+    if len(_type_dispatch) >= _TYPE_DISPATCH_LIMIT:
+        _type_dispatch.clear()
+    _type_dispatch[cls] = convert
+    return convert
+
+
+# The types json's C encoder writes exactly as _flat does (apart from floats
+# equal to integers, NaN and the infinities), and their base classes, which
+# must not have converters registered
+_PLAIN_TYPES = frozenset((str, int, float, bool, type(None), list, tuple, dict))
+_PLAIN_BASES = frozenset(itertools.chain.from_iterable(cls.__mro__ for cls in _PLAIN_TYPES))
+_STR_TYPE = frozenset((str,))
+_CONTAINER_TYPES = frozenset((list, tuple, dict))
+
+
+def _is_plain(obj: dict[Any, Any] | list[Any]) -> bool:
+    """
+    Whether an array or object holds only values that json's C encoder writes as _flat would.
+
+    These are strings, integers, booleans, None and floats not equal to an
+    integer, in lists, tuples, objects with string keys and objects written
+    as their fields (such as dataclasses), all of exactly those types. NaN
+    and the infinities are not checked for, since the encoder rejects them.
+    Values containing the same array or object twice are not plain either,
+    which keeps the check from looping on values that contain themselves.
+    """
+    # The tree is checked a level at a time, with every step of each level
+    # run by builtins rather than by a Python loop per value
+    level: list[Any] = [obj]
+    seen = {id(obj)}
+    field_types: set[type] = set()
+    if type(obj) is _Fields:
+        level = [obj.source]
+        field_types.add(type(obj.source))
+    nested_types = _CONTAINER_TYPES
+    while level:
+        fields: list[tuple[Any, ...] | None] = []
+        if field_types:
+            objects = [v for v in level if type(v) in field_types]
+            if objects:
+                fields = list(map(_field_values, objects))
+                if None in fields:
+                    return False
+                level = [v for v in level if type(v) not in field_types]
+        dicts = [v for v in level if type(v) is dict]
+        if dicts:
+            if not _STR_TYPE.issuperset(map(type, itertools.chain.from_iterable(dicts))):
+                return False
+            arrays = [v for v in level if type(v) is not dict] if len(dicts) < len(level) else []
+            members = list(itertools.chain(itertools.chain.from_iterable(map(dict.values, dicts)), *arrays, *fields))
         else:
-            keyvals = [[f"{ind}{indent}{json.dumps(str(k))}", v, i] for i, (k, v) in enumerate(items)]
-
-            if aligned:
-                longest = max(len(kv[0]) for kv in keyvals)
-                keyvals = [[kv[0].ljust(longest), kv[1], kv[2]] for kv in keyvals]
-
-            indent2 = f"{ind}{indent}"
-            result_lines = []
-            for k_str, v, idx in keyvals:
-                key_floats_forced = force_floats or keys[idx] in _force_floats_in
-                one_line_kv = f"{k_str}{colonn}{build(v, '', key_floats_forced)}"
-                if (
-                    wrap_width is not None
-                    and len(one_line_kv) > wrap_width
-                    and isinstance(v, (list, tuple, set, frozenset, dict))
-                ):
-                    result_lines.append(f"{k_str}{colonn}{build(v, indent2, key_floats_forced).lstrip()}")
-                else:
-                    result_lines.append(one_line_kv)
+            members = list(itertools.chain(itertools.chain.from_iterable(level), *fields))
+        types = list(map(type, members))
+        type_set = set(types)
+        if not _PLAIN_TYPES.issuperset(type_set):
+            if not _add_field_types(type_set, field_types):
+                return False
+            nested_types = _CONTAINER_TYPES.union(field_types)
+        if float in type_set:
+            floats = itertools.compress(members, map(operator.is_, types, itertools.repeat(float)))
+            if any(map(float.is_integer, floats)):
+                return False
+        if type_set.isdisjoint(nested_types):
+            return True
+        level = list(itertools.compress(members, map(nested_types.__contains__, types)))
+        ids = set(map(id, level))
+        if len(ids) < len(level) or not seen.isdisjoint(ids):
+            return False
+        seen |= ids
+    return True
+
+
+def _field_values(obj: Any) -> tuple[Any, ...] | None:
+    """Return the values of the fields of an object written as its fields, or None if any is not set."""
+    cls = type(obj)
+    return (_type_dispatch.get(cls) or _classify(cls)).values(obj)  # type: ignore[attr-defined]
+
+
+def _add_field_types(types: set[type], field_types: set[type]) -> bool:
+    """
+    Add the classes in types that are not plain to field_types, returning
+    whether all of them are written as objects of their fields.
+    """
+    for cls in types - _PLAIN_TYPES - field_types:
+        if type(_type_dispatch.get(cls) or _classify(cls)) is not _FieldConverter:
+            return False
+        field_types.add(cls)
+    return True
+
+
+# The fewest members an array or object (that is not plain) must have for
+# the plain ones within it to be looked for
+_NATIVE_MIN_SIZE = 8
+
+# The most values a small array or object may hold in all to be written
+# without being measured first
+_SMALL_SIZE = 32
+
+
+def _plain_subtrees(obj: dict[Any, Any] | list[Any]) -> set[int]:
+    """
+    Return the id() of each array and object nested in a value that is
+    plain (see _is_plain), or of the object its fields were read from.
+
+    Every array and object is visited once, a level at a time; each is then
+    marked as not plain if any of its own members are not, or if any nested
+    array or object is.
+    """
+    levels: list[tuple[list[Any], list[int]]] = []
+    bad: list[set[int]] = []
+    level: list[Any] = [obj]
+    parents: list[int] = [-1]
+    seen = {id(obj)}
+    field_types: set[type] = set()
+    if type(obj) is _Fields:
+        level = [obj.source]
+        field_types.add(type(obj.source))
+    while level:
+        level_bad = set()
+        nested: list[Any] = []
+        nested_parents: list[int] = []
+        for i, container in enumerate(level):
+            if type(container) in field_types:
+                values = _field_values(container)
+                if values is None:
+                    level_bad.add(i)
+                    continue
+            else:
+                values = container.values() if type(container) is dict else container
+            types = list(map(type, values))
+            type_set = set(types)
+            if (
+                (type(container) is dict and not _STR_TYPE.issuperset(map(type, container)))
+                or not (_PLAIN_TYPES.issuperset(type_set) or _add_field_types(type_set, field_types))
+                or (
+                    float in type_set
+                    and any(map(float.is_integer, itertools.compress(values, map(operator.is_, types, itertools.repeat(float)))))
+                )
+            ):
+                level_bad.add(i)
+            if not type_set.isdisjoint(_CONTAINER_TYPES) or not type_set.isdisjoint(field_types):
+                for v in values:
+                    if type(v) in _CONTAINER_TYPES or type(v) in field_types:
+                        if id(v) in seen:
+                            # Repeated (or containing itself), as for _is_plain
+                            level_bad.add(i)
+                        else:
+                            seen.add(id(v))
+                            nested.append(v)
+                            nested_parents.append(i)
+        levels.append((level, parents))
+        bad.append(level_bad)
+        level, parents = nested, nested_parents
+
+    # Containers holding ones that are not plain are not plain either
+    plain: set[int] = set()
+    for depth in range(len(levels) - 1, 0, -1):
+        level, parents = levels[depth]
+        level_bad = bad[depth]
+        parent_bad = bad[depth - 1]
+        parent_bad.update(parents[i] for i in level_bad)
+        plain.update(id(v) for i, v in enumerate(level) if i not in level_bad)
+    return plain
+
+
+def _native_fields(obj: Any) -> Any:
+    """
+    Make an object of the fields of a value for json's C encoder, which
+    _is_plain has found to be written as one; other values it has already
+    ruled out are rejected.
+    """
+    convert = _type_dispatch.get(type(obj))
+    if type(convert) is not _FieldConverter:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return convert(obj)
+
+
+@functools.lru_cache(maxsize=64)
+def _native_encoder(ensure_ascii: bool, key_separator: str, item_separator: str, sort_keys: bool) -> Any:
+    """Return json's C encoder for single-line output with these options."""
+    escape = encode_basestring_ascii if ensure_ascii else encode_basestring
+    # No markers, so that values containing themselves recurse until
+    # RecursionError rather than leaving stale markers behind
+    return c_make_encoder(None, _native_fields, escape, None, key_separator, item_separator, sort_keys, False, False)
+
+
+# Floats formatted in each batch, in arrays laid out across lines
+_FLOATS_SLICE_SIZE = 1024
+
+
+def _all_floats(arr: Any) -> TypeGuard[list[float] | tuple[float, ...]]:
+    """Whether an array is a non-empty list or tuple containing only floats, so it can be formatted in one batch."""
+    # The first member is checked on its own, since most arrays that are
+    # not all floats do not start with one. Floats with a converter
+    # registered for them are each resolved instead.
+    return (
+        type(arr) in (list, tuple)
+        and bool(arr)
+        and type(arr[0]) is float
+        and (_type_dispatch.get(float) or _classify(float)) is _as_is
+        and all(type(v) is float for v in arr)
+    )
+
+
+class _EncodeState:
+    """State for a single encode() or iterencode() call."""
+
+    __slots__ = ("resolved", "content_keys", "markers", "flat")
+
+    def __init__(self) -> None:
+        # Resolved values for wrapper types (namedtuple, __json__, Enum,
+        # other iterables, and objects written as their fields when layouts
+        # are cached), keyed by id() of the original. The original is stored
+        # alongside its resolution so that its id cannot be reused during
+        # this call, and so that one-shot iterables are consumed only once.
+        self.resolved: dict[int, tuple[Any, Any]] = {}
+
+        # Content keys of arrays and objects for the subtree cache, keyed by
+        # id(); see NeatEncoder._content_key
+        self.content_keys: dict[int, _ContentKey | None] = {}
+
+        # id() of the arrays and objects currently being written or measured,
+        # to detect circular references
+        self.markers: set[int] = set()
+
+        # Single-line text of the arrays and objects within a small value
+        # that was written on one line but did not fit, keyed by (_marker(),
+        # floats forced); see NeatEncoder._small_flat
+        self.flat: dict[tuple[int, bool], str] = {}
+
+
+class _Stream:
+    """
+    A one-shot iterator (such as a generator) written as an array.
+
+    Items are only read from the iterator as they are needed. Measuring the
+    array with peek() keeps the items it reads, so that they can be written
+    afterwards, but writing it by iterating over it does not, so an array
+    that does not fit on one line is written in bounded memory.
+    """
+
+    __slots__ = ("head", "rest")
+
+    def __init__(self, it: Iterator[Any]) -> None:
+        self.head: list[Any] = []
+        self.rest = it
+
+    def __bool__(self) -> bool:
+        if not self.head:
+            self.head.extend(itertools.islice(self.rest, 1))
+        return bool(self.head)
+
+    def __iter__(self) -> Iterator[Any]:
+        """Read the items, dropping those read ahead by peek()."""
+        head, self.head = self.head, []
+        yield from head
+        yield from self.rest
+
+    def peek(self) -> Iterator[Any]:
+        """Read the items, keeping them to be read again."""
+        head = self.head
+        yield from head
+        for item in self.rest:
+            head.append(item)
+            yield item
+
+    def materialize(self) -> list[Any]:
+        """Read all of the items, keeping them to be read again."""
+        self.head.extend(self.rest)
+        return self.head
+
+
+def _circular_reference() -> ValueError:
+    """Return the error raised for a value that contains itself, matching json.dumps."""
+    return ValueError("Circular reference detected")
+
+
+class _Capture:
+    """
+    A request, yielded by a layout from NeatEncoder._emit, to cache the text of a nested layout.
+
+    NeatEncoder._walk collects the text of the nested layout and stores it in
+    the subtree cache under key, as well as writing it out.
+    """
+
+    __slots__ = ("key", "layout")
+
+    def __init__(self, key: Hashable, layout: Iterator[Any]) -> None:
+        self.key = key
+        self.layout = layout
+
+
+class _Shape:
+    """The layout of the keys of an object, shared by objects with the same keys."""
+
+    __slots__ = ("keys", "names", "floats_forced", "aligned_names", "flat_starts", "widths")
+
+    def __init__(
+        self,
+        keys: list[Any],
+        names: list[str],
+        floats_forced: list[bool],
+        aligned_names: list[str],
+        widths: list[int],
+    ) -> None:
+        # Keys in output order, with their JSON text, whether integers under
+        # them are written as floats, and their JSON text padded to the
+        # longest for aligned objects
+        self.keys = keys
+        self.names = names
+        self.floats_forced = floats_forced
+        self.aligned_names = aligned_names
+        # The width of the text before each value on a single line, counting
+        # a comma for every member, and that text itself (the key and colon,
+        # after a comma for all but the first), which _flat fills in when it
+        # first needs it
+        self.widths = widths
+        self.flat_starts: list[str] | None = None
+
+
+class _ContentKey:
+    """A hashable key for the content of an array or object, with its hash computed once."""
+
+    __slots__ = ("parts", "_hash")
+
+    def __init__(self, parts: tuple[Any, ...]) -> None:
+        self.parts = parts
+        self._hash = hash(parts)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, _ContentKey):
+            return False
+
+        # Compare nested keys with an explicit stack, since documents may be
+        # nested deeper than the recursion limit
+        pending = [(self, other)]
+        while pending:
+            a, b = pending.pop()
+            if a._hash != b._hash or len(a.parts) != len(b.parts):
+                return False
+            for x, y in zip(a.parts, b.parts):
+                if x is y:
+                    continue
+                if type(x) is _ContentKey:
+                    if type(y) is not _ContentKey:
+                        return False
+                    pending.append((x, y))
+                elif x != y:
+                    return False
+        return True
+
+
+class SubtreeCache:
+    """
+    A size-bounded LRU cache of formatted arrays and objects.
+
+    Pass one to `neat_json` or `NeatEncoder` as `cache` to format repeated
+    sub-documents (such as the same fragment embedded in many values) only
+    once, across calls. Entries are keyed on the content of a subtree and on
+    the formatting options, never on object identity, so mutating a value
+    cannot produce stale output. Only subtrees made of str, int, float,
+    bool, None, list, tuple, set, frozenset and dict (after conversion of
+    other types) are cached. A cache may be shared by encoders and threads.
+
+    Subtrees whose text is longer than max_chars are formatted every time
+    rather than cached: they are rarely repeated, and keeping the text of
+    every level of a large, deeply nested value would take time and memory
+    in proportion to its size times its depth. Nor are single-line values
+    that json's C encoder writes, which it does faster than they could be
+    looked up.
+
+    Attributes:
+        maxsize: Maximum number of entries kept.
+        max_chars: Longest text, in characters, of a subtree that is cached.
+        hits: Number of lookups answered from the cache.
+        misses: Number of lookups that had to format the subtree.
+
+    Example:
+        >>> cache = SubtreeCache(maxsize=100)
+        >>> schema = {"type": "object", "required": ["id", "name"]}
+        >>> for i in range(3):
+        ...     _ = neat_json({"id": i, "schema": schema}, wrap=30, cache=cache)
+        >>> cache.hits
+        2
+    """
+
+    def __init__(self, maxsize: int = 1024, max_chars: int = 16384) -> None:
+        self.maxsize = maxsize
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return f"SubtreeCache(maxsize={self.maxsize}, size={len(self)}, hits={self.hits}, misses={self.misses})"
+
+    def clear(self) -> None:
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def nbytes(self) -> int:
+        """Return the approximate memory held by the cache, in bytes."""
+        with self._lock:
+            pending: list[Any] = [obj for entry in self._entries.items() for obj in entry]
+        total = sys.getsizeof(self._entries)
+        seen: set[int] = set()
+        while pending:
+            obj = pending.pop()
+            # Types in content keys are shared with the rest of the program
+            if id(obj) in seen or isinstance(obj, type):
+                continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+            if isinstance(obj, _ContentKey):
+                pending.append(obj.parts)
+            elif isinstance(obj, tuple):
+                pending.extend(obj)
+        return total
+
+    def _lookup(self, key: Hashable) -> str | None:
+        """Return the text cached for key, or None on a miss."""
+        with self._lock:
+            text = self._entries.get(key)
+            if text is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return text
+
+    def _store(self, key: Hashable, text: str) -> None:
+        """Cache the text built for key after a miss."""
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class FormatStats:
+    """
+    Counters and timings describing where formatting time goes.
+
+    Pass one to `neat_json` or `NeatEncoder` as `stats` to accumulate them
+    over every call that uses it; `neat_dump`, `neat_dump_into`,
+    `neat_reformat` and `NeatDocument` take it too. For a NeatDocument, each
+    time its text is formatted again counts as a call, and the remembered
+    text of unchanged arrays and objects counts as cache hits. An encoder
+    created without `stats` is not instrumented at all, so collection costs
+    nothing when it is disabled.
+    Collection is not synchronized: share a FormatStats only between calls
+    made from one thread, and note that work done in the worker processes of
+    `neat_json_many` and `neat_json_parallel` is not counted.
+
+    Attributes:
+        calls: Number of values formatted.
+        visits: Number of times a value was examined. A value is examined
+                once to measure it and again to write it, and values inside
+                cached subtrees are not examined at all.
+        scalars: Number of times a string, number, boolean or null was
+                 formatted, other than floats formatted as a batch. Like
+                 strings and floats, this counts a value measured and then
+                 written twice.
+        strings: Number of times a string value was escaped.
+        floats: Number of times a float was formatted.
+        sorts: Number of objects whose keys were sorted. Objects with the
+               same keys as an earlier one reuse its order, and are not
+               counted.
+        measures: Number of arrays and objects measured to see whether they
+                  fit on one line.
+        overflows: Number of measurements that found the value too wide, so
+                   that it was laid out over several lines instead.
+        flat: Number of arrays and objects written on a single line
+              (not counting those nested in another single-line value).
+        native: Number of arrays and objects on a single line written by
+                json's C encoder (nested ones included, when the value
+                around them is not), which is used when they hold only
+                plain JSON values and no padding, decimals, forced floats
+                or sort callable is set. Values in them are not counted as
+                visits, scalars, strings or floats.
+        wrapped: Number of arrays and objects laid out over several lines.
+        cache_hits: Number of subtrees answered by the SubtreeCache.
+        cache_misses: Number of subtrees formatted and added to the cache.
+        chars: Number of characters of JSON produced.
+        times: Seconds spent in each phase: "total", "sort", "escape",
+               "floats", "measure" and "flat". Phases nest, so for example
+               the time to format floats on a single line is also part of
+               "flat".
+
+    Example:
+        >>> stats = FormatStats()
+        >>> _ = neat_json({"b": [1.5, 2.5], "a": "x"}, sort=True, stats=stats)
+        >>> stats.sorts, stats.native, stats.floats, stats.chars
+        (1, 1, 2, 23)
+    """
+
+    _COUNTERS = (
+        "calls",
+        "visits",
+        "scalars",
+        "strings",
+        "floats",
+        "sorts",
+        "measures",
+        "overflows",
+        "flat",
+        "native",
+        "wrapped",
+        "cache_hits",
+        "cache_misses",
+        "chars",
+    )
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def __repr__(self) -> str:
+        counters = ", ".join(f"{name}={getattr(self, name)}" for name in self._COUNTERS)
+        return f"FormatStats({counters})"
+
+    def reset(self) -> None:
+        """Set every counter and timing back to zero."""
+        for name in self._COUNTERS:
+            setattr(self, name, 0)
+        self.times: dict[str, float] = dict.fromkeys(("total", "sort", "escape", "floats", "measure", "flat"), 0.0)
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the counters and timings as a dictionary, for logging."""
+        result: dict[str, Any] = {name: getattr(self, name) for name in self._COUNTERS}
+        result["times"] = dict(self.times)
+        return result
+
+    def _instrument(self, encoder: NeatEncoder) -> None:
+        """
+        Replace the methods of one encoder with versions that update these stats.
+
+        The replacements are set on the instance, so other encoders, and
+        this one when created without stats, run the plain methods.
+        """
+        perf_counter = time.perf_counter
+        times = self.times
+        cls = type(encoder)
+
+        def timed(method: Callable[..., Any], phase: str) -> Callable[..., Any]:
+            # Only the outermost of nested (recursive) calls is timed
+            depth = 0
+
+            def call(*args: Any) -> Any:
+                nonlocal depth
+                if depth:
+                    return method(*args)
+                depth += 1
+                start = perf_counter()
+                try:
+                    return method(*args)
+                finally:
+                    times[phase] += perf_counter() - start
+                    depth -= 1
+
+            return call
+
+        encode = cls.encode.__get__(encoder)
+        iterencode = cls.iterencode.__get__(encoder)
+
+        def instrumented_encode(value: Any) -> str:
+            self.calls += 1
+            start = perf_counter()
+            text = encode(value)
+            times["total"] += perf_counter() - start
+            self.chars += len(text)
+            return text
+
+        def count_chunks(chunks: Iterator[str]) -> Iterator[str]:
+            self.calls += 1
+            while True:
+                start = perf_counter()
+                chunk = next(chunks, None)
+                times["total"] += perf_counter() - start
+                if chunk is None:
+                    return
+                self.chars += len(chunk)
+                yield chunk
+
+        def instrumented_iterencode(value: Any) -> Iterator[str]:
+            return count_chunks(iterencode(value))
+
+        reformat = cls._reformat.__get__(encoder)
+
+        def instrumented_reformat(reader: _JSONReader) -> Iterator[str]:
+            return count_chunks(reformat(reader))
+
+        encode_into = cls.encode_into.__get__(encoder)
+
+        def instrumented_encode_into(value: Any, buffer: bytearray | io.BytesIO) -> memoryview:
+            self.calls += 1
+            start = perf_counter()
+            view = encode_into(value, buffer)
+            times["total"] += perf_counter() - start
+            # Only the bytes written are known here, so the characters are
+            # counted from those
+            self.chars += len(str(view, "utf-8"))
+            return view
+
+        resolve = cls._resolve.__get__(encoder)
+
+        def instrumented_resolve(obj: Any, state: _EncodeState) -> Any:
+            self.visits += 1
+            return resolve(obj, state)
+
+        scalar = cls._scalar.__get__(encoder)
+        escape = timed(scalar, "escape")
+
+        def instrumented_scalar(obj: Any, floats_forced: bool) -> str:
+            self.scalars += 1
+            if isinstance(obj, str):
+                self.strings += 1
+                return cast(str, escape(obj, floats_forced))
+            return scalar(obj, floats_forced)
+
+        float_ = timed(cls._float.__get__(encoder), "floats")
+
+        def instrumented_float(obj: float, floats_forced: bool) -> str:
+            self.floats += 1
+            return cast(str, float_(obj, floats_forced))
+
+        floats = timed(cls._floats.__get__(encoder), "floats")
+
+        def instrumented_floats(values: list[float] | tuple[float, ...], floats_forced: bool) -> list[str]:
+            self.floats += len(values)
+            return cast(list[str], floats(values, floats_forced))
+
+        keys = timed(cls._keys.__get__(encoder), "sort")
+
+        def instrumented_keys(obj: dict[Any, Any]) -> list[Any]:
+            if encoder.sort:
+                self.sorts += 1
+            return cast(list[Any], keys(obj))
+
+        width = timed(cls._width.__get__(encoder), "measure")
+        measuring = False
+
+        def instrumented_width(obj: Any, floats_forced: bool, budget: int, state: _EncodeState) -> int:
+            nonlocal measuring
+            if measuring:
+                return cast(int, width(obj, floats_forced, budget, state))
+            measuring = True
+            try:
+                result = cast(int, width(obj, floats_forced, budget, state))
+            finally:
+                measuring = False
+            self.measures += 1
+            if result > budget:
+                self.overflows += 1
+            return result
+
+        flat = timed(cls._flat.__get__(encoder), "flat")
+        flattening = False
+
+        def instrumented_flat(obj: Any, floats_forced: bool, state: _EncodeState) -> str:
+            nonlocal flattening
+            if flattening:
+                return cast(str, flat(obj, floats_forced, state))
+            flattening = True
+            try:
+                text = cast(str, flat(obj, floats_forced, state))
+            finally:
+                flattening = False
+            if text[:1] in ("[", "{"):
+                self.flat += 1
+            return text
+
+        native_text = cls._native_text.__get__(encoder)
+
+        def instrumented_native_text(obj: dict[Any, Any] | list[Any] | tuple[Any, ...]) -> str | None:
+            text = native_text(obj)
+            if text is not None:
+                self.native += 1
+            return text
+
+        emit_array = cls._emit_array.__get__(encoder)
+        emit_object = cls._emit_object.__get__(encoder)
+
+        def instrumented_emit_array(*args: Any) -> Iterator[str]:
+            self.wrapped += 1
+            return cast(Iterator[str], emit_array(*args))
+
+        def instrumented_emit_object(*args: Any) -> Iterator[str]:
+            self.wrapped += 1
+            return cast(Iterator[str], emit_object(*args))
+
+        encoder.encode = instrumented_encode  # type: ignore[method-assign]
+        encoder.iterencode = instrumented_iterencode  # type: ignore[method-assign]
+        encoder.encode_into = instrumented_encode_into  # type: ignore[method-assign]
+        encoder._reformat = instrumented_reformat  # type: ignore[method-assign]
+        encoder._resolve = instrumented_resolve  # type: ignore[method-assign]
+        encoder._scalar = instrumented_scalar  # type: ignore[method-assign]
+        encoder._float = instrumented_float  # type: ignore[method-assign]
+        encoder._floats = instrumented_floats  # type: ignore[method-assign]
+        encoder._keys = instrumented_keys  # type: ignore[method-assign]
+        encoder._width = instrumented_width  # type: ignore[method-assign]
+        encoder._flat = instrumented_flat  # type: ignore[method-assign]
+        encoder._native_text = instrumented_native_text  # type: ignore[method-assign]
+        encoder._emit_array = instrumented_emit_array  # type: ignore[method-assign]
+        encoder._emit_object = instrumented_emit_object  # type: ignore[method-assign]
+
+        if encoder.cache is not None:
+            encoder.cache = _CacheProbe(encoder.cache, self)  # type: ignore[assignment]
+
+
+class _CacheProbe:
+    """Stands in for an encoder's SubtreeCache to count its hits and misses in a FormatStats."""
+
+    def __init__(self, cache: SubtreeCache, stats: FormatStats) -> None:
+        self.cache = cache
+        self.stats = stats
+
+    @property
+    def max_chars(self) -> int:
+        return self.cache.max_chars
+
+    def _lookup(self, key: Hashable) -> str | None:
+        text = self.cache._lookup(key)
+        if text is None:
+            self.stats.cache_misses += 1
+        else:
+            self.stats.cache_hits += 1
+        return text
+
+    def _store(self, key: Hashable, text: str) -> None:
+        self.cache._store(key, text)
+
+
+class _RawNumber:
+    """A number read by neat_reformat, which remembers the text it was written with."""
+
+    text: str
+
+
+class _RawInt(_RawNumber, int):
+    pass
+
+
+class _RawFloat(_RawNumber, float):
+    pass
+
+
+def _raw_number(text: str) -> _RawNumber:
+    """Return the number for the text of a JSON number, remembering the text."""
+    number: _RawNumber = _RawFloat(text) if "." in text or "e" in text or "E" in text else _RawInt(text)
+    number.text = text
+    return number
+
+
+@functools.cache
+def _reader_patterns() -> tuple[re.Pattern[str], re.Pattern[str]]:
+    """Compile the patterns for JSON numbers and whitespace, when a reader first needs them."""
+    import re
+
+    # The C scanstring imports json.decoder to raise its errors, which fails
+    # while it is raising one, so make sure that has been done already
+    import json.decoder  # noqa: F401
+
+    return (re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?"), re.compile(r"[ \t\n\r]*"))
+
+
+# The words standing for scalars other than numbers (including the
+# non-standard NaN and infinities that the json module reads and writes)
+_WORDS = {
+    "t": ("true", True),
+    "f": ("false", False),
+    "n": ("null", None),
+    "N": ("NaN", float("nan")),
+    "I": ("Infinity", float("inf")),
+    "-": ("-Infinity", float("-inf")),
+}
+
+# Returned by NeatEncoder._reformat_fits for values too wide for one line
+_TOO_WIDE = object()
+
+
+class _JSONReader:
+    """
+    Splits the JSON read incrementally from a file object into tokens.
+
+    Tokens are (kind, value, offset) tuples, where kind is one of "[]{},:",
+    "s" for strings, "n" for numbers, "v" for true, false, null, NaN and the
+    infinities, or "" at the end of the input. Tokens can be looked ahead at
+    with peek before they are read with next.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, fp: IO[str] | IO[bytes]) -> None:
+        self._fp = fp
+        self._number, self._whitespace = _reader_patterns()
+        self._decoder: codecs.IncrementalDecoder | None = None
+        self._text = ""
+        self._pos = 0
+        self._offset = 0  # Characters read and dropped from the front of _text
+        self._eof = False
+        self._tokens: list[tuple[str, Any, int]] = []
+        self._head = 0
+
+    def peek(self, i: int = 0) -> tuple[str, Any, int]:
+        """Return the token i tokens after the next one, without reading it."""
+        tokens = self._tokens
+        while len(tokens) <= self._head + i:
+            tokens.append(self._scan())
+        return tokens[self._head + i]
+
+    def next(self) -> tuple[str, Any, int]:
+        """Read the next token."""
+        tokens = self._tokens
+        if self._head < len(tokens):
+            token = tokens[self._head]
+            self._head += 1
+            if self._head == len(tokens):
+                tokens.clear()
+                self._head = 0
+            return token
+        return self._scan()
+
+    def key(self) -> str:
+        """Read an object key and the colon after it."""
+        kind, key, offset = self.next()
+        if kind != "s":
+            raise self._error("Expecting property name enclosed in double quotes", offset)
+        kind, _, offset = self.next()
+        if kind != ":":
+            raise self._error("Expecting ':' delimiter", offset)
+        return cast(str, key)
+
+    def close(self, closer: str) -> bool:
+        """Read the comma after a member of an array or object, returning True if the closing bracket is read instead."""
+        kind, _, offset = self.next()
+        if kind == ",":
+            return False
+        if kind == closer:
+            return True
+        raise self._error("Expecting ',' delimiter", offset)
+
+    def value(self) -> Any:
+        """Read the next value in full, with numbers as _RawNumber."""
+        # Arrays and objects are built with an explicit stack of those still
+        # open, each with the key its next value goes under (None for arrays)
+        stack: list[tuple[Any, str | None]] = []
+        while True:
+            kind, value, offset = self.next()
+            if kind == "[":
+                if self.peek()[0] == "]":
+                    self.next()
+                    value = []
+                else:
+                    stack.append(([], None))
+                    continue
+            elif kind == "{":
+                if self.peek()[0] == "}":
+                    self.next()
+                    value = {}
+                else:
+                    stack.append(({}, self.key()))
+                    continue
+            elif kind not in ("s", "n", "v"):
+                raise self._error("Expecting value", offset)
+
+            # Add the value to the innermost container, closing those that end
+            while stack:
+                container, key = stack[-1]
+                if key is None:
+                    container.append(value)
+                else:
+                    container[key] = value
+                if not self.close("]" if key is None else "}"):
+                    if key is not None:
+                        stack[-1] = (container, self.key())
+                    break
+                stack.pop()
+                value = container
+            else:
+                return value
+
+    def end(self) -> None:
+        """Check that nothing but whitespace follows the value read."""
+        if self._head < len(self._tokens):
+            raise self._error("Extra data", self._tokens[self._head][2])
+        while True:
+            pos = self._whitespace.match(self._text, self._pos).end()
+            self._pos = pos
+            if pos < len(self._text):
+                raise self._error("Extra data", self._offset + pos)
+            if not self._fill():
+                return
+
+    def _error(self, message: str, offset: int) -> ValueError:
+        return ValueError(f"{message} (char {offset})")
+
+    def _scan(self) -> tuple[str, Any, int]:
+        """Read the next token from the input."""
+        while True:
+            text = self._text
+            pos = self._whitespace.match(text, self._pos).end()
+            self._pos = pos
+            offset = self._offset + pos
+            if pos == len(text):
+                if self._fill():
+                    continue
+                return ("", None, offset)
+
+            char = text[pos]
+            if char in "[]{},:":
+                self._pos = pos + 1
+                return (char, None, offset)
+
+            if char == '"':
+                try:
+                    value, end = scanstring(text, pos + 1, True)
+                except ValueError as e:
+                    # The string may only be cut short by the end of what was
+                    # read. scanstring raises a json.JSONDecodeError.
+                    if self._fill():
+                        continue
+                    error = cast("json.JSONDecodeError", e)
+                    raise self._error(error.msg, self._offset + error.pos) from None
+                self._pos = end
+                return ("s", value, offset)
+
+            match = self._number.match(text, pos)
+            if match:
+                # A number may continue in what is read next, after as many as
+                # two more characters that do not match yet (as in "1e-")
+                if len(text) - match.end() < 3 and self._fill():
+                    continue
+                self._pos = match.end()
+                return ("n", _raw_number(match.group()), offset)
+            word, word_value = _WORDS.get(char, ("", None))
+            if word and text.startswith(word, pos):
+                self._pos = pos + len(word)
+                return ("v", word_value, offset)
+            if len(text) - pos < len("-Infinity") and self._fill():
+                continue
+            raise self._error("Expecting value", offset)
+
+    def _fill(self) -> bool:
+        """Read more of the input after what is left unscanned, returning False at the end."""
+        if self._eof:
+            return False
+        # Read at least as much as is left, so that long tokens are rescanned
+        # only a few times
+        size = max(self.CHUNK_SIZE, len(self._text) - self._pos)
+        while True:
+            data = self._fp.read(size)
+            if not isinstance(data, bytes):
+                chunk = data
+                break
+            if self._decoder is None:
+                self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+            chunk = self._decoder.decode(data, final=not data)
+            # Bytes read may only start a character
+            if chunk or not data:
+                break
+        if not chunk:
+            self._eof = True
+            return False
+        self._offset += self._pos
+        self._text = self._text[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+
+class NeatEncoder:
+    """
+    A reusable formatter for a fixed set of `neat_json` options.
+
+    The option cascades, separators and sort strategy are resolved once when
+    the encoder is created, so encoding many small values with the same
+    options is cheaper than calling `neat_json` for each of them. Encoders
+    hold no per-call state and may be shared between threads.
+
+    Example:
+        >>> encoder = NeatEncoder(wrap=40, sort=True)
+        >>> encoder.encode({"b": 1, "a": 2})
+        '{"a":2,"b":1}'
+    """
+
+    def __init__(
+        self,
+        *,
+        wrap: int | bool = 80,
+        indent: str = "  ",
+        indent_last: bool = False,
+        short: bool = False,
+        sort: bool | Callable[..., Any] = False,
+        sorted: bool | Callable[..., Any] | None = None,  # noqa: A002 - alias for sort
+        sort_cache: int = 256,
+        aligned: bool = False,
+        table: bool = False,
+        decimals: int | None = None,
+        trim_trailing_zeros: bool = False,
+        force_floats: bool = False,
+        force_floats_in: list[str] | None = None,
+        ensure_ascii: bool = True,
+        padding: int = 0,
+        array_padding: int | None = None,
+        object_padding: int | None = None,
+        around_comma: int = 0,
+        before_comma: int | None = None,
+        after_comma: int | None = None,
+        around_colon: int = 0,
+        before_colon: int | None = None,
+        after_colon: int | None = None,
+        around_colon_1: int | None = None,
+        before_colon_1: int | None = None,
+        after_colon_1: int | None = None,
+        around_colon_n: int | None = None,
+        before_colon_n: int | None = None,
+        after_colon_n: int | None = None,
+        cache: SubtreeCache | None = None,
+        stats: FormatStats | None = None,
+    ) -> None:
+        """Create an encoder; the options are the same as for `neat_json`."""
+        # Handle wrap special values
+        self.wrap_width: int | None
+        if wrap is True:
+            self.wrap_width = -1  # Always wrap
+        elif wrap is False:
+            self.wrap_width = None  # Never wrap
+        else:
+            self.wrap_width = wrap
+
+        # Resolve option cascades
+        _array_padding = array_padding if array_padding is not None else padding
+        _object_padding = object_padding if object_padding is not None else padding
+        _before_comma = before_comma if before_comma is not None else around_comma
+        _after_comma = after_comma if after_comma is not None else around_comma
+        _before_colon = before_colon if before_colon is not None else around_colon
+        _after_colon = after_colon if after_colon is not None else around_colon
+        _before_colon_1 = (
+            before_colon_1
+            if before_colon_1 is not None
+            else (around_colon_1 if around_colon_1 is not None else _before_colon)
+        )
+        _after_colon_1 = (
+            after_colon_1
+            if after_colon_1 is not None
+            else (around_colon_1 if around_colon_1 is not None else _after_colon)
+        )
+        _before_colon_n = (
+            before_colon_n
+            if before_colon_n is not None
+            else (around_colon_n if around_colon_n is not None else _before_colon)
+        )
+        _after_colon_n = (
+            after_colon_n
+            if after_colon_n is not None
+            else (around_colon_n if around_colon_n is not None else _after_colon)
+        )
+
+        self.indent = indent
+        self.indent_last = indent_last
+        self.short = short
+        self.aligned = aligned
+        self.table = table
+        self.decimals = decimals
+        self.trim_trailing_zeros = trim_trailing_zeros
+        self.force_floats = force_floats
+
+        # Normalize force_floats_in to an empty set if None
+        self.force_floats_in: frozenset[str] = frozenset(force_floats_in or ())
+
+        # Strings are escaped by the json module's C accelerated functions
+        # directly, skipping the setup json.dumps does for every call
+        self.ensure_ascii = ensure_ascii
+        self._escape: Callable[[str], str] = encode_basestring_ascii if ensure_ascii else encode_basestring
+
+        # Pre-compute formatting strings
+        self.apad = " " * _array_padding
+        self.opad = " " * _object_padding
+        self.comma = f"{' ' * _before_comma},{' ' * _after_comma}"
+        self.colon1 = f"{' ' * _before_colon_1}:{' ' * _after_colon_1}"
+        self.colonn = f"{' ' * _before_colon_n}:{' ' * _after_colon_n}"
+        # The width of the brackets and padding of a non-empty array or
+        # object, less one comma, which _width counts before every member
+        self._array_overhead = 2 + 2 * len(self.apad) - len(self.comma)
+        self._object_overhead = 2 + 2 * len(self.opad) - len(self.comma)
+
+        # Handle sort/sorted alias, and determine the arity of a sort function
+        # (how many of key, value and object it receives) once up front
+        self.sort: bool | Callable[..., Any] = sorted if sorted is not None else sort
+        self._sort_fn: Callable[..., Any] | None = None
+        self._sort_arity = 1
+        if self.sort is not True and callable(self.sort):
+            self._sort_fn = self.sort
+            import inspect
+
+            try:
+                sig = inspect.signature(self.sort)
+                # Count params that could accept positional arguments
+                self._sort_arity = len(
+                    [
+                        p
+                        for p in sig.parameters.values()
+                        if p.kind
+                        in (
+                            inspect.Parameter.POSITIONAL_ONLY,
+                            inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                        )
+                    ]
+                )
+            except (ValueError, TypeError):
+                pass
+
+        # Layouts of objects with string keys, keyed by their keys in insertion
+        # order; not kept when the order of keys depends on their values
+        self.sort_cache = sort_cache
+        self._shapes: dict[tuple[Any, ...], _Shape] | None = None
+        if sort_cache > 0 and (self._sort_fn is None or self._sort_arity < 2):
+            self._shapes = {}
+
+        # Formatted subtrees depend on every option, so they are all part of
+        # the key for a (possibly shared) cache
+        self.cache = cache
+        self._options_key = (
+            self.wrap_width,
+            self.indent,
+            self.indent_last,
+            self.short,
+            self.aligned,
+            self.table,
+            self.decimals,
+            self.trim_trailing_zeros,
+            self.force_floats,
+            self.force_floats_in,
+            self.ensure_ascii,
+            self.apad,
+            self.opad,
+            self.comma,
+            self.colon1,
+            self.colonn,
+            self.sort,
+        )
+
+        # Single-line arrays and objects of plain values are written by json's
+        # C encoder, unless an option it cannot reproduce is set
+        self._native_key: tuple[bool, str, str, bool] | None = None
+        if (
+            c_make_encoder is not None
+            and not (self.apad or self.opad or self.force_floats or self.force_floats_in)
+            and self.decimals is None
+            and self._sort_fn is None
+        ):
+            self._native_key = (self.ensure_ascii, self.colon1, self.comma, self.sort is True)
+
+        # Small arrays and objects are written on one line before it is known
+        # whether they fit, unless stats are collected (which count
+        # measuring them) or layouts are cached
+        self._small_first = stats is None and cache is None
+
+        self.stats = stats
+        if stats is not None:
+            stats._instrument(self)
+
+    def encode(self, value: Any) -> str:
+        """Return the formatted JSON string for a value."""
+        state = _EncodeState()
+        if self.wrap_width is None:
+            return self._flat(value, self.force_floats, state)
+        if self._small_first and type(value) in (dict, list) and 0 < len(value) < _NATIVE_MIN_SIZE:
+            # Small values are written straight away, which costs less than
+            # measuring them first
+            text = self._small_flat(value, self.force_floats, state, [_SMALL_SIZE])
+            if text is not None:
+                if len(text) <= self.wrap_width:
+                    return text
+                state.flat[(id(value), self.force_floats)] = text
+        layout = self._emit(value, "", "", self.force_floats, state)
+        return layout if isinstance(layout, str) else "".join(self._walk(layout))
+
+    def iterencode(self, value: Any) -> Iterator[str]:
+        """
+        Yield the formatted JSON for a value as a sequence of string chunks.
+
+        Unwrapped output is split between array elements and object members,
+        and wrapped output is yielded as soon as the layout of each line is
+        known.
+        """
+        state = _EncodeState()
+        if self.wrap_width is None:
+            return self._walk(self._flat_chunks(value, self.force_floats, state))
+        return self._walk(self._emit(value, "", "", self.force_floats, state))
+
+    def encode_into(self, value: Any, buffer: bytearray | io.BytesIO) -> memoryview:
+        """Write the formatted JSON for a value into a buffer as UTF-8, like `neat_dump_into`."""
+        state = _EncodeState()
+        chunks: Iterable[str]
+        if self.wrap_width is None:
+            # Single-line output is built fastest as one string, by json's C
+            # encoder where it can be, and then encoded a piece at a time
+            text = self._flat(value, self.force_floats, state)
+            chunks = (text[i : i + _ENCODE_CHUNK_SIZE] for i in range(0, len(text), _ENCODE_CHUNK_SIZE))
+        else:
+            layout = self._emit(value, "", "", self.force_floats, state)
+            chunks = _gather_chunks(self._walk(layout), _ENCODE_CHUNK_SIZE)
+
+        if isinstance(buffer, io.BytesIO):
+            buffer.seek(0)
+            write = buffer.write
+            for chunk in chunks:
+                write(chunk.encode("utf-8"))
+            buffer.truncate()
+            return buffer.getbuffer()
+
+        # Overwrite the bytes already in the bytearray, growing it only once
+        # they run out
+        size = 0
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            end = size + len(data)
+            buffer[size:end] = data
+            size = end
+        del buffer[size:]
+        return memoryview(buffer)
+
+    def reformat(self, fp_in: IO[str] | IO[bytes], fp_out: IO[str] | IO[bytes]) -> None:
+        """Reformat the JSON read from one file object, writing it to another, like `neat_reformat`."""
+        _write_chunks(self._reformat(_JSONReader(fp_in)), fp_out)
+
+    async def aiterencode(self, value: Any, interval: float = 0.01, chunk_size: int = 65536) -> AsyncIterator[str]:
+        """
+        Yield the formatted JSON for a value in chunks, letting other tasks run as it goes.
+
+        The chunks of iterencode() are gathered into chunks of about
+        chunk_size characters, and control is handed back to the event loop
+        at least every interval seconds.
+        """
+        import asyncio
+
+        perf_counter = time.perf_counter
+        pending: list[str] = []
+        size = 0
+        deadline = perf_counter() + interval
+        for chunk in self.iterencode(value):
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield "".join(pending)
+                pending.clear()
+                size = 0
+            # Yielding a chunk only returns to the consumer, which may not
+            # await anything before asking for the next one
+            if perf_counter() >= deadline:
+                await asyncio.sleep(0)
+                deadline = perf_counter() + interval
+        if pending:
+            yield "".join(pending)
+
+    def _reformat(self, reader: _JSONReader) -> Iterator[str]:
+        """Yield the formatted JSON for the document read, in chunks, then check that nothing follows it."""
+        state = _EncodeState()
+        if self.wrap_width is None:
+            yield from self._walk(self._reformat_flat(reader, self.force_floats, state))
+        else:
+            yield from self._walk(self._reformat_value(reader, "", "", self.force_floats, state))
+        reader.end()
+
+    def _encode_parallel(self, value: Any, workers: int, chunksize: int | None) -> str:
+        """Format a value like encode(), splitting its top-level members over worker processes."""
+        state = _EncodeState()
+        obj = self._resolve(value, state)
+        if not obj or not isinstance(obj, (dict, list, tuple, set, frozenset)):
+            return self.encode(obj)
+
+        wrap_width = self.wrap_width
+        if wrap_width is not None and self._width(obj, self.force_floats, wrap_width, state) <= wrap_width:
+            return self._flat(obj, self.force_floats, state)
+        if self.table and wrap_width is not None and not isinstance(obj, dict):
+            # The rows of a table are padded to line up with each other
+            return self.encode(obj)
+
+        # Describe each top-level member as a part that a worker can format on
+        # its own, then surround the results as _flat or _emit would
+        parts: list[tuple[Any, ...]]
+        if wrap_width is None:
+            if isinstance(obj, dict):
+                shape = self._shape(obj)
+                parts = [(obj[k], key_floats_forced) for k, key_floats_forced in zip(shape.keys, shape.floats_forced)]
+                texts = self._format_parts_parallel("flat", "", parts, workers, chunksize)
+                keyvals = self.comma.join(f"{name}{self.colon1}{text}" for name, text in zip(shape.names, texts))
+                return f"{{{self.opad}{keyvals}{self.opad}}}"
+
+            parts = [(v, self.force_floats) for v in obj]
+            texts = self._format_parts_parallel("flat", "", parts, workers, chunksize)
+            return f"[{self.apad}{self.comma.join(texts)}{self.apad}]"
+
+        if isinstance(obj, dict):
+            members = self._object_members(obj, "", "", state)
+            parts = [(v, k_str, key_floats_forced) for v, k_str, key_floats_forced, _ in members]
+            texts = self._format_parts_parallel("member", "", parts, workers, chunksize)
+            body = "".join(f"{start}{text}" for (_, _, _, start), text in zip(members, texts))
+            if self.short:
+                return f"{body}{self.opad}}}"
+            close_ind = self.indent if self.indent_last else ""
+            return f"{body}\n{close_ind}}}"
+
+        apad = self.apad
+        indent2 = f" {apad}" if self.short else self.indent
+        parts = [(v, self.force_floats) for v in obj]
+        texts = self._format_parts_parallel("item", indent2, parts, workers, chunksize)
+        body = f",\n{indent2}".join(texts)
+        if self.short:
+            return f"[{apad}{body}{apad}]"
+        close_ind = indent2 if self.indent_last else ""
+        return f"[\n{indent2}{body}\n{close_ind}]"
+
+    def _format_parts_parallel(
+        self, kind: str, ind: str, parts: list[tuple[Any, ...]], workers: int, chunksize: int | None
+    ) -> list[str]:
+        """Format the parts of a document in worker processes, returning the texts in order."""
+        import concurrent.futures
+
+        chunksize = chunksize or max(1, -(-len(parts) // (4 * workers)))
+        with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker_parts, initargs=(self, kind, ind, parts)
+        ) as executor:
+            futures = [
+                executor.submit(_format_parts_in_worker, start, min(start + chunksize, len(parts)))
+                for start in range(0, len(parts), chunksize)
+            ]
+            return [text for future in futures for text in future.result()]
+
+    def _format_part(self, kind: str, ind: str, part: tuple[Any, ...], state: _EncodeState) -> str:
+        """
+        Format one top-level member of a document for _encode_parallel.
+
+        A "flat" part is (value, floats forced), formatted on one line. An
+        "item" part is the same, formatted as an element of a wrapped array
+        with indentation ind. A "member" part is (value, key text, floats
+        forced), formatted as the value of a member of a wrapped object.
+        """
+        if kind == "flat":
+            value, floats_forced = part
+            return self._flat(value, floats_forced, state)
+        if kind == "item":
+            value, floats_forced = part
+            return "".join(self._walk(self._emit(value, ind, "", floats_forced, state)))
+        value, k_str, floats_forced = part
+        return "".join(self._walk(self._emit_member(value, k_str, floats_forced, ind, "", state)))
+
+    def _cache_key(
+        self,
+        obj: dict[Any, Any] | list[Any] | tuple[Any, ...] | set[Any] | frozenset[Any],
+        ind: str | None,
+        floats_forced: bool,
+        state: _EncodeState,
+    ) -> Hashable | None:
+        """
+        Return the key for the formatting of a resolved array or object in the cache.
+
+        ind is the indentation for wrapped output, or None for single-line output.
+        Returns None if the value cannot be cached.
+        """
+        content_key = self._content_key(obj, state)
+        if content_key is None:
+            return None
+        return (self._options_key, ind, floats_forced, content_key)
+
+    def _content_key(self, obj: Any, state: _EncodeState) -> _ContentKey | None:
+        """
+        Return a key equal for all resolved arrays or objects with the same content.
+
+        Scalars are keyed on their type as well as their value, since 1, 1.0
+        and True compare equal but are written differently. Returns None if
+        the value contains anything other than plain JSON-compatible types.
+        """
+        content_keys = state.content_keys
+        if id(obj) in content_keys:
+            return content_keys[id(obj)]
+
+        # Keys are built bottom-up with an explicit stack of the arrays and
+        # objects whose content is being added, each with its members and the
+        # parts of its key so far
+        stack = [(obj, self._content_members(obj), [dict if isinstance(obj, dict) else list])]
+        on_stack = {id(obj)}
+        while stack:
+            container, members, parts = stack[-1]
+            for key_parts, value in members:
+                parts.extend(key_parts)
+                value = self._resolve(value, state)
+                cls = type(value)
+                if cls is str or cls is int or cls is bool or value is None:
+                    parts.append(cls)
+                    parts.append(value)
+                elif cls is float:
+                    # -0.0 and 0.0 are equal but written differently
+                    parts.append(cls)
+                    parts.append(value if value else repr(value))
+                elif isinstance(value, (dict, list, tuple, set, frozenset)):
+                    if id(value) not in content_keys:
+                        if id(value) in on_stack:
+                            raise _circular_reference()
+                        on_stack.add(id(value))
+                        stack.append(
+                            (value, self._content_members(value), [dict if isinstance(value, dict) else list])
+                        )
+                        break
+                    if content_keys[id(value)] is None:
+                        break
+                    parts.append(content_keys[id(value)])
+                else:
+                    break
+            else:
+                stack.pop()
+                on_stack.discard(id(container))
+                content_keys[id(container)] = key = _ContentKey(tuple(parts))
+                if not stack:
+                    return key
+                stack[-1][2].append(key)
+                continue
+
+            if stack[-1][0] is container:
+                # A member that cannot be keyed makes every enclosing array
+                # and object impossible to key too
+                for container, _, _ in stack:
+                    content_keys[id(container)] = None
+                return None
+        return None  # pragma: no cover - the loop always returns
+
+    @staticmethod
+    def _content_members(obj: Any) -> Iterator[tuple[tuple[Any, ...], Any]]:
+        """Yield the parts of the content key for each key of an object, with the value, or () and each value of an array."""
+        if isinstance(obj, dict):
+            # Keys -0.0 and 0.0 are equal but written differently
+            return (((type(k), repr(k) if type(k) is float else k), v) for k, v in obj.items())
+        return (((), v) for v in obj)
+
+    def _resolve(self, obj: Any, state: _EncodeState) -> Any:
+        """Return the plain value that is serialized in place of an object."""
+        cls = type(obj)
+        convert = _type_dispatch.get(cls) or _classify(cls)
+        if convert is _as_is:
+            return obj
+        if convert is float:
+            return float(obj)
+
+        key = id(obj)
+        if key in state.resolved:
+            return state.resolved[key][1]
+
+        if convert is _Stream and self.cache is not None:
+            # Cached layouts are found by the content and id() of arrays and
+            # objects, so every item must be read and kept for the whole call
+            convert = list
+        result = convert(obj)
+        result_cls = type(result)
+        if (_type_dispatch.get(result_cls) or _classify(result_cls)) is not convert:
+            result = self._resolve(result, state)
+        else:
+            # A converter is not applied again to what it returned (as one
+            # rounding floats would be, forever); that is resolved as it
+            # would be with no converter registered
+            convert = _builtin_conversion(result_cls)
+            if convert is float:
+                result = float(result)
+            elif convert is not _as_is:
+                result = self._resolve(convert(result), state)
+        if type(result) is not _Fields or result.source is not obj or self.cache is not None:
+            # The fields of an object are read again each time it is reached
+            # rather than kept for the whole call, unless layouts are cached
+            # (as for streams above)
+            state.resolved[key] = (obj, result)
+        return result
+
+    def _scalar(self, obj: Any, floats_forced: bool) -> str:
+        """Build the JSON string for a resolved value that is not an array or object."""
+        match obj:
+            case str():
+                return self._escape(obj)
+
+            case _RawNumber() if self.decimals is None and (not floats_forced or isinstance(obj, float)):
+                # Numbers read by neat_reformat keep the text they were written with
+                return obj.text
+
+            case bool():
+                # Must come before int check since bool is subclass of int
+                return str(obj).lower()
+
+            case int():
+                if floats_forced:
+                    return self._float(float(obj), floats_forced)
+                return f"{obj}"
+
+            case float():
+                return self._float(obj, floats_forced)
+
+            case None:
+                return "null"
+
+            case _:
+                # Fall back to json.dumps for other types
+                import json
+
+                return json.dumps(obj, ensure_ascii=self.ensure_ascii)
+
+    def _float(self, obj: float, floats_forced: bool) -> str:
+        """Build the JSON string for a float."""
+        r = repr(obj)
+
+        # Handle infinity and NaN ("inf", "-inf" and "nan")
+        if r[-1] in "fn":
+            if r == "nan":
+                return '"NaN"'
+            return "-9e9999" if r[0] == "-" else "9e9999"
+
+        # Write floats equivalent to integers as integers (unless forced);
+        # repr only ends in ".0" for those, and only when not in e-notation
+        if not floats_forced and r.endswith(".0"):
+            return "0" if r == "-0.0" else r[:-2]
+
+        decimals = self.decimals
+        if decimals is not None:
+            if self.trim_trailing_zeros:
+                return repr(round(obj, decimals))
+            else:
+                return f"{obj:.{decimals}f}"
+        else:
+            return r
+
+    def _floats(self, values: list[float] | tuple[float, ...], floats_forced: bool) -> list[str]:
+        """Build the JSON strings for a list of floats, as _float would for each."""
+        # Only reprs ending in "0", "f" or "n" can be integral, infinite or NaN
+        pairs = zip(values, map(repr, values))
+        decimals = self.decimals
+        if decimals is None:
+            return [r if r[-1] not in "0fn" else self._float(v, floats_forced) for v, r in pairs]
+        if self.trim_trailing_zeros:
+            return [repr(round(v, decimals)) if r[-1] not in "0fn" else self._float(v, floats_forced) for v, r in pairs]
+        spec = f".{decimals}f"
+        return [format(v, spec) if r[-1] not in "0fn" else self._float(v, floats_forced) for v, r in pairs]
+
+    def _keys(self, obj: dict[Any, Any]) -> list[Any]:
+        """Return the keys of an object in output order."""
+        sort_fn = self._sort_fn
+        if sort_fn is not None:
+            if self._sort_arity >= 3:
+                return sorted(obj, key=lambda k: sort_fn(k, obj[k], obj))
+            if self._sort_arity >= 2:
+                return sorted(obj, key=lambda k: sort_fn(k, obj[k]))
+            return sorted(obj, key=sort_fn)
+
+        keys = list(obj)
+        if self.sort is True and len(keys) > 1:
+            if all(type(k) is str for k in keys):
+                # Strings sort as themselves, and dict keys never tie
+                keys.sort()
+            else:
+                keys.sort(key=str)
+        return keys
+
+    def _shape(self, obj: dict[Any, Any]) -> _Shape:
+        """
+        Return the layout of the keys of a non-empty object.
+
+        Objects with the same string keys in the same insertion order (such
+        as the records in an array) share one layout, unless the order of
+        keys depends on their values.
+        """
+        shapes = self._shapes
+        if shapes is None:
+            return self._new_shape(obj)
+        keys = tuple(obj)
+        shape = shapes.get(keys)
+        if shape is None:
+            shape = self._new_shape(obj)
+            # Keys of other types may compare equal while being written differently
+            if all(type(k) is str for k in keys):
+                if len(shapes) >= self.sort_cache:
+                    shapes.clear()
+                shapes[keys] = shape
+        return shape
+
+    def _new_shape(self, obj: dict[Any, Any]) -> _Shape:
+        """Lay out the keys of a non-empty object."""
+        keys = self._keys(obj)
+        strs = [str(k) for k in keys]
+        names = [self._escape(k) for k in strs]
+        floats_forced = [self.force_floats or k in self.force_floats_in for k in strs]
+        if self.aligned:
+            longest = max(len(name) for name in names)
+            aligned_names = [name.ljust(longest) for name in names]
+        else:
+            aligned_names = names
+        separators = len(self.comma) + len(self.colon1)
+        return _Shape(keys, names, floats_forced, aligned_names, [separators + len(name) for name in names])
+
+    def _width(self, obj: Any, floats_forced: bool, budget: int, state: _EncodeState) -> int:
+        """
+        Measure the single-line rendering of a value without building it.
+
+        Returns the exact length if it is at most budget; otherwise stops as
+        soon as the rendering is known to be wider and returns some larger
+        number.
+        """
+        resolve = self._resolve
+        scalar = self._scalar
+        markers = state.markers
+
+        # Nested arrays and objects are measured with an explicit stack of
+        # their members, each with the width of the text before it
+        stack: list[tuple[Iterator[tuple[int, Any, bool]], Any]] = []
+        total = 0
+        value = resolve(obj, state)
+        if state.flat and (text := state.flat.get((_marker(value), floats_forced))) is not None:
+            return len(text)
+        while True:
+            if isinstance(value, dict):
+                if value:
+                    marker = _marker(value)
+                    if marker in markers:
+                        raise _circular_reference()
+                    markers.add(marker)
+                    total += self._object_overhead
+                    if self._shapes is None:
+                        # Measuring does not need the (possibly costly) order of keys
+                        len_comma = len(self.comma)
+                        len_colon1 = len(self.colon1)
+                        force_floats = self.force_floats
+                        force_floats_in = self.force_floats_in
+                        members = (
+                            (len_comma + len(self._escape(str(k))) + len_colon1, v, force_floats or str(k) in force_floats_in)
+                            for k, v in value.items()
+                        )
+                    else:
+                        # Members are zipped rather than built in a generator
+                        # expression, which would see later values of value
+                        shape = self._shape(value)
+                        members = zip(shape.widths, map(value.__getitem__, shape.keys), shape.floats_forced)
+                    stack.append((members, value))
+                else:
+                    total += 2
+            elif isinstance(value, (list, tuple, set, frozenset, _Stream)):
+                if value:
+                    if id(value) in markers:
+                        raise _circular_reference()
+                    markers.add(id(value))
+                    total += self._array_overhead
+                    items = value.peek() if type(value) is _Stream else value
+                    stack.append((zip(itertools.repeat(len(self.comma)), items, itertools.repeat(floats_forced)), value))
+                else:
+                    total += 2
+            elif isinstance(value, str) and len(value) + 2 > budget - total:
+                # Escaping never makes a string shorter
+                total += len(value) + 2
+            else:
+                total += len(scalar(value, floats_forced))
+
+            # Measure the scalar members of the innermost container, stopping
+            # at the next nested container and closing the containers that
+            # are done
+            while stack and total <= budget:
+                for extra, value, floats_forced in stack[-1][0]:
+                    total += extra
+                    if total > budget:
+                        break
+                    value = resolve(value, state)
+                    if isinstance(value, (dict, list, tuple, set, frozenset, _Stream)):
+                        break
+                    if isinstance(value, str) and len(value) + 2 > budget - total:
+                        total += len(value) + 2
+                    else:
+                        total += len(scalar(value, floats_forced))
+                    if total > budget:
+                        break
+                else:
+                    markers.discard(_marker(stack.pop()[1]))
+                    continue
+                break
+            if total > budget or not stack:
+                for _, container in stack:
+                    markers.discard(_marker(container))
+                return total
+
+    def _flat(self, obj: Any, floats_forced: bool, state: _EncodeState) -> str:
+        """Build the single-line JSON string for a value."""
+        obj = self._resolve(obj, state)
+        if state.flat and (text := state.flat.get((_marker(obj), floats_forced))) is not None:
+            return text
+        if type(obj) is _Stream:
+            # All of the text is built at once anyway, and a list can go
+            # through json's C encoder
+            obj = obj.materialize()
+        if not isinstance(obj, (dict, list, tuple, set, frozenset)):
+            return self._scalar(obj, floats_forced)
+        if not obj:
+            return "{}" if isinstance(obj, dict) else "[]"
+        # Plain values are written by json's C encoder, as are the plain
+        # arrays and objects within those that are not. Those are only looked
+        # for once a larger array or object is reached, since finding them
+        # costs more than it saves in small values.
+        native = (
+            self._native_key is not None
+            and type(obj) in (dict, list, _Fields)
+            and _type_converters.keys().isdisjoint(_PLAIN_BASES)
+        )
+        if native and _is_plain(obj) and (text := self._native_text(obj)) is not None:
+            return text
+        plain: set[int] | None = None
+
+        resolve = self._resolve
+        scalar = self._scalar
+        cache = self.cache
+        markers = state.markers
+        apad = self.apad
+        opad = self.opad
+        comma = self.comma
+
+        # Nested arrays and objects are written with an explicit stack, each
+        # entry holding the members still to write (with the text before
+        # each), the closing text, the container, its cache key and the index
+        # in parts of its first text
+        parts: list[str] = []
+        stack: list[tuple[Iterator[tuple[str, Any, bool]], str, Any, Hashable | None, int]] = []
+        prefix = ""
+        value = obj
+        while True:
+            if isinstance(value, (dict, list, tuple, set, frozenset, _Stream)):
+                key = None
+                text = None
+                if native and type(value) in (dict, list, _Fields):
+                    if plain is None and len(value) >= _NATIVE_MIN_SIZE:
+                        plain = _plain_subtrees(obj)
+                    if plain and _marker(value) in plain:
+                        text = self._native_text(value)
+                if text is None and cache is not None and value:
+                    key = self._cache_key(value, None, floats_forced, state)
+                    text = cache._lookup(key) if key else None
+                if text is not None:
+                    parts.append(f"{prefix}{text}")
+                elif not value:
+                    parts.append(f"{prefix}{{}}" if isinstance(value, dict) else f"{prefix}[]")
+                elif not isinstance(value, dict) and _all_floats(value):
+                    text = f"[{apad}{comma.join(self._floats(value, floats_forced))}{apad}]"
+                    if key and len(text) <= cache.max_chars:  # type: ignore[union-attr]
+                        cache._store(key, text)  # type: ignore[union-attr]
+                    parts.append(f"{prefix}{text}")
+                else:
+                    marker = _marker(value)
+                    if marker in markers:
+                        raise _circular_reference()
+                    markers.add(marker)
+                    parts.append(prefix)
+                    start = len(parts)
+                    # Members are zipped rather than built in a generator
+                    # expression, which would see later values of value
+                    members: Iterator[tuple[str, Any, bool]]
+                    if isinstance(value, dict):
+                        parts.append(f"{{{opad}")
+                        shape = self._shape(value)
+                        starts = shape.flat_starts
+                        if starts is None:
+                            starts = shape.flat_starts = [f"{comma}{name}{self.colon1}" for name in shape.names]
+                            starts[0] = starts[0][len(comma) :]
+                        members = zip(starts, map(value.__getitem__, shape.keys), shape.floats_forced)
+                        stack.append((members, f"{opad}}}", value, key, start))
+                    else:
+                        parts.append(f"[{apad}")
+                        separators = itertools.chain(("",), itertools.repeat(comma))
+                        members = zip(separators, value, itertools.repeat(floats_forced))
+                        stack.append((members, f"{apad}]", value, key, start))
+            else:
+                parts.append(f"{prefix}{scalar(value, floats_forced)}")
+
+            # Write the scalar members of the innermost container, stopping at
+            # the next nested container and closing the containers that are
+            # done
+            while stack:
+                for prefix, value, floats_forced in stack[-1][0]:
+                    value = resolve(value, state)
+                    if isinstance(value, (dict, list, tuple, set, frozenset, _Stream)):
+                        break
+                    parts.append(f"{prefix}{scalar(value, floats_forced)}")
+                else:
+                    _, closing, container, key, start = stack.pop()
+                    parts.append(closing)
+                    markers.discard(_marker(container))
+                    if key and sum(map(len, parts[start:])) <= cache.max_chars:  # type: ignore[union-attr]
+                        text = "".join(parts[start:])
+                        del parts[start:]
+                        parts.append(text)
+                        cache._store(key, text)  # type: ignore[union-attr]
+                    elif key and stack:
+                        # The text enclosing text too long to cache is too
+                        # long as well
+                        stack[-1] = (*stack[-1][:3], None, stack[-1][4])
+                    continue
+                break
+            else:
+                return "".join(parts)
+
+    def _small_flat(
+        self, obj: dict[Any, Any] | list[Any], floats_forced: bool, state: _EncodeState, room: list[int]
+    ) -> str | None:
+        """
+        Build the single-line JSON string for a small resolved array or object, as _flat would.
+
+        The members are written by recursion rather than with the explicit
+        stack _flat sets up, and the text of each array and object within is
+        kept in state.flat, for _width and _flat to reuse should the whole
+        not fit. room holds the number of values left; returns None once it
+        runs out.
+        """
+        room[0] -= len(obj)
+        if room[0] < 0:
+            return None
+        if isinstance(obj, dict):
+            shape = self._shape(obj)
+            starts = shape.flat_starts
+            if starts is None:
+                starts = shape.flat_starts = [f"{self.comma}{name}{self.colon1}" for name in shape.names]
+                starts[0] = starts[0][len(self.comma) :]
+            members: Iterable[tuple[str, Any, bool]] = zip(starts, map(obj.__getitem__, shape.keys), shape.floats_forced)
+        else:
+            separators = itertools.chain(("",), itertools.repeat(self.comma))
+            members = zip(separators, obj, itertools.repeat(floats_forced))
+
+        parts = []
+        for prefix, value, value_floats_forced in members:
+            value = self._resolve(value, state)
+            if type(value) is _Stream:
+                return None
+            if not isinstance(value, (dict, list, tuple, set, frozenset)):
+                text = self._scalar(value, value_floats_forced)
+            elif not value:
+                text = "{}" if isinstance(value, dict) else "[]"
+            else:
+                text = self._small_flat(value, value_floats_forced, state, room)  # type: ignore[arg-type]
+                if text is None:
+                    return None
+                state.flat[(_marker(value), value_floats_forced)] = text
+            parts.append(f"{prefix}{text}")
+        if isinstance(obj, dict):
+            return f"{{{self.opad}{''.join(parts)}{self.opad}}}"
+        return f"[{self.apad}{''.join(parts)}{self.apad}]"
+
+    def _native_text(self, obj: dict[Any, Any] | list[Any] | tuple[Any, ...]) -> str | None:
+        """Build the single-line JSON string for a plain array or object with json's C encoder, or None if it cannot."""
+        try:
+            return "".join(_native_encoder(*self._native_key)(obj, 0))  # type: ignore[misc]
+        except (ValueError, RecursionError):
+            # NaN and the infinities, which _flat writes differently, and values
+            # containing themselves, which _flat reports
+            return None
+
+    def _flat_chunks(self, obj: Any, floats_forced: bool, state: _EncodeState) -> Iterator[Any]:
+        """
+        Lay out the single-line JSON for a value, split between the members of arrays and objects.
+
+        Yields text, and nested layouts for _walk to run.
+        """
+        obj = self._resolve(obj, state)
+
+        if isinstance(obj, dict) and obj:
+            marker = _marker(obj)
+            if marker in state.markers:
+                raise _circular_reference()
+            state.markers.add(marker)
+            sep = f"{{{self.opad}"
+            shape = self._shape(obj)
+            for k, name, key_floats_forced in zip(shape.keys, shape.names, shape.floats_forced):
+                v = self._resolve(obj[k], state)
+                if isinstance(v, (list, tuple, set, frozenset, dict, _Stream)) and v:
+                    yield f"{sep}{name}{self.colon1}"
+                    yield self._flat_chunks(v, key_floats_forced, state)
+                else:
+                    yield f"{sep}{name}{self.colon1}{self._flat(v, key_floats_forced, state)}"
+                sep = self.comma
+            yield f"{self.opad}}}"
+            state.markers.discard(_marker(obj))
+        elif isinstance(obj, (list, tuple, set, frozenset, _Stream)) and obj:
+            if id(obj) in state.markers:
+                raise _circular_reference()
+            state.markers.add(id(obj))
+            sep = f"[{self.apad}"
+            for item in obj:
+                v = self._resolve(item, state)
+                if isinstance(v, (list, tuple, set, frozenset, dict, _Stream)) and v:
+                    yield sep
+                    yield self._flat_chunks(v, floats_forced, state)
+                else:
+                    yield f"{sep}{self._flat(v, floats_forced, state)}"
+                if type(obj) is _Stream:
+                    # Items already written need not be remembered
+                    state.resolved.pop(id(item), None)
+                sep = self.comma
+            yield f"{self.apad}]"
+            state.markers.discard(id(obj))
+        else:
+            yield self._flat(obj, floats_forced, state)
+
+    def _walk(self, layout: str | Iterator[Any]) -> Iterator[str]:
+        """
+        Yield the text of a layout from _emit or _flat_chunks.
+
+        A layout is either text, or an iterator yielding text, nested layouts
+        and _Capture requests. Nested layouts are run with an explicit stack
+        rather than by recursion, so documents may be nested to any depth,
+        and each chunk of text is passed up once rather than through every
+        enclosing level.
+        """
+        if isinstance(layout, str):
+            yield layout
+            return
+
+        stack = [layout]
+        # (stack depth, request, collected text) for each _Capture being run,
+        # and the length of the text each has collected. Once one collects
+        # more than the cache keeps, so have all of those enclosing it, and
+        # they are all given up.
+        captures: list[tuple[int, _Capture, list[str]]] = []
+        sizes: list[int] = []
+        max_chars = self.cache.max_chars if self.cache is not None else 0
+        while stack:
+            # Pass on the text of the innermost layout, stopping at the next
+            # nested layout or capture
+            for item in stack[-1]:
+                if type(item) is not str:
+                    break
+                if captures:
+                    captures[-1][2].append(item)
+                    sizes[-1] += len(item)
+                    if sizes[-1] > max_chars:
+                        yield self._release_captures(captures, sizes)
+                elif item:
+                    yield item
+            else:
+                stack.pop()
+                if captures and captures[-1][0] == len(stack):
+                    _, capture, texts = captures.pop()
+                    size = sizes.pop()
+                    text = "".join(texts)
+                    self.cache._store(capture.key, text)  # type: ignore[union-attr]
+                    if captures:
+                        captures[-1][2].append(text)
+                        sizes[-1] += size
+                        if sizes[-1] > max_chars:
+                            yield self._release_captures(captures, sizes)
+                    elif text:
+                        yield text
+                continue
+
+            if type(item) is _Capture:
+                captures.append((len(stack), item, []))
+                sizes.append(0)
+                stack.append(item.layout)
+            else:
+                stack.append(item)
+
+    @staticmethod
+    def _release_captures(captures: list[tuple[int, _Capture, list[str]]], sizes: list[int]) -> str:
+        """Give up every _Capture being run by _walk, returning the text they collected."""
+        text = "".join(itertools.chain.from_iterable(texts for _, _, texts in captures))
+        captures.clear()
+        sizes.clear()
+        return text
+
+    def _emit(self, obj: Any, ind: str, lead: str, floats_forced: bool, state: _EncodeState) -> str | Iterator[Any]:
+        """
+        Lay out the (possibly wrapped) JSON for a value at indentation ind.
+
+        The first line is written starting with lead instead of ind, which lets
+        a caller place the value after text already on that line. Returns the
+        text of values written on one line, and otherwise a layout for _walk.
+        """
+        obj = self._resolve(obj, state)
+
+        if not isinstance(obj, (dict, list, tuple, set, frozenset, _Stream)):
+            return f"{lead}{self._scalar(obj, floats_forced)}"
+        if not obj:
+            return f"{lead}{{}}" if isinstance(obj, dict) else f"{lead}[]"
+
+        budget = self.wrap_width - len(ind)  # type: ignore[operator]
+        if self._width(obj, floats_forced, budget, state) <= budget:
+            return f"{lead}{self._flat(obj, floats_forced, state)}"
+
+        # Text on one line is cached by _flat whatever its indentation, and
+        # wrapped text here under its indentation, so each is stored once
+        key = self._cache_key(obj, ind, floats_forced, state) if self.cache is not None else None
+        if key:
+            text = self.cache._lookup(key)  # type: ignore[union-attr]
+            if text is not None:
+                return f"{lead}{text}"
+        marker = _marker(obj)
+        if marker in state.markers:
+            raise _circular_reference()
+        state.markers.add(marker)
+        if isinstance(obj, dict):
+            layout = self._emit_object(obj, ind, "", state)
+        else:
+            layout = self._emit_array(obj, ind, "", floats_forced, state)
+        if key:
+            return iter((lead, _Capture(key, layout)))
+        # lead is passed up on its own rather than joined onto the first line,
+        # so that deeply nested first lines are not copied at every level
+        return iter((lead, layout)) if lead else layout
+
+    def _emit_array(
+        self,
+        arr: list[Any] | tuple[Any, ...] | set[Any] | frozenset[Any] | _Stream,
+        ind: str,
+        lead: str,
+        floats_forced: bool,
+        state: _EncodeState,
+    ) -> Iterator[Any]:
+        """Lay out an array that does not fit on one line, for _walk."""
+        apad = self.apad
+        if self.short:
+            indent2 = f"{ind} {apad}"
+            item_lead = f"{lead}[{apad}"
+        else:
+            indent2 = f"{ind}{self.indent}"
+            item_lead = f"{lead}[\n{indent2}"
+
+        # The rows of a table are padded to line up, so all of them are read
+        # before any is written
+        rows = None
+        if self.table:
+            if type(arr) is not _Stream:
+                rows = self._table_rows(arr, indent2, state)
+            # A stream is only read to its end if its first item could be a
+            # row, so that a long stream of anything else is still written
+            # as it is read
+            elif arr and type(first := self._resolve(arr.head[0], state)) in (dict, _Fields) and first:
+                rows = self._table_rows(arr.materialize(), indent2, state)
+        if rows is not None:
+            for row in rows:
+                yield f"{item_lead}{row}"
+                item_lead = f",\n{indent2}"
+        elif type(arr) is _Stream:
+            resolved = state.resolved
+            for v in arr:
+                yield self._emit(v, indent2, item_lead, floats_forced, state)
+                item_lead = f",\n{indent2}"
+                # Items already written need not be remembered
+                resolved.pop(id(v), None)
+        else:
+            # Runs of floats are formatted in one batch, a slice at a time so
+            # that a long array of them is written as it is formatted
+            items = iter(arr)
+            while chunk := list(itertools.islice(items, _FLOATS_SLICE_SIZE)):
+                if _all_floats(chunk):
+                    for float_str in self._floats(chunk, floats_forced):
+                        yield f"{item_lead}{float_str}"
+                        item_lead = f",\n{indent2}"
+                else:
+                    for v in chunk:
+                        yield self._emit(v, indent2, item_lead, floats_forced, state)
+                        item_lead = f",\n{indent2}"
+
+        if self.short:
+            yield f"{apad}]"
+        else:
+            close_ind = indent2 if self.indent_last else ind
+            yield f"\n{close_ind}]"
+        state.markers.discard(id(arr))
+
+    def _table_rows(
+        self, arr: list[Any] | tuple[Any, ...] | set[Any] | frozenset[Any], ind: str, state: _EncodeState
+    ) -> list[str] | None:
+        """
+        Lay out an array of objects with the same keys as the rows of a table.
+
+        Each object is written on one line, with the text after each comma
+        padded so that members line up in columns. Returns None unless the
+        array holds at least two non-empty objects with the same keys and
+        every row fits within the wrap width at indentation ind.
+        """
+        if len(arr) < 2:
+            return None
+        budget = self.wrap_width - len(ind)  # type: ignore[operator]
+        colon1 = self.colon1
+
+        shape: _Shape | None = None
+        rows = []
+        for v in arr:
+            v = self._resolve(v, state)
+            if type(v) not in (dict, _Fields) or not v:
+                return None
+            row_shape = self._shape(v)
+            if shape is None:
+                shape = row_shape
+            elif row_shape is not shape and row_shape.keys != shape.keys:
+                return None
+            if self._width(v, False, budget, state) > budget:
+                return None
+            rows.append(
+                [
+                    f"{name}{colon1}{self._flat(v[k], key_floats_forced, state)}"
+                    for k, name, key_floats_forced in zip(row_shape.keys, row_shape.names, row_shape.floats_forced)
+                ]
+            )
+
+        # Every column but the last is padded to its widest member
+        comma = self.comma
+        opad = self.opad
+        widths = [max(len(row[i]) for row in rows) + len(comma) for i in range(len(rows[0]) - 1)]
+        if 2 + 2 * len(opad) + sum(widths) + max(len(row[-1]) for row in rows) > budget:
+            return None
+        return [
+            f"{{{opad}{''.join(f'{member}{comma}'.ljust(width) for member, width in zip(row, widths))}{row[-1]}{opad}}}"
+            for row in rows
+        ]
+
+    def _emit_object(
+        self, obj: dict[Any, Any], ind: str, lead: str, state: _EncodeState
+    ) -> Iterator[Any]:
+        """Lay out an object that does not fit on one line, for _walk."""
+        for v, k_str, key_floats_forced, start in self._object_members(obj, ind, lead, state):
+            yield self._emit_member(v, k_str, key_floats_forced, ind, start, state)
+
+        if self.short:
+            yield f"{self.opad}}}"
+        else:
+            close_ind = f"{ind}{self.indent}" if self.indent_last else ind
+            yield f"\n{close_ind}}}"
+        state.markers.discard(_marker(obj))
+
+    def _object_members(
+        self, obj: dict[Any, Any], ind: str, lead: str, state: _EncodeState
+    ) -> list[tuple[Any, str, bool, str]]:
+        """
+        Lay out the keys of an object that does not fit on one line.
+
+        Returns (value, key text, floats forced, start) for each member, where
+        start is the text written before the member's value: the key and
+        colon, preceded by the opening brace for the first member and by the
+        separating comma for the others.
+        """
+        shape = self._shape(obj)
+        names = shape.aligned_names
+        opad = self.opad
+
+        if self.short:
+            key_strs = [f"{ind} {opad}{name}" for name in names]
+            key_strs[0] = f"{ind}{{{opad}{names[0]}"
+        else:
+            key_strs = [f"{ind}{self.indent}{name}" for name in names]
+
+        colonn = self.colonn
+        members = []
+        for i, (k, key_floats_forced, k_str) in enumerate(zip(shape.keys, shape.floats_forced, key_strs)):
+            if i:
+                start = f",\n{k_str}{colonn}"
+            elif self.short:
+                start = f"{lead}{k_str[len(ind):]}{colonn}"
+            else:
+                start = f"{lead}{{\n{k_str}{colonn}"
+            members.append((self._resolve(obj[k], state), k_str, key_floats_forced, start))
+        return members
+
+    def _emit_member(
+        self, v: Any, k_str: str, floats_forced: bool, ind: str, start: str, state: _EncodeState
+    ) -> str | Iterator[Any]:
+        """Lay out the value of one member of an object that does not fit on one line, after start."""
+        colonn = self.colonn
+        if isinstance(v, (list, tuple, set, frozenset, dict, _Stream)):
+            budget = self.wrap_width - len(k_str) - len(colonn)  # type: ignore[operator]
+            if self._width(v, floats_forced, budget, state) > budget:
+                indent2 = " " * (len(k_str) + len(colonn)) if self.short else f"{ind}{self.indent}"
+                return self._emit(v, indent2, f"{start}{indent2.lstrip()}", floats_forced, state)
+            return f"{start}{self._flat(v, floats_forced, state)}"
+        # Other values are laid out as if they started at the left margin
+        return self._emit(v, "", start, floats_forced, state)
+
+    def _reformat_flat(self, reader: _JSONReader, floats_forced: bool, state: _EncodeState) -> Iterator[Any]:
+        """Lay out the single-line JSON for the next value read, like _flat_chunks, for _walk."""
+        kind = reader.peek()[0]
+        if kind not in ("[", "{") or reader.peek(1)[0] in ("]", "}") or (kind == "{" and self.sort):
+            yield self._flat(reader.value(), floats_forced, state)
+            return
+
+        reader.next()
+        if kind == "[":
+            sep = f"[{self.apad}"
+            while True:
+                if reader.peek()[0] in ("[", "{"):
+                    yield sep
+                    yield self._reformat_flat(reader, floats_forced, state)
+                else:
+                    yield f"{sep}{self._flat(reader.value(), floats_forced, state)}"
+                if reader.close("]"):
+                    break
+                sep = self.comma
+            yield f"{self.apad}]"
+        else:
+            sep = f"{{{self.opad}"
+            while True:
+                key = reader.key()
+                key_floats_forced = self.force_floats or key in self.force_floats_in
+                if reader.peek()[0] in ("[", "{"):
+                    yield f"{sep}{self._escape(key)}{self.colon1}"
+                    yield self._reformat_flat(reader, key_floats_forced, state)
+                else:
+                    yield f"{sep}{self._escape(key)}{self.colon1}{self._flat(reader.value(), key_floats_forced, state)}"
+                if reader.close("}"):
+                    break
+                sep = self.comma
+            yield f"{self.opad}}}"
+
+    def _reformat_fits(self, reader: _JSONReader, budget: int, floats_forced: bool) -> Any:
+        """
+        Read the next value, a non-empty array or object, if it fits on one line within budget.
+
+        Looks ahead at the value's tokens, measuring them as _width would,
+        and returns _TOO_WIDE without reading anything as soon as the value
+        is known to be wider.
+        """
+        peek = reader.peek
+        escape = self._escape
+        scalar = self._scalar
+        len_comma = len(self.comma)
+        len_colon1 = len(self.colon1)
+
+        # The closing bracket and floats forced of each array and object open
+        stack: list[tuple[str, bool]] = []
+        total = 0
+        i = 0
+        while True:
+            kind, value, _ = peek(i)
+            i += 1
+            if kind == "[" and peek(i)[0] != "]":
+                total += self._array_overhead
+                stack.append(("]", floats_forced))
+            elif kind == "{" and peek(i)[0] != "}":
+                total += self._object_overhead
+                stack.append(("}", floats_forced))
+            else:
+                if kind in ("[", "{"):
+                    i += 1
+                    total += 2
+                elif kind == "s" and len(value) + 2 > budget - total:
+                    # Escaping never makes a string shorter
+                    return _TOO_WIDE
+                elif kind in ("s", "n", "v"):
+                    total += len(scalar(value, floats_forced))
+                else:
+                    return reader.value()  # Raises for the invalid token
+
+                # Close the arrays and objects that end after this value
+                while True:
+                    if total > budget:
+                        return _TOO_WIDE
+                    if not stack:
+                        return reader.value()
+                    kind = peek(i)[0]
+                    i += 1
+                    if kind == ",":
+                        break
+                    if kind != stack[-1][0]:
+                        return reader.value()
+                    stack.pop()
+
+            # Start the next member of the innermost array or object
+            closer, floats_forced = stack[-1]
+            if closer == "}":
+                kind, key, _ = peek(i)
+                if kind != "s" or peek(i + 1)[0] != ":":
+                    return reader.value()
+                i += 2
+                total += len_comma + len_colon1
+                if len(key) + 2 > budget - total:
+                    return _TOO_WIDE
+                total += len(escape(key))
+                floats_forced = self.force_floats or key in self.force_floats_in
+            else:
+                total += len_comma
+            if total > budget:
+                return _TOO_WIDE
+
+    def _reformat_value(
+        self, reader: _JSONReader, ind: str, lead: str, floats_forced: bool, state: _EncodeState
+    ) -> str | Iterator[Any]:
+        """Lay out the (possibly wrapped) JSON for the next value read, like _emit."""
+        if reader.peek()[0] not in ("[", "{") or reader.peek(1)[0] in ("]", "}"):
+            return self._emit(reader.value(), ind, lead, floats_forced, state)
+        value = self._reformat_fits(reader, self.wrap_width - len(ind), floats_forced)  # type: ignore[operator]
+        if value is not _TOO_WIDE:
+            return self._emit(value, ind, lead, floats_forced, state)
+        return self._reformat_wrapped(reader, ind, lead, floats_forced, state)
+
+    def _reformat_wrapped(
+        self, reader: _JSONReader, ind: str, lead: str, floats_forced: bool, state: _EncodeState
+    ) -> str | Iterator[Any]:
+        """Lay out the next value read, an array or object too wide for one line, like _emit."""
+        kind = reader.peek()[0]
+        if (kind == "{" and (self.sort or self.aligned)) or (kind == "[" and self.table and reader.peek(1)[0] == "{"):
+            # Sorting or aligning keys, and laying out a table, need every member
+            return self._emit(reader.value(), ind, lead, floats_forced, state)
+        reader.next()
+        if kind == "{":
+            layout = self._reformat_object(reader, ind, state)
+        else:
+            layout = self._reformat_array(reader, ind, floats_forced, state)
+        return iter((lead, layout)) if lead else layout
+
+    def _reformat_array(
+        self, reader: _JSONReader, ind: str, floats_forced: bool, state: _EncodeState
+    ) -> Iterator[Any]:
+        """Lay out the members of an array being read, after its opening bracket, like _emit_array."""
+        apad = self.apad
+        if self.short:
+            indent2 = f"{ind} {apad}"
+            item_lead = f"[{apad}"
+        else:
+            indent2 = f"{ind}{self.indent}"
+            item_lead = f"[\n{indent2}"
+
+        while True:
+            yield self._reformat_value(reader, indent2, item_lead, floats_forced, state)
+            if reader.close("]"):
+                break
+            item_lead = f",\n{indent2}"
+
+        if self.short:
+            yield f"{apad}]"
+        else:
+            close_ind = indent2 if self.indent_last else ind
+            yield f"\n{close_ind}]"
+
+    def _reformat_object(self, reader: _JSONReader, ind: str, state: _EncodeState) -> Iterator[Any]:
+        """Lay out the members of an object being read, after its opening brace, like _emit_object."""
+        opad = self.opad
+        colonn = self.colonn
+        first = True
+        while True:
+            key = reader.key()
+            name = self._escape(key)
+            if not self.short:
+                k_str = f"{ind}{self.indent}{name}"
+                start = f"{{\n{k_str}{colonn}" if first else f",\n{k_str}{colonn}"
+            elif first:
+                k_str = f"{ind}{{{opad}{name}"
+                start = f"{k_str[len(ind):]}{colonn}"
+            else:
+                k_str = f"{ind} {opad}{name}"
+                start = f",\n{k_str}{colonn}"
+            key_floats_forced = self.force_floats or key in self.force_floats_in
+            yield self._reformat_member(reader, k_str, key_floats_forced, ind, start, state)
+            if reader.close("}"):
+                break
+            first = False
+
+        if self.short:
+            yield f"{opad}}}"
+        else:
+            close_ind = f"{ind}{self.indent}" if self.indent_last else ind
+            yield f"\n{close_ind}}}"
+
+    def _reformat_member(
+        self, reader: _JSONReader, k_str: str, floats_forced: bool, ind: str, start: str, state: _EncodeState
+    ) -> str | Iterator[Any]:
+        """Lay out the value of one member of an object being read, after start, like _emit_member."""
+        if reader.peek()[0] not in ("[", "{") or reader.peek(1)[0] in ("]", "}"):
+            return self._emit_member(reader.value(), k_str, floats_forced, ind, start, state)
+
+        # The value is written on one line if it fits after the key, or else
+        # on a line of its own
+        colonn = self.colonn
+        indent2 = " " * (len(k_str) + len(colonn)) if self.short else f"{ind}{self.indent}"
+        budget = self.wrap_width - min(len(k_str) + len(colonn), len(indent2))  # type: ignore[operator]
+        value = self._reformat_fits(reader, budget, floats_forced)
+        if value is not _TOO_WIDE:
+            return self._emit_member(value, k_str, floats_forced, ind, start, state)
+        return self._reformat_wrapped(reader, indent2, f"{start}{indent2.lstrip()}", floats_forced, state)
+
+
+# The options of neat_json (other than cache and stats), in the order
+# _shared_encoder takes them
+_OPTION_NAMES = (
+    "wrap",
+    "indent",
+    "indent_last",
+    "short",
+    "sort",
+    "sorted",
+    "sort_cache",
+    "aligned",
+    "table",
+    "decimals",
+    "trim_trailing_zeros",
+    "force_floats",
+    "force_floats_in",
+    "ensure_ascii",
+    "padding",
+    "array_padding",
+    "object_padding",
+    "around_comma",
+    "before_comma",
+    "after_comma",
+    "around_colon",
+    "before_colon",
+    "after_colon",
+    "around_colon_1",
+    "before_colon_1",
+    "after_colon_1",
+    "around_colon_n",
+    "before_colon_n",
+    "after_colon_n",
+)
+
+
+@functools.lru_cache(maxsize=64, typed=True)
+def _shared_encoder(*options: Any) -> NeatEncoder:
+    """Return an encoder for the options of a neat_json call, shared by calls with the same options."""
+    return NeatEncoder(**dict(zip(_OPTION_NAMES, options)))
+
+
+class _DocumentEncoder(NeatEncoder):
+    """
+    An encoder that remembers the formatting of each array and object of a NeatDocument.
+
+    Entries are keyed on the identity of the container, which is safe because
+    the document owns every container in its tree and forgets the entries of
+    any container that is changed or removed.
+    """
+
+    # Only text up to this long is remembered, as for a SubtreeCache, so that
+    # a deeply nested document does not keep a copy of its text at every
+    # level. Longer containers are laid out again, from the remembered text
+    # of the values in them.
+    max_chars = 16384
+
+    def __init__(self, **opts: Any) -> None:
+        super().__init__(**opts)
+        # Containers by id(), with their formatted text keyed on (indentation,
+        # floats forced) and their width keyed on ("width", floats forced)
+        self._memo: dict[int, tuple[Any, dict[Hashable, Any]]] = {}
+        self.cache = self  # type: ignore[assignment]
+        # Layouts are remembered, so small values are measured like others
+        self._small_first = False
+        if self.stats is not None:
+            # The stats instrumented the encoder before it had a cache, so
+            # remembered text is counted as cache hits from here
+            self.cache = _CacheProbe(self, self.stats)  # type: ignore[arg-type]
+
+    def _cache_key(
+        self,
+        obj: dict[Any, Any] | list[Any] | tuple[Any, ...] | set[Any] | frozenset[Any],
+        ind: str | None,
+        floats_forced: bool,
+        state: _EncodeState,
+    ) -> Hashable | None:
+        return (obj, ind, floats_forced)
+
+    def _lookup(self, key: Hashable) -> str | None:
+        obj, ind, floats_forced = cast(tuple[Any, Any, bool], key)
+        return cast("str | None", self._entries(obj).get((ind, floats_forced)))
+
+    def _store(self, key: Hashable, text: str) -> None:
+        obj, ind, floats_forced = cast(tuple[Any, Any, bool], key)
+        self._entries(obj)[ind, floats_forced] = text
+
+    def _width(self, obj: Any, floats_forced: bool, budget: int, state: _EncodeState) -> int:
+        if not isinstance(obj, (dict, list)) or not obj:
+            return super()._width(obj, floats_forced, budget, state)
+
+        # A remembered width is exact if it was within the budget it was
+        # measured against, and otherwise a lower bound
+        entries = self._entries(obj)
+        measured = entries.get(("width", floats_forced))
+        if measured is not None:
+            width, measured_budget = measured
+            if width <= measured_budget or width > budget:
+                return width
+        width = super()._width(obj, floats_forced, budget, state)
+        entries["width", floats_forced] = (width, budget)
+        return width
+
+    def _entries(self, obj: Any) -> dict[Hashable, Any]:
+        """Return the remembered formatting of a container in the document."""
+        entry = self._memo.get(id(obj))
+        if entry is None or entry[0] is not obj:
+            entry = self._memo[id(obj)] = (obj, {})
+        return entry[1]
+
+    def _forget(self, obj: Any) -> None:
+        """Forget the formatting of a container, but not of the values in it."""
+        self._memo.pop(id(obj), None)
+
+    def _forget_tree(self, obj: Any) -> None:
+        """Forget the formatting of a value and everything in it."""
+        pending = [obj]
+        while pending:
+            obj = pending.pop()
+            if isinstance(obj, dict):
+                self._memo.pop(id(obj), None)
+                pending.extend(obj.values())
+            elif isinstance(obj, list):
+                self._memo.pop(id(obj), None)
+                pending.extend(obj)
+
+
+class NeatDocument:
+    """
+    A formatted document that is re-formatted incrementally as it is edited.
+
+    The text of every array and object is remembered, so after an update
+    through `set`, `insert` or `delete` only the changed value and the arrays
+    and objects containing it are formatted again. Arrays and objects whose
+    text is longer than 16384 characters are the exception: they are laid
+    out again from the remembered text of the values in them, so that a
+    deeply nested document does not keep a copy of its text at every level.
+    The text is always identical to calling `neat_json` on the document's
+    current value with the same options.
+
+    The document keeps its own copy of the value, with wrapper types (such
+    as dataclasses, namedtuples and registered types) converted, tuples and
+    sets turned into lists, and float-like numbers into floats. Paths are
+    JSON pointers (RFC 6901), such as "/servers/0/port"; "" is the whole
+    document. Object keys are matched on their str() form, and "-" stands
+    for the end of an array.
+
+    Example:
+        >>> doc = NeatDocument({"name": "api", "ports": [80, 443]}, wrap=20)
+        >>> doc.set("/ports/-", 8080)
+        >>> print(doc.text)
+        {
+          "name":"api",
+          "ports":[80,443,8080]
+        }
+    """
+
+    def __init__(self, value: Any, **opts: Any) -> None:
+        """
+        Create a document.
+
+        Args:
+            value: The initial value of the document.
+            **opts: Any of the keyword options accepted by `neat_json`,
+                    except `cache`.
+        """
+        self._encoder = _DocumentEncoder(**opts)
+        self._value = self._own(value)
+        self._text: str | None = None
+
+    @property
+    def value(self) -> Any:
+        """The current value of the document, which must not be modified directly."""
+        return self._value
+
+    @property
+    def text(self) -> str:
+        """The formatted JSON for the current value of the document."""
+        if self._text is None:
+            self._text = self._encoder.encode(self._value)
+        return self._text
+
+    def __str__(self) -> str:
+        return self.text
+
+    def set(self, path: str, value: Any) -> None:
+        """
+        Replace the value at a path, or add it as a new member of an object.
+
+        "-" as the last token of the path appends to an array.
+        """
+        if not path:
+            self._encoder._memo.clear()
+            self._value = self._own(value)
+            self._text = None
+            return
+        parent, token = self._parent(path)
+        if isinstance(parent, dict):
+            key = self._key(parent, token, missing_ok=True)
+            self._encoder._forget_tree(parent.get(key))
+            parent[key] = self._own(value)
+        elif token == "-":
+            parent.append(self._own(value))
+        else:
+            index = self._index(parent, token)
+            self._encoder._forget_tree(parent[index])
+            parent[index] = self._own(value)
+
+    def insert(self, path: str, value: Any) -> None:
+        """
+        Insert a value into an array before the element at a path.
+
+        "-" as the last token of the path appends to the array. For objects
+        this is the same as `set`.
+        """
+        if not path:
+            self.set(path, value)
+            return
+        parent, token = self._parent(path)
+        if isinstance(parent, dict):
+            self.set(path, value)
+        elif token == "-":
+            parent.append(self._own(value))
+        else:
+            index = self._index(parent, token, allow_end=True)
+            parent.insert(index, self._own(value))
+
+    def delete(self, path: str) -> None:
+        """Remove the value at a path from the array or object containing it."""
+        if not path:
+            raise ValueError("cannot delete the whole document")
+        parent, token = self._parent(path)
+        if isinstance(parent, dict):
+            self._encoder._forget_tree(parent.pop(self._key(parent, token)))
+        else:
+            self._encoder._forget_tree(parent.pop(self._index(parent, token)))
+
+    def _own(self, value: Any) -> Any:
+        """Return a copy of a value that the document owns, made of plain types."""
+        state = _EncodeState()
+        resolve = self._encoder._resolve
+
+        # Copies are made with an explicit stack of (copy to fill, key or
+        # index in it, original value), with an entry of (None, id, None) to
+        # mark where the copy of each array or object is complete
+        root: list[Any] = [None]
+        pending: list[tuple[Any, Any, Any]] = [(root, 0, value)]
+        copying: set[int] = set()
+        while pending:
+            target, key, obj = pending.pop()
+            if target is None:
+                copying.discard(key)
+                continue
+            obj = resolve(obj, state)
+            copy: dict[Any, Any] | list[Any]
+            if isinstance(obj, dict):
+                copy = dict.fromkeys(obj)
+                members = list(obj.items())
+            elif isinstance(obj, (list, tuple, set, frozenset, _Stream)):
+                members = list(enumerate(obj))
+                copy = [None] * len(members)
+            else:
+                target[key] = obj
+                continue
+            if id(obj) in copying:
+                raise _circular_reference()
+            copying.add(id(obj))
+            target[key] = copy
+            pending.append((None, id(obj), None))
+            pending.extend((copy, k, v) for k, v in reversed(members))
+        return root[0]
+
+    def _parent(self, path: str) -> tuple[dict[Any, Any] | list[Any], str]:
+        """
+        Find the container of the value at a path, and the last token of the path.
+
+        The formatting of every container on the way is forgotten, since
+        changing the value changes all of them.
+        """
+        if not path.startswith("/"):
+            raise ValueError(f"invalid JSON pointer: {path!r}")
+        tokens = [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
 
-            close_ind = indent2 if indent_last else ind
-            return f"{ind}{{\n{',\n'.join(result_lines)}\n{close_ind}}}"
+        self._text = None
+        parent = self._value
+        for token in tokens[:-1]:
+            self._encoder._forget(parent)
+            if isinstance(parent, dict):
+                parent = parent[self._key(parent, token)]
+            elif isinstance(parent, list):
+                parent = parent[self._index(parent, token)]
+            else:
+                raise TypeError(f"cannot index into {type(parent).__name__} at {path!r}")
+        if not isinstance(parent, (dict, list)):
+            raise TypeError(f"cannot index into {type(parent).__name__} at {path!r}")
+        self._encoder._forget(parent)
+        return parent, tokens[-1]
 
-    # Avoid shadowing built-in sorted
-    builtins_sorted = __builtins__["sorted"] if isinstance(__builtins__, dict) else getattr(__builtins__, "sorted")  # type: ignore[index]
+    @staticmethod
+    def _key(obj: dict[Any, Any], token: str, missing_ok: bool = False) -> Any:
+        """Return the key of an object that a path token refers to."""
+        if token in obj:
+            return token
+        for k in obj:
+            if str(k) == token:
+                return k
+        if missing_ok:
+            return token
+        raise KeyError(token)
 
-    return build(value, "", force_floats)
+    @staticmethod
+    def _index(arr: list[Any], token: str, allow_end: bool = False) -> int:
+        """Return the index in an array that a path token refers to."""
+        if not token.isdigit() or (token.startswith("0") and token != "0"):
+            raise IndexError(f"invalid array index: {token!r}")
+        index = int(token)
+        if index > len(arr) or (index == len(arr) and not allow_end):
+            raise IndexError(f"array index out of range: {token!r}")
+        return index
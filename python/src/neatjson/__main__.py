@@ -0,0 +1,272 @@
+"""
+Command-line interface for NeatJSON.
+
+Reformats JSON files (or standard input) with the options of `neat_json`,
+given as flags, writing the result to standard output, to a file, or back
+to each file in place.
+
+Usage:
+    python -m neatjson data.json --wrap 40 --sort
+    neatjson --in-place -j 8 fixtures/*.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import filecmp
+import io
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from typing import IO, Any, cast
+
+from neatjson import NeatEncoder
+
+# Size of the write buffer for output files
+_BUFFER_SIZE = 1 << 20
+
+# The most output of one file held in memory until the file is known to be
+# valid; more than this is held in a temporary file instead
+_SPOOL_SIZE = 1 << 24
+
+# Integer spacing options of neat_json, each given as a --flag-name
+_SPACING_OPTIONS = (
+    "padding",
+    "array_padding",
+    "object_padding",
+    "around_comma",
+    "before_comma",
+    "after_comma",
+    "around_colon",
+    "before_colon",
+    "after_colon",
+    "around_colon_1",
+    "before_colon_1",
+    "after_colon_1",
+    "around_colon_n",
+    "before_colon_n",
+    "after_colon_n",
+)
+
+# The neat_json options that can be given as flags
+_OPTIONS = (
+    "wrap",
+    "indent",
+    "indent_last",
+    "short",
+    "sort",
+    "sort_cache",
+    "aligned",
+    "table",
+    "decimals",
+    "trim_trailing_zeros",
+    "force_floats",
+    "force_floats_in",
+    "ensure_ascii",
+    *_SPACING_OPTIONS,
+)
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Run the command line, returning the exit status.
+
+    Args:
+        argv: The arguments, without the program name. Default: sys.argv[1:]
+
+    Returns:
+        0 if every input was reformatted, 1 if any could not be.
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    # Options not given are left out, so that neat_json's defaults and
+    # shorthand cascades apply
+    opts = {name: getattr(args, name) for name in _OPTIONS if hasattr(args, name)}
+    try:
+        encoder = NeatEncoder(**opts)
+    except (TypeError, ValueError) as e:
+        parser.error(str(e))
+
+    paths = args.files or ["-"]
+    if args.in_place and (args.output or "-" in paths):
+        parser.error("--in-place needs file arguments and cannot be used with --output")
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    jobs = args.jobs or os.cpu_count() or 1
+
+    errors: list[str | None]
+    if args.in_place:
+        if jobs == 1 or len(paths) == 1:
+            errors = [_rewrite(encoder, path) for path in paths]
+        else:
+            errors = list(_pool_map(_rewrite_in_worker, paths, opts, jobs))
+    else:
+        fp_out = open(args.output, "wb", buffering=_BUFFER_SIZE) if args.output else sys.stdout.buffer
+        try:
+            if jobs == 1 or len(paths) == 1:
+                errors = [_write(encoder, path, fp_out) for path in paths]
+            else:
+                # Workers format whole files, which are written out in order
+                errors = []
+                for text, error in _pool_map(_format_in_worker, paths, opts, jobs):
+                    fp_out.write(text)
+                    errors.append(error)
+        finally:
+            if args.output:
+                fp_out.close()
+            else:
+                fp_out.flush()
+
+    for error in errors:
+        if error is not None:
+            print(f"neatjson: {error}", file=sys.stderr)
+    return 1 if any(error is not None for error in errors) else 0
+
+
+def _parser() -> argparse.ArgumentParser:
+    """Create the argument parser, with a flag for each neat_json option."""
+    parser = argparse.ArgumentParser(
+        prog="neatjson",
+        description="Pretty-print JSON files with NeatJSON.",
+        argument_default=argparse.SUPPRESS,
+    )
+    parser.add_argument("files", nargs="*", default=[], help="JSON files to reformat ('-' or none for stdin)")
+    parser.add_argument("-o", "--output", default=None, help="write the output to this file instead of stdout")
+    parser.add_argument("-i", "--in-place", action="store_true", default=False, help="rewrite each file in place")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of files to reformat in parallel (0 for one per CPU)"
+    )
+
+    layout = parser.add_argument_group("formatting options (see neat_json)")
+    layout.add_argument("--wrap", type=_wrap, metavar="WIDTH", help="line width, 'true' or 'false' (default: 80)")
+    layout.add_argument("--indent", type=_unescape, help="indent for each level; '\\t' is a tab (default: 2 spaces)")
+    layout.add_argument("--indent-last", action="store_true")
+    layout.add_argument("--short", action="store_true")
+    layout.add_argument("--sort", action="store_true", help="sort object keys")
+    layout.add_argument("--sort-cache", type=int, metavar="N")
+    layout.add_argument("--aligned", action="store_true")
+    layout.add_argument("--table", action="store_true")
+    layout.add_argument("--decimals", type=int, metavar="N")
+    layout.add_argument("--trim-trailing-zeros", action="store_true")
+    layout.add_argument("--force-floats", action="store_true")
+    layout.add_argument("--force-floats-in", action="append", metavar="KEY", help="may be given more than once")
+    layout.add_argument("--no-ensure-ascii", dest="ensure_ascii", action="store_false")
+    for name in _SPACING_OPTIONS:
+        layout.add_argument(f"--{name.replace('_', '-')}", type=int, metavar="N")
+    return parser
+
+
+def _wrap(text: str) -> int | bool:
+    """Parse the value of --wrap."""
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    return int(text)
+
+
+def _unescape(text: str) -> str:
+    """Parse the value of --indent, where a literal \\t stands for a tab."""
+    return text.replace("\\t", "\t")
+
+
+def _reformat(encoder: NeatEncoder, path: str, fp_out: IO[bytes]) -> None:
+    """Reformat one file, or stdin for '-', into fp_out, followed by a newline."""
+    if path == "-":
+        encoder.reformat(sys.stdin.buffer, fp_out)
+    else:
+        with open(path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Empty files and pipes cannot be mapped
+                encoder.reformat(f, fp_out)
+            else:
+                with data:
+                    encoder.reformat(cast(IO[bytes], data), fp_out)
+    fp_out.write(b"\n")
+
+
+def _write(encoder: NeatEncoder, path: str, fp_out: IO[bytes]) -> str | None:
+    """
+    Reformat one file into fp_out, returning an error message if it fails.
+
+    The output is gathered first and only written once the whole file has
+    been read, so nothing of a file that is not valid JSON is written.
+    """
+    with tempfile.SpooledTemporaryFile(_SPOOL_SIZE) as buf:
+        try:
+            _reformat(encoder, path, cast(IO[bytes], buf))
+            buf.seek(0)
+            shutil.copyfileobj(buf, fp_out, _BUFFER_SIZE)
+        except (OSError, ValueError) as e:
+            return f"{path}: {e}"
+    return None
+
+
+def _rewrite(encoder: NeatEncoder, path: str) -> str | None:
+    """
+    Reformat one file in place, returning an error message if it fails.
+
+    The output is written to a temporary file beside it, which then replaces
+    it, so the file is never left partly written. Files that are already
+    formatted are left untouched.
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=".neatjson-", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    except OSError as e:
+        return f"{path}: {e}"
+    try:
+        with os.fdopen(fd, "wb", buffering=_BUFFER_SIZE) as f:
+            _reformat(encoder, path, f)
+        if filecmp.cmp(path, tmp, shallow=False):
+            os.unlink(tmp)
+        else:
+            shutil.copymode(path, tmp)
+            os.replace(tmp, path)
+    except (OSError, ValueError) as e:
+        os.unlink(tmp)
+        return f"{path}: {e}"
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return None
+
+
+def _pool_map(fn: Any, paths: list[str], opts: dict[str, Any], jobs: int) -> Any:
+    """Map fn over the paths in order on a pool of worker processes, each with its own encoder."""
+    # Imported here, since it slows down starting the command for serial runs
+    import concurrent.futures
+
+    chunksize = max(1, len(paths) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(opts,)) as executor:
+        yield from executor.map(fn, paths, chunksize=chunksize)
+
+
+# The encoder used by each worker process
+_worker_encoder: NeatEncoder | None = None
+
+
+def _init_worker(opts: dict[str, Any]) -> None:
+    """Create the encoder for a worker process."""
+    global _worker_encoder
+    _worker_encoder = NeatEncoder(**opts)
+
+
+def _format_in_worker(path: str) -> tuple[bytes, str | None]:
+    """Reformat one file in a worker process, returning its output (none if it fails) and any error message."""
+    buf = io.BytesIO()
+    try:
+        _reformat(cast(NeatEncoder, _worker_encoder), path, buf)
+    except (OSError, ValueError) as e:
+        return b"", f"{path}: {e}"
+    return buf.getvalue(), None
+
+
+def _rewrite_in_worker(path: str) -> str | None:
+    """Reformat one file in place in a worker process."""
+    return _rewrite(cast(NeatEncoder, _worker_encoder), path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the NeatJSON Python port.
+
+Formats a set of deterministic synthetic corpora (plus test/large.json, if
+present) with several combinations of options, and reports the best and
+median time, throughput of the output in MB/s, and peak memory for each.
+
+Usage:
+    python test/bench_neatjson.py                          # Run and print results
+    python test/bench_neatjson.py -o results.json          # Also save results as JSON
+    python test/bench_neatjson.py -c baseline.json         # Flag regressions against saved results
+    python test/bench_neatjson.py -k floats -k wide        # Only corpora whose names contain these
+    python test/bench_neatjson.py -s 4                     # Corpora four times larger
+    python test/bench_neatjson.py --quick                  # One timed run per benchmark
+
+The "tiny" and "many-small" corpora format each document with its own call,
+so comparing them with -c against results saved from an earlier version
+shows any change in the cost of each call.
+
+Importing neatjson is timed too, in fresh interpreters with
+`python -X importtime`, and reported as "import". The run fails if the
+best import time is over IMPORT_BUDGET_MS.
+
+The longest time neat_json_async keeps other tasks waiting while it formats
+large documents is reported as "async-stall", and the run fails if even the
+best is over STALL_BUDGET_MS.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+# Add the python src directory to the path
+sys.path.insert(0, str(Path(__file__).parent.parent / "python" / "src"))
+
+import neatjson
+from neatjson import neat_json, neat_json_async
+
+SEED = 20240611
+
+# The most time importing neatjson may take, in milliseconds
+IMPORT_BUDGET_MS = 30
+
+# The most time neat_json_async may keep other tasks waiting, in milliseconds
+STALL_BUDGET_MS = 100
+
+OPTION_SETS: dict[str, dict[str, Any]] = {
+    "default": {},
+    "flat": {"wrap": False},
+    "wrap40-aligned": {"wrap": 40, "aligned": True, "around_colon": 1},
+    "short-padded": {"short": True, "padding": 1, "after_comma": 1},
+    "sorted-decimals": {"sort": True, "decimals": 3, "trim_trailing_zeros": True},
+}
+
+
+def _word(rng: random.Random, alphabet: str = "abcdefghijklmnopqrstuvwxyz") -> str:
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(3, 10)))
+
+
+def wide_object(rng: random.Random, scale: int) -> Any:
+    """One object with many members of mixed scalar types."""
+    return {
+        f"{_word(rng)}_{i}": rng.choice([rng.randint(-1000, 1000), rng.random() * 100, _word(rng), True, None])
+        for i in range(2000 * scale)
+    }
+
+
+def deep_nesting(rng: random.Random, scale: int) -> Any:
+    """Arrays and objects nested many levels deep, each level holding a few members."""
+
+    def level(depth: int) -> Any:
+        if depth == 0:
+            return [rng.randint(0, 99) for _ in range(3)]
+        if depth % 2:
+            return {_word(rng): level(depth - 1), "n": depth, "tag": _word(rng)}
+        return [level(depth - 1), depth, _word(rng)]
+
+    return [level(60) for _ in range(10 * scale)]
+
+
+def float_arrays(rng: random.Random, scale: int) -> Any:
+    """Rows of floats, with integral and negative values mixed in."""
+    return [[round(rng.uniform(-1e4, 1e4), rng.randint(0, 6)) for _ in range(50)] for _ in range(200 * scale)]
+
+
+def long_strings(rng: random.Random, scale: int) -> Any:
+    """Long strings that need escaping, in a flat array and in objects."""
+    alphabet = "abcdefghij \"\\\n\t/"
+    return {
+        "lines": ["".join(rng.choice(alphabet) for _ in range(rng.randint(100, 2000))) for _ in range(50 * scale)],
+        "records": [{"id": i, "body": _word(rng) * 40} for i in range(100 * scale)],
+    }
+
+
+def unicode_text(rng: random.Random, scale: int) -> Any:
+    """Keys and values outside ASCII, including astral-plane characters."""
+    alphabet = "αβγδεжзий日本語中文한국어😀🎉ü"
+    return [{_word(rng, alphabet): _word(rng, alphabet) * 5, "ascii": _word(rng)} for _ in range(1000 * scale)]
+
+
+def many_small(rng: random.Random, scale: int) -> Any:
+    """Many small log-record documents, each formatted by its own call."""
+    return [
+        {"level": rng.choice(["info", "warn", "error"]), "msg": _word(rng), "t": rng.random(), "tags": [_word(rng)]}
+        for _ in range(5000 * scale)
+    ]
+
+
+def tiny_values(rng: random.Random, scale: int) -> Any:
+    """Tiny documents, each formatted by its own call, where the cost of each call matters most."""
+    return [
+        rng.choice(
+            [
+                {"id": rng.randint(0, 999), "name": _word(rng), "ok": True},
+                [rng.randint(0, 9) for _ in range(3)],
+                {"user": {"id": rng.randint(0, 999), "name": _word(rng)}, "tags": [_word(rng)], "n": rng.random()},
+            ]
+        )
+        for _ in range(5000 * scale)
+    ]
+
+
+@dataclasses.dataclass
+class LineItem:
+    sku: str
+    qty: int
+    tags: list[str]
+
+
+@dataclasses.dataclass
+class Order:
+    id: int
+    lines: list[LineItem]
+    total: float
+
+
+def orders(rng: random.Random, scale: int) -> Any:
+    """Orders of ten line items each, as dataclasses."""
+    return [
+        Order(i, [LineItem(_word(rng), rng.randint(1, 20), [_word(rng), _word(rng)]) for _ in range(10)], i * 1.5)
+        for i in range(3000 * scale)
+    ]
+
+
+def order_dicts(rng: random.Random, scale: int) -> Any:
+    """The orders of the "orders" corpus converted to dicts beforehand, to compare with."""
+    return [dataclasses.asdict(order) for order in orders(random.Random(f"{SEED}-orders"), scale)]
+
+
+CORPORA: dict[str, Callable[[random.Random, int], Any]] = {
+    "wide-object": wide_object,
+    "deep-nesting": deep_nesting,
+    "float-arrays": float_arrays,
+    "long-strings": long_strings,
+    "unicode": unicode_text,
+    "many-small": many_small,
+    "tiny": tiny_values,
+    "orders": orders,
+    "orders-as-dicts": order_dicts,
+}
+
+
+# Corpora of documents each formatted by its own call
+PER_CALL_CORPORA = {"many-small", "tiny"}
+
+
+def load_corpora(scale: int) -> dict[str, Any]:
+    """Generate every corpus from a fixed seed, and add large.json if it exists."""
+    corpora = {name: make(random.Random(f"{SEED}-{name}"), scale) for name, make in CORPORA.items()}
+    large_path = Path(__file__).parent / "large.json"
+    if large_path.exists():
+        with open(large_path) as f:
+            corpora["large.json"] = json.load(f)
+    return corpora
+
+
+def formatter(name: str, value: Any, opts: dict[str, Any]) -> Callable[[], int]:
+    """Return a function that formats a corpus once and returns the number of bytes written."""
+    if name in PER_CALL_CORPORA:
+        return lambda: sum(len(neat_json(doc, **opts).encode()) for doc in value)
+    return lambda: len(neat_json(value, **opts).encode())
+
+
+def bench_one(run: Callable[[], int], repeat: int) -> dict[str, Any]:
+    """Time a formatter; peak memory is measured on a separate run, since tracing slows it down."""
+    size = run()  # Warm up, and find the output size
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "best_ms": best * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "output_bytes": size,
+        "mb_per_s": size / best / 1e6 if best else 0.0,
+        "peak_kib": peak / 1024,
+    }
+
+
+def import_time(repeat: int) -> tuple[list[float], set[str]]:
+    """
+    Import neatjson in fresh interpreters, returning the time each import took
+    in milliseconds (as reported by `python -X importtime`), and the modules
+    that importing it loaded.
+    """
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    env["PYTHONPATH"] = str(Path(__file__).parent.parent / "python" / "src")
+    times = []
+    modules: set[str] = set()
+    # The first, untimed, run writes the byte-code, so that the timed runs
+    # load the module rather than compile it
+    for _ in range(repeat + 1):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import neatjson"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Lines are "import time: self [us] | cumulative | name", in the order
+        # imports finish, with each name indented by how deeply it was nested
+        lines = [line.split("|") for line in result.stderr.splitlines() if line.startswith("import time:")]
+        end = next(i for i, (_, _, name) in enumerate(lines) if name.strip() == "neatjson")
+        modules = set()
+        for _, _, name in reversed(lines[:end]):
+            if not name.startswith("  "):
+                break
+            modules.add(name.strip())
+        times.append(int(lines[end][1]) / 1000)
+    return times[1:], modules
+
+
+def bench_import(repeat: int) -> dict[str, Any]:
+    """Time importing neatjson; there is no output, and the memory used is not measured."""
+    times, _ = import_time(repeat)
+    return {
+        "best_ms": min(times),
+        "median_ms": statistics.median(times),
+        "output_bytes": 0,
+        "mb_per_s": 0.0,
+        "peak_kib": 0.0,
+    }
+
+
+async def measure_stall(value: Any) -> float:
+    """Format a value with neat_json_async, returning the longest time another task waited to run."""
+    max_stall = 0.0
+    done = False
+
+    async def ticker() -> None:
+        nonlocal max_stall
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            max_stall = max(max_stall, now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    await neat_json_async(value, wrap=60, interval=0.005)
+    done = True
+    await task
+    return max_stall
+
+
+def bench_async_stall(repeat: int) -> dict[str, Any]:
+    """Measure the longest stall of the event loop while formatting large documents with neat_json_async."""
+    documents = [
+        [{"id": i, "name": f"item {i}", "tags": ["a", "b"], "score": i / 7} for i in range(8000)],
+        [i / 7 for i in range(200000)],
+    ]
+    stalls = [max(asyncio.run(measure_stall(value)) for value in documents) for _ in range(repeat)]
+    return {
+        "best_ms": min(stalls) * 1000,
+        "median_ms": statistics.median(stalls) * 1000,
+        "output_bytes": 0,
+        "mb_per_s": 0.0,
+        "peak_kib": 0.0,
+    }
+
+
+def run_benchmarks(keywords: list[str], repeat: int, scale: int) -> dict[str, Any]:
+    """Run every selected corpus with every option set."""
+    corpora = load_corpora(scale)
+    results: dict[str, dict[str, Any]] = {}
+    if not keywords or any(k in "import" for k in keywords):
+        results["import"] = bench_import(repeat)
+        print_result("import", results["import"])
+    if not keywords or any(k in "async-stall" for k in keywords):
+        results["async-stall"] = bench_async_stall(repeat)
+        print_result("async-stall", results["async-stall"])
+    for corpus_name, value in corpora.items():
+        if keywords and not any(k in corpus_name for k in keywords):
+            continue
+        for opts_name, opts in OPTION_SETS.items():
+            key = f"{corpus_name}/{opts_name}"
+            try:
+                results[key] = bench_one(formatter(corpus_name, value, opts), repeat)
+            except Exception as e:
+                results[key] = {"error": f"{type(e).__name__}: {e}"}
+            print_result(key, results[key])
+
+    return {
+        "neatjson_version": neatjson.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "seed": SEED,
+        "scale": scale,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def print_result(key: str, result: dict[str, Any]) -> None:
+    if "error" in result:
+        print(f"{key:<36} ERROR {result['error']}")
+    else:
+        print(
+            f"{key:<36} {result['best_ms']:9.2f}ms best {result['median_ms']:9.2f}ms median "
+            f"{result['mb_per_s']:8.2f}MB/s {result['peak_kib']:10.0f}KiB peak"
+        )
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[str]:
+    """
+    Compare results with a baseline, returning a description of each regression.
+
+    A benchmark regresses if its best time or peak memory grew by more than
+    threshold (a fraction), or if it now fails.
+    """
+    regressions = []
+    if baseline.get("scale") != current["scale"]:
+        regressions.append(f"baseline scale {baseline.get('scale')} differs from {current['scale']}")
+    for key, old in baseline.get("results", {}).items():
+        new = current["results"].get(key)
+        if new is None or "error" in old:
+            continue
+        if "error" in new:
+            regressions.append(f"{key}: now fails with {new['error']}")
+            continue
+        for metric in ("best_ms", "peak_kib"):
+            if old[metric] and new[metric] > old[metric] * (1 + threshold):
+                change = (new[metric] / old[metric] - 1) * 100
+                regressions.append(f"{key}: {metric} {old[metric]:.2f} -> {new[metric]:.2f} (+{change:.0f}%)")
+    return regressions
+
+
+def check_budgets(current: dict[str, Any]) -> list[str]:
+    """Return a description of each result over its budget."""
+    over = []
+    result = current["results"].get("import")
+    if result is not None and result["best_ms"] > IMPORT_BUDGET_MS:
+        over.append(f"import: {result['best_ms']:.2f}ms (budget {IMPORT_BUDGET_MS}ms)")
+    result = current["results"].get("async-stall")
+    if result is not None and result["best_ms"] > STALL_BUDGET_MS:
+        over.append(f"async-stall: {result['best_ms']:.2f}ms (budget {STALL_BUDGET_MS}ms)")
+    return over
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the NeatJSON Python port.")
+    parser.add_argument("-o", "--output", type=Path, help="write the results as JSON to this file")
+    parser.add_argument("-c", "--compare", type=Path, help="flag regressions against results saved with -o")
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.10, help="fractional slowdown counted as a regression (0.10)"
+    )
+    parser.add_argument("-k", "--keyword", action="append", default=[], help="only run corpora containing this")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timed runs per benchmark (5)")
+    parser.add_argument("-s", "--scale", type=int, default=1, help="multiply the size of the synthetic corpora (1)")
+    parser.add_argument("--quick", action="store_true", help="a single timed run per benchmark")
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.keyword, 1 if args.quick else args.repeat, args.scale)
+
+    if args.output:
+        args.output.write_text(json.dumps(current, indent=2) + "\n")
+        print(f"Results written to {args.output}")
+
+    over = check_budgets(current)
+    for line in over:
+        print(f"Over budget: {line}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+    if over:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
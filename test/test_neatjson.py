@@ -11,19 +11,64 @@ Usage:
 
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import dataclasses
+import io
+import ipaddress
+import itertools
 import json
+import os
 import re
+import subprocess
 import sys
+import tempfile
 import time
+import tracemalloc
+import uuid
+from collections.abc import Callable, Iterator
 from pathlib import Path
 from typing import Any
 
 # Add the python src directory to the path
 sys.path.insert(0, str(Path(__file__).parent.parent / "python" / "src"))
 
-from neatjson import neat_json
+from neatjson import (
+    FormatStats,
+    NeatDocument,
+    SubtreeCache,
+    aiter_neat_json,
+    iter_neat_json,
+    neat_dump,
+    neat_dump_into,
+    neat_json,
+    neat_json_async,
+    neat_json_many,
+    neat_json_parallel,
+    neat_reformat,
+    register_field_adapter,
+    register_type,
+    slot_fields,
+    unregister_field_adapter,
+    unregister_type,
+)
 
-from tests import TESTS, PYTHON_TESTS, CUSTOM_JSON_TESTS
+from neatjson.__main__ import main as cli_main
+from tests import (
+    TESTS,
+    PYTHON_TESTS,
+    CUSTOM_JSON_TESTS,
+    REGISTERED_TYPES,
+    REGISTERED_TYPE_TESTS,
+    FIELD_ADAPTERS,
+    FIELD_TESTS,
+    NUMPY_TESTS,
+    LineItem,
+    Order,
+)
+
+# Modules that neatjson only imports once a value or option needs them
+LAZY_MODULES = {"asyncio", "concurrent.futures", "dataclasses", "decimal", "fractions", "inspect", "json"}
 
 
 def run_tests() -> None:
@@ -42,8 +87,54 @@ def run_tests() -> None:
 
     start = time.perf_counter()
 
-    # Run all test suites
-    all_tests = TESTS + PYTHON_TESTS + CUSTOM_JSON_TESTS
+    # The converters and adapters the test values need are registered for
+    # the whole run, and removed again at the end
+    for cls, fn in REGISTERED_TYPES:
+        register_type(cls, fn)
+    for adapter in FIELD_ADAPTERS:
+        register_field_adapter(adapter)
+    try:
+        # Each check yields None if it passes, and a description of the
+        # failure if it does not
+        for check in (lambda: check_values(large_data), *FEATURE_CHECKS):
+            for failure in check():
+                count += 1
+                if failure is None:
+                    passed += 1
+                else:
+                    print(failure)
+    finally:
+        for cls, _ in REGISTERED_TYPES:
+            unregister_type(cls)
+        for adapter in FIELD_ADAPTERS:
+            unregister_field_adapter(adapter)
+
+    elapsed = time.perf_counter() - start
+    elapsed = max(elapsed, 0.0001)  # Avoid division by zero
+
+    tests_word = "test" if count == 1 else "tests"
+    print(
+        f"{passed}/{count} {tests_word} passed in {elapsed * 1000:.2f}ms "
+        f"({int(count / elapsed)} tests per second)"
+    )
+
+    if perf_testing:
+        time_float_formatting()
+
+    # Exit with error code if any tests failed
+    sys.exit(0 if passed == count else 1)
+
+
+def check_values(large_data: Any = None) -> Iterator[str | None]:
+    """Format every test value with every API, checking that all of them give the expected output."""
+    # Shared by all tests, so that entries for other values and options are present
+    cache = SubtreeCache(maxsize=64)
+    stats = FormatStats()
+    stats_calls = stats_chars = 0
+    # Reused by all tests, so that they are overwritten by longer and shorter output
+    byte_buffers: list[bytearray | io.BytesIO] = [bytearray(), io.BytesIO()]
+
+    all_tests = TESTS + PYTHON_TESTS + CUSTOM_JSON_TESTS + REGISTERED_TYPE_TESTS + FIELD_TESTS + NUMPY_TESTS
 
     for value_tests in all_tests:
         val = value_tests["value"]
@@ -72,33 +163,595 @@ def run_tests() -> None:
                             f"EXPECTED:\n{expected}\nACTUAL:\n{result}"
                         )
 
-                passed += 1
+                # Streaming output must match the string result exactly
+                streamed = "".join(iter_neat_json(val, **opts))
+                if streamed != result:
+                    raise AssertionError(f"STREAMED:\n{streamed}\nACTUAL:\n{result}")
+                text_fp = io.StringIO()
+                neat_dump(val, text_fp, **opts)
+                binary_fp = io.BytesIO()
+                neat_dump(val, binary_fp, **opts)
+                if text_fp.getvalue() != result or binary_fp.getvalue() != result.encode("utf-8"):
+                    raise AssertionError(f"DUMPED:\n{text_fp.getvalue()}\nACTUAL:\n{result}")
+                for buffer in byte_buffers:
+                    with neat_dump_into(val, buffer, **opts) as view:
+                        contents = buffer.getvalue() if isinstance(buffer, io.BytesIO) else bytes(buffer)
+                        if view != result.encode("utf-8") or contents != view:
+                            raise AssertionError(f"DUMPED INTO {type(buffer).__name__}:\n{contents!r}\nACTUAL:\n{result}")
 
-            except Exception as e:
-                print(f"Failure running {cmd}")
-                print(e)
-                print()
+                # Cached output must match too, whether or not the cache is hit
+                for _ in range(2):
+                    cached = neat_json(val, cache=cache, **opts)
+                    if cached != result:
+                        raise AssertionError(f"CACHED:\n{cached}\nACTUAL:\n{result}")
+
+                # Collecting stats must not change the output
+                instrumented = neat_json(val, stats=stats, **opts)
+                if instrumented != result:
+                    raise AssertionError(f"WITH STATS:\n{instrumented}\nACTUAL:\n{result}")
+                stats_calls += 1
+                stats_chars += len(result)
+
+                # A document must match, and match again after an edit is undone
+                doc = NeatDocument(val, **opts)
+                if doc.text != result:
+                    raise AssertionError(f"DOCUMENT:\n{doc.text}\nACTUAL:\n{result}")
+                if isinstance(doc.value, (dict, list)):
+                    # Objects get a number, since some sort functions compare values
+                    if isinstance(doc.value, list):
+                        path, added = "/-", {"x": [1, 2.5]}
+                    else:
+                        path, added = "/added", 99
+                    doc.set(path, added)
+                    if doc.text != neat_json(doc.value, **opts):
+                        raise AssertionError(f"EDITED DOCUMENT:\n{doc.text}")
+                    doc.delete(f"/{len(doc.value) - 1}" if isinstance(doc.value, list) else path)
+                    if doc.text != result:
+                        raise AssertionError(f"RESTORED DOCUMENT:\n{doc.text}\nACTUAL:\n{result}")
 
-            count += 1
+                # Reformatting the output must reproduce it, including when the
+                # input arrives a byte at a time
+                if _is_json(result):
+                    reformat_expected = result if "decimals" not in opts else neat_json(json.loads(result), **opts)
+                    for fp_in in (io.StringIO(result), _TrickleReader(result.encode("utf-8"))):
+                        fp_out = io.StringIO()
+                        neat_reformat(fp_in, fp_out, **opts)
+                        if fp_out.getvalue() != reformat_expected:
+                            raise AssertionError(f"REFORMATTED:\n{fp_out.getvalue()}\nEXPECTED:\n{reformat_expected}")
+
+                yield None
+
+            except Exception as e:
+                yield f"Failure running {cmd}\n{e}\n"
 
             # Performance testing with large data
-            if perf_testing and large_data is not None:
+            if large_data is not None:
                 try:
                     neat_json(large_data, **opts)
-                except Exception:
-                    print(f"Error serializing large data with {opts!r}")
+                except Exception as e:
+                    print(f"Error serializing large data with {opts!r}: {e}")
 
-    elapsed = time.perf_counter() - start
-    elapsed = max(elapsed, 0.0001)  # Avoid division by zero
+    # Stats must account for every instrumented call
+    if stats.calls == stats_calls and stats.chars == stats_chars and stats.visits > 0:
+        yield None
+    else:
+        yield f"Failure collecting stats: {stats!r}"
 
-    tests_word = "test" if count == 1 else "tests"
-    print(
-        f"{passed}/{count} {tests_word} passed in {elapsed * 1000:.2f}ms "
-        f"({int(count / elapsed)} tests per second)"
-    )
 
-    # Exit with error code if any tests failed
-    sys.exit(0 if passed == count else 1)
+def check_stats_coverage() -> Iterator[str | None]:
+    """
+    Stats count the calls and output of every API that takes them, and the
+    text a NeatDocument remembers as cache hits.
+    """
+    value = {"a": [1, 2, {"b": [3] * 30}], "c": "é" * 50}
+    text = neat_json(value, wrap=40, ensure_ascii=False)
+    stats = FormatStats()
+    with neat_dump_into(value, bytearray(), wrap=40, ensure_ascii=False, stats=stats):
+        pass
+    neat_reformat(io.StringIO(text), io.StringIO(), wrap=40, ensure_ascii=False, stats=stats)
+    if (stats.calls, stats.chars) == (2, 2 * len(text)):
+        yield None
+    else:
+        yield f"Failure collecting stats from neat_dump_into and neat_reformat: {stats!r}"
+
+    doc_stats = FormatStats()
+    doc = NeatDocument(value, wrap=40, stats=doc_stats)
+    texts = [doc.text]
+    doc.set("/c", "x")
+    texts.append(doc.text)
+    expected_chars = len(neat_json(value, wrap=40)) + len(texts[1])
+    if (doc_stats.calls, doc_stats.chars) == (2, expected_chars) and doc_stats.cache_hits > 0:
+        yield None
+    else:
+        yield f"Failure collecting stats from a NeatDocument: {doc_stats!r}"
+
+
+def check_slotted_classes() -> Iterator[str | None]:
+    """
+    Classes with __slots__ are only serialized field by field through an
+    adapter, which never applies to standard library classes.
+    """
+    for slotted in (uuid.UUID(int=5), Path("a/b"), ipaddress.IPv4Address("127.0.0.1")):
+        try:
+            neat_json(slotted)
+            yield f"Failure rejecting {slotted!r}"
+        except TypeError:
+            if slot_fields(type(slotted)) is None:
+                yield None
+            else:
+                yield f"Failure leaving out the slots of {type(slotted).__name__}"
+
+
+def check_unchanging_converter() -> Iterator[str | None]:
+    """
+    A converter returning a value of the type it converts is not applied to it
+    again, so one that changes nothing leaves it unserializable.
+    """
+    register_type(complex, lambda z: z)
+    try:
+        neat_json([1j])
+        yield "Failure rejecting a value its converter returned unchanged"
+    except TypeError:
+        yield None
+    finally:
+        unregister_type(complex)
+
+
+def check_unregistering() -> Iterator[str | None]:
+    """A converter or adapter that is removed again no longer applies."""
+    register_type(int, str)
+    converted = neat_json([1])
+    unregister_type(int)
+    if (converted, neat_json([1])) == ('["1"]', "[1]"):
+        yield None
+    else:
+        yield f"Failure unregistering a converter: {converted!r}, then {neat_json([1])!r}"
+
+    def adapter(cls: type) -> list[str] | None:
+        return ["real", "imag"] if cls is complex else None
+
+    register_field_adapter(adapter)
+    adapted = neat_json(1j)
+    unregister_field_adapter(adapter)
+    try:
+        neat_json(1j)
+        yield "Failure unregistering a field adapter"
+    except TypeError:
+        yield None if adapted == '{"real":0,"imag":1}' else f"Failure registering a field adapter: {adapted!r}"
+
+
+def check_async() -> Iterator[str | None]:
+    """Async formatting must match (how long it stalls the event loop is measured by the benchmarks)."""
+    for async_opts in ({"wrap": 20, "sort": True}, {"wrap": False}, {"wrap": 40, "short": True, "aligned": True}):
+        async_values = [value_tests["value"] for value_tests in TESTS + PYTHON_TESTS]
+        if asyncio.run(_format_async(async_values, async_opts)) == [neat_json(v, **async_opts) for v in async_values]:
+            yield None
+        else:
+            yield f"Failure running neat_json_async(..., {async_opts!r})"
+    large_floats = [i / 7 for i in range(200000)]
+    if asyncio.run(neat_json_async(large_floats, wrap=60, interval=0.005)) == neat_json(large_floats, wrap=60):
+        yield None
+    else:
+        yield "Failure formatting a large array with neat_json_async"
+
+
+def check_native_encoder() -> Iterator[str | None]:
+    """
+    Plain values on a single line are written by json's C encoder, and
+    values it would write differently are not, though the plain values
+    within them are.
+    """
+    native_tests = [
+        ([{"a": [1, "x"], "b": 1.5}], 1),
+        ([{"a": [1, "x"], "b": 1.0}, *range(8)], 1),
+        ([{"a": [1.0, *range(8)], "b": [{"c": 2}, {"c": 3.0}], "d": {"e": [4]}}], 2),
+        ([{"a": [1, "x"], "b": 1.0}], 0),
+    ]
+    for native_value, native_count in native_tests:
+        native_stats = FormatStats()
+        neat_json(native_value, wrap=False, stats=native_stats)
+        if native_stats.native == native_count:
+            yield None
+        else:
+            yield f"Failure using json's C encoder for {native_value!r}: {native_stats!r}"
+
+
+def check_measurement() -> Iterator[str | None]:
+    """
+    Measuring a value too wide for one line stops at the wrap width, so each
+    member of a long array is formatted about once.
+    """
+    long_stats = FormatStats()
+    long_array = [list(range(100000)), "x" * 100000]
+    neat_json(long_array, wrap=80, stats=long_stats)
+    if long_stats.scalars < 100000 + 1 + 200 and long_stats.overflows == 2:
+        yield None
+    else:
+        yield f"Failure stopping measurement at the wrap width: {long_stats!r}"
+
+
+def check_many() -> Iterator[str | None]:
+    """Batch formatting must match formatting each value separately."""
+    for many_opts in ({"wrap": 20, "sort": True}, {"wrap": False, "padding": 1}):
+        values = [value_tests["value"] for value_tests in TESTS + PYTHON_TESTS]
+        expected_many = [neat_json(val, **many_opts) for val in values]
+        for mode in ({"workers": 2, "chunksize": 8}, {"workers": 3, "threads": True}, {"workers": 1}):
+            if list(neat_json_many(values, **mode, **many_opts)) == expected_many:
+                yield None
+            else:
+                yield f"Failure running neat_json_many(..., {mode!r}, {many_opts!r})"
+
+
+def check_parallel() -> Iterator[str | None]:
+    """Splitting one document over workers must match formatting it serially."""
+    document = {f"key{i}": value_tests["value"] for i, value_tests in enumerate(TESTS + PYTHON_TESTS)}
+    for parallel_opts in ({"wrap": 20, "sort": True}, {"wrap": 40, "short": True, "aligned": True}, {"wrap": False}):
+        for value in (document, list(document.values())):
+            if neat_json_parallel(value, workers=2, chunksize=16, **parallel_opts) == neat_json(value, **parallel_opts):
+                yield None
+            else:
+                yield f"Failure running neat_json_parallel(..., {parallel_opts!r})"
+
+
+def check_deep_nesting() -> Iterator[str | None]:
+    """
+    Documents nested far beyond the recursion limit must format, and documents
+    containing themselves must fail cleanly.
+    """
+    depth = sys.getrecursionlimit() + 500
+    deep_array = _nested_array(depth)
+    deep_object: dict[str, Any] = {}
+    for _ in range(depth):
+        deep_object = {"a": deep_object}
+    deep_flat = {id(deep_array): "[" * depth + "[]" + ",1]" * depth, id(deep_object): '{"a":' * depth + "{}" + "}" * depth}
+    cyclic_array: list[Any] = [1]
+    cyclic_array.append({"a": cyclic_array})
+    cyclic_object: dict[str, Any] = {"a": [1]}
+    cyclic_object["a"].append(cyclic_object)
+    deep_options = [{}, {"wrap": False}, {"wrap": True, "short": True}, {"wrap": 40, "aligned": True}, {"cache": SubtreeCache()}]
+    for deep_opts in deep_options:
+        for value in (deep_array, deep_object):
+            expected = deep_flat[id(value)] if deep_opts == {"wrap": False} else None
+            try:
+                result = neat_json(value, **deep_opts)
+                if result == "".join(iter_neat_json(value, **deep_opts)) and expected in (None, result):
+                    yield None
+                else:
+                    yield f"Failure formatting a deeply nested value with {deep_opts!r}"
+            except RecursionError:
+                yield f"Failure formatting a deeply nested value with {deep_opts!r}: RecursionError"
+        for value in (cyclic_array, cyclic_object):
+            try:
+                neat_json(value, **deep_opts)
+                yield f"Failure detecting a circular reference with {deep_opts!r}"
+            except ValueError:
+                yield None
+
+
+def check_subtree_cache() -> Iterator[str | None]:
+    """
+    The subtree cache counts hits and misses, evicts the least recently used
+    entry, and leaves out text longer than max_chars.
+    """
+    lru = SubtreeCache(maxsize=2)
+    for value in ([1.0, 1], [2.0, 2], [3.0, 3], [3.0, 3], [1.0, 1]):
+        neat_json(value, wrap=False, cache=lru)
+    if (lru.hits, lru.misses, len(lru)) == (1, 4, 2):
+        yield None
+    else:
+        yield f"Failure evicting from the subtree cache: {lru!r}"
+    full_size = lru.nbytes()
+    lru.clear()
+    if full_size > lru.nbytes() > 0 and (lru.hits, lru.misses, len(lru)) == (0, 0, 0):
+        yield None
+    else:
+        yield f"Failure measuring the subtree cache: {full_size} bytes full, {lru.nbytes()} bytes cleared"
+    probed_stats = FormatStats()
+    probed_cache = SubtreeCache()
+    probed_value = [{"id": i, "schema": {"type": "object", "required": ["id", "name"]}} for i in range(3)]
+    probed_text = neat_json(probed_value, wrap=30, cache=probed_cache, stats=probed_stats)
+    if probed_text == neat_json(probed_value, wrap=30) and probed_stats.cache_hits == probed_cache.hits == 2:
+        yield None
+    else:
+        yield f"Failure counting cache hits in stats: {probed_stats!r}"
+    short_cache = SubtreeCache(max_chars=12)
+    long_text = neat_json([[1.0, "short"], [2.0, "a longer string"]], wrap=False, cache=short_cache)
+    if long_text == '[[1,"short"],[2,"a longer string"]]' and len(short_cache) == 1:
+        yield None
+    else:
+        yield f"Failure leaving long text out of the subtree cache: {short_cache!r}"
+    deep_array = _nested_array(sys.getrecursionlimit() + 500)
+    deep_cache = SubtreeCache()
+    for _ in range(2):
+        deep_text = neat_json(deep_array, wrap=40, cache=deep_cache)
+    if deep_text == neat_json(deep_array, wrap=40) and deep_cache.hits == 1 and deep_cache.nbytes() < 1 << 22:
+        yield None
+    else:
+        yield f"Failure caching a deeply nested value: {deep_cache!r} holding {deep_cache.nbytes()} bytes"
+
+
+def check_deep_document() -> Iterator[str | None]:
+    """A deeply nested document does not keep a copy of its text for every level of nesting."""
+    doc_value = _nested_array(500)
+    tracemalloc.start()
+    try:
+        deep_doc = NeatDocument(doc_value)
+        deep_doc.set("/0/0/0/1", 2)
+        doc_text = deep_doc.text
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if doc_text == neat_json(deep_doc.value) and peak < 16 * len(doc_text):
+        yield None
+    else:
+        yield f"Failure editing a deeply nested document: peak memory {peak / 1024:.0f}KiB"
+
+
+def check_dump_into() -> Iterator[str | None]:
+    """
+    Output longer than the chunks encoded at a time fills a buffer that is
+    then reused for shorter output.
+    """
+    long_value = [{"text": "é😀" * i, "n": i} for i in range(600)]
+    for dump_opts in ({"wrap": False, "ensure_ascii": False}, {"wrap": 60, "ensure_ascii": False}, {"wrap": 60}):
+        for buffer in (bytearray(b"-" * 100), io.BytesIO(b"-" * 100)):
+            outputs = []
+            for value in (long_value, long_value[:3]):
+                with neat_dump_into(value, buffer, **dump_opts) as view:
+                    outputs.append(view.tobytes() == neat_json(value, **dump_opts).encode("utf-8"))
+            contents = buffer.getvalue() if isinstance(buffer, io.BytesIO) else bytes(buffer)
+            if all(outputs) and contents == neat_json(long_value[:3], **dump_opts).encode("utf-8"):
+                yield None
+            else:
+                yield f"Failure running neat_dump_into(..., {type(buffer).__name__}, {dump_opts!r})"
+
+
+def check_generators() -> Iterator[str | None]:
+    """
+    Generators are written the same as lists, reading no further ahead than is
+    needed to lay out what is written next.
+    """
+
+    def records(n: int, pulled: list[int] | None = None) -> Iterator[Any]:
+        for i in range(n):
+            if pulled is not None:
+                pulled[0] += 1
+            yield {"id": i, "tags": (f"t{j}" for j in range(i % 3)), "at": (i, i / 4)}
+
+    def record_lists(n: int) -> list[Any]:
+        return [{"id": i, "tags": [f"t{j}" for j in range(i % 3)], "at": (i, i / 4)} for i in range(n)]
+
+    stream_cache = SubtreeCache(maxsize=64)
+    for stream_opts in ({}, {"wrap": False}, {"wrap": 30, "short": True}, {"wrap": 40, "table": True}, {"cache": stream_cache}):
+        for n in (0, 1, 40):
+            expected = neat_json(record_lists(n), **stream_opts)
+            outputs = [neat_json(records(n), **stream_opts), "".join(iter_neat_json(records(n), **stream_opts))]
+            outputs.append(neat_json({"rows": records(n), "empty": iter(())}, **stream_opts))
+            if outputs[:2] == [expected, expected] and outputs[2] == neat_json({"rows": record_lists(n), "empty": []}, **stream_opts):
+                yield None
+            else:
+                yield f"Failure formatting a generator of {n} records with {stream_opts!r}"
+    for stream_opts in ({"wrap": False}, {"wrap": 80}, {"wrap": 80, "short": True}):
+        pulled = [0]
+        chunks = iter_neat_json({"rows": records(100000, pulled)}, **stream_opts)
+        head = "".join(itertools.islice(chunks, 20))
+        if head.startswith(neat_json({"rows": record_lists(3)}, **stream_opts)[:20]) and pulled[0] < 30:
+            yield None
+        else:
+            yield f"Failure reading a generator lazily with {stream_opts!r}: read {pulled[0]} items"
+
+    # A long array of floats is formatted as it is written, not all at once
+    large_floats = [i / 7 for i in range(200000)]
+    tracemalloc.start()
+    try:
+        head = "".join(itertools.islice(iter_neat_json(large_floats), 20))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if neat_json(large_floats).startswith(head) and peak < 1 << 20:
+        yield None
+    else:
+        yield f"Failure streaming a long array of floats: peak memory {peak / 1024:.0f}KiB"
+
+    # A table is only looked for in a generator whose first item is an object
+    def numbers(n: int, pulled: list[int]) -> Iterator[int]:
+        for i in range(n):
+            pulled[0] += 1
+            yield i
+
+    pulled = [0]
+    head = "".join(itertools.islice(iter_neat_json(numbers(100000, pulled), wrap=40, table=True), 20))
+    if head.startswith("[\n  0,\n  1,") and pulled[0] < 30:
+        yield None
+    else:
+        yield f"Failure reading a generator of numbers lazily with table=True: read {pulled[0]} items"
+
+
+def check_dataclasses() -> Iterator[str | None]:
+    """
+    Dataclasses are read field by field as they are written, using no more
+    memory than the same values already converted to dicts.
+    """
+    orders = [Order(i, [LineItem(f"sku-{i}-{j}", j, ["a", "b"]) for j in range(10)], i * 1.5) for i in range(300)]
+    order_dicts = [dataclasses.asdict(order) for order in orders]
+    for order_opts in ({}, {"wrap": False}):
+        order_texts = []
+        peaks = []
+        for value in (orders, order_dicts):
+            tracemalloc.start()
+            try:
+                order_texts.append(neat_json(value, **order_opts))
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        if order_texts[0] == order_texts[1] and peaks[0] < 1.25 * peaks[1] + (64 << 10):
+            yield None
+        else:
+            yield f"Failure writing dataclasses with {order_opts!r}: peak memory {peaks[0] / 1024:.0f}KiB, {peaks[1] / 1024:.0f}KiB as dicts"
+
+
+def check_small_values() -> Iterator[str | None]:
+    """
+    Small values written on one line that turn out too wide are wrapped as
+    larger values are, even with an array shared by keys whose floats differ.
+    """
+    shared = [1, 2]
+    small_tests = [
+        ({"a": shared, "b": shared, "c": "some text"}, {"wrap": 20, "force_floats_in": ("a",)}),
+        ({"a": shared, "b": {"c": shared}}, {"wrap": 8, "force_floats_in": ["c"], "aligned": True}),
+        ([{"id": 1, "tags": ["x", "y"]}, [3, [4]]], {"wrap": 12, "short": True, "padding": 1}),
+    ]
+    for value, opts in small_tests:
+        expected = neat_json(value, **opts, stats=FormatStats())
+        if neat_json(value, **opts) == expected:
+            yield None
+        else:
+            yield f"Failure wrapping the small value {value!r} with {opts!r}: {neat_json(value, **opts)!r}"
+
+
+def check_reformat() -> Iterator[str | None]:
+    """Reformatting keeps the text of numbers and rejects invalid JSON."""
+    reformat_tests = [
+        ('{"a": [1.50, 2e3, 12345678901234567890123]}', {}, '{"a":[1.50,2e3,12345678901234567890123]}'),
+        ('[1.50, 2]', {"force_floats": True}, "[1.50,2.0]"),
+        ('[1.50, 2]', {"decimals": 1}, "[1.5,2]"),
+        ('{"b": [1.0, 2.0], "a": 3}', {"sort": True, "wrap": 20}, '{\n  "a":3,\n  "b":[1.0,2.0]\n}'),
+    ]
+    for text, opts, expected in reformat_tests:
+        fp_out = io.StringIO()
+        neat_reformat(io.StringIO(text), fp_out, **opts)
+        if fp_out.getvalue() == expected:
+            yield None
+        else:
+            yield f"Failure running neat_reformat({text!r}, {opts!r}): {fp_out.getvalue()!r}"
+    for text in ("", "[1,]", "[1 2]", '{"a" 1}', "[1] 2", '"abc'):
+        try:
+            neat_reformat(io.StringIO(text), io.StringIO(), wrap=2)
+            yield f"Failure rejecting invalid JSON {text!r}"
+        except ValueError:
+            yield None
+
+
+def check_command_line() -> Iterator[str | None]:
+    """
+    The command line rewrites files in place, serially and in parallel, and
+    reports files it cannot read.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [Path(tmp, f"{i}.json") for i in range(4)]
+        for jobs in ("1", "2"):
+            for i, path in enumerate(paths):
+                path.write_text(f'{{"b": [{i}.50, 2], "a": null}}')
+            status = cli_main(["--in-place", "-j", jobs, "--sort", "--after-colon", "1", *map(str, paths)])
+            if status == 0 and all(p.read_text() == f'{{"a": null,"b": [{i}.50,2]}}\n' for i, p in enumerate(paths)):
+                yield None
+            else:
+                yield f"Failure running the command line with -j {jobs}"
+        # Nothing of an invalid file is written, even once much of it has
+        # been formatted
+        out_path = Path(tmp, "out.json")
+        paths[0].write_text("[" + "1," * 100000)
+        for jobs in ("1", "2"):
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                status = cli_main([str(paths[0]), str(paths[1]), "-j", jobs, "-o", str(out_path)])
+            if status == 1 and "0.json" in err.getvalue() and out_path.read_text() == '{"a":null,"b":[1.50,2]}\n':
+                yield None
+            else:
+                yield f"Failure reporting an invalid file from the command line with -j {jobs}"
+
+
+def check_lazy_imports() -> Iterator[str | None]:
+    """
+    Importing neatjson leaves modules that only some values and options need
+    until they are used (its import time is checked by the benchmarks).
+    """
+    imported = _modules_imported_by_neatjson()
+    if not imported & LAZY_MODULES:
+        yield None
+    else:
+        yield f"Failure importing neatjson: importing {sorted(imported & LAZY_MODULES)}"
+
+
+# The checks run after check_values, in order
+FEATURE_CHECKS: list[Callable[[], Iterator[str | None]]] = [
+    check_stats_coverage,
+    check_slotted_classes,
+    check_unchanging_converter,
+    check_unregistering,
+    check_async,
+    check_native_encoder,
+    check_measurement,
+    check_many,
+    check_parallel,
+    check_deep_nesting,
+    check_subtree_cache,
+    check_deep_document,
+    check_dump_into,
+    check_generators,
+    check_dataclasses,
+    check_small_values,
+    check_reformat,
+    check_command_line,
+    check_lazy_imports,
+]
+
+
+class _TrickleReader(io.RawIOBase):
+    """A binary file object that returns at most one byte per read."""
+
+    def __init__(self, data: bytes) -> None:
+        self._data = io.BytesIO(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self._data.read(1)
+
+
+async def _format_async(values: list[Any], opts: dict[str, Any]) -> list[str]:
+    """Format values with neat_json_async and aiter_neat_json, checking that they agree."""
+    results = []
+    for value in values:
+        text = await neat_json_async(value, **opts)
+        chunks = [chunk async for chunk in aiter_neat_json(value, chunk_size=16, **opts)]
+        results.append(text if "".join(chunks) == text else None)
+    return results
+
+
+def _modules_imported_by_neatjson() -> set[str]:
+    """Import neatjson in a fresh interpreter, returning the modules that importing it loaded."""
+    code = "import sys; before = set(sys.modules); import neatjson; print(*set(sys.modules) - before)"
+    env = {**os.environ, "PYTHONPATH": str(Path(__file__).parent.parent / "python" / "src")}
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+
+def _nested_array(depth: int) -> list[Any]:
+    """Return an array nested depth levels deep, each level holding the next and 1."""
+    value: list[Any] = []
+    for _ in range(depth):
+        value = [value, 1]
+    return value
+
+
+def _is_json(text: str) -> bool:
+    """Return True if the text is valid JSON."""
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+
+def time_float_formatting() -> None:
+    """Time formatting a large array of floats with common float options."""
+    floats = [i * 1.37 - 5000.0 for i in range(100000)]
+    for opts in ({"wrap": False}, {"wrap": 80}, {"wrap": False, "decimals": 2}, {"wrap": False, "force_floats": True}):
+        start = time.perf_counter()
+        neat_json(floats, **opts)
+        elapsed = time.perf_counter() - start
+        print(f"{len(floats)} floats with {opts!r}: {elapsed * 1000:.2f}ms")
 
 
 if __name__ == "__main__":
@@ -8,10 +8,25 @@ The 'json' value can be a string or a compiled regex pattern.
 
 from __future__ import annotations
 
+import collections
+import dataclasses
+import decimal
 import math
 import re
 from typing import Any
 
+from neatjson import slot_fields
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import attrs
+except ImportError:
+    attrs = None
+
 TESTS: list[dict[str, Any]] = [
     {"value": True, "tests": [{"json": "true"}]},
     {"value": False, "tests": [{"json": "false"}]},
@@ -278,6 +293,51 @@ PYTHON_TESTS: list[dict[str, Any]] = [
 
     # None in objects
     {"value": {"a": None}, "tests": [{"json": '{"a":null}'}]},
+
+    # Non-string keys sort by their string form
+    {"value": {10: "a", 9: "b", "1": "c"}, "tests": [
+        {"json": '{"1":"c","10":"a","9":"b"}', "opts": {"sort": True}},
+        {"json": '{"1":"c","10":"a","9":"b"}', "opts": {"sort": True, "sort_cache": 0}},
+    ]},
+
+    # Values json's C encoder would write differently from NeatJSON
+    {"value": {"b": [1.5, (2, "x")], "a": {"n": None, "t": True}}, "tests": [
+        {"json": '{"b":[1.5,[2,"x"]],"a":{"n":null,"t":true}}', "opts": {"wrap": False}},
+        {"json": '{"a" : {"n" : null, "t" : true}, "b" : [1.5, [2, "x"]]}', "opts": {"wrap": False, "sort": True, "around_colon": 1, "after_comma": 1}},
+    ]},
+    {"value": [[1.5, 2.0], [1.5, math.nan], [1.5, -math.inf], {1: "a", "b": "\u00e9"}], "tests": [
+        {"json": '[[1.5,2],[1.5,"NaN"],[1.5,-9e9999],{"1":"a","b":"\\u00e9"}]', "opts": {"wrap": False}},
+        {"json": '[[1.5,2],[1.5,"NaN"],[1.5,-9e9999],{"1":"a","b":"\u00e9"}]', "opts": {"wrap": False, "ensure_ascii": False}},
+    ]},
+
+    # Records sharing a key set reuse one sorted order
+    {"value": [{"b": 1, "a": 2}, {"b": 3, "a": 4}, {"a": 5, "b": 6}], "tests": [
+        {"json": '[{"a":2,"b":1},{"a":4,"b":3},{"a":5,"b":6}]', "opts": {"sort": True}},
+        {"json": '[{"b":1,"a":2},{"b":3,"a":4},{"b":6,"a":5}]', "opts": {"sort": lambda k: k == "a"}},
+        {"json": '[{"a":2,"b":1},{"a":4,"b":3},{"a":5,"b":6}]', "opts": {"sort": True, "sort_cache": 1}},
+    ]},
+
+    # Non-ASCII text is escaped by default, which counts toward the wrap width
+    {"value": {"名前": "café ☕", "tags": ["日本語", 'a"b\\c']}, "tests": [
+        {"json": '{"\\u540d\\u524d":"caf\\u00e9 \\u2615","tags":["\\u65e5\\u672c\\u8a9e","a\\"b\\\\c"]}', "opts": {"wrap": False}},
+        {"json": '{"名前":"café ☕","tags":["日本語","a\\"b\\\\c"]}', "opts": {"wrap": False, "ensure_ascii": False}},
+        {"json": '{\n  "名前":"café ☕",\n  "tags":["日本語","a\\"b\\\\c"]\n}', "opts": {"wrap": 30, "ensure_ascii": False}},
+        {"json": '{\n  "\\u540d\\u524d":"caf\\u00e9 \\u2615",\n  "tags":[\n    "\\u65e5\\u672c\\u8a9e",\n    "a\\"b\\\\c"\n  ]\n}', "opts": {"wrap": 30}},
+    ]},
+
+    # Arrays of objects with the same keys as tables
+    {"value": [{"a": 1, "bb": "x"}, {"a": 22, "bb": "yy"}, {"a": 3, "bb": None}], "tests": [
+        {"json": '[\n  {"a":1,"bb":"x"},\n  {"a":22,"bb":"yy"},\n  {"a":3,"bb":null}\n]', "opts": {"wrap": 20}},
+        {"json": '[\n  {"a":1, "bb":"x"},\n  {"a":22,"bb":"yy"},\n  {"a":3, "bb":null}\n]', "opts": {"wrap": 20, "table": True}},
+        {"json": '[ { "a" : 1,  "bb" : "x" },\n  { "a" : 22, "bb" : "yy" },\n  { "a" : 3,  "bb" : null } ]',
+         "opts": {"wrap": 40, "table": True, "short": True, "padding": 1, "around_colon": 1, "after_comma": 1}},
+        {"json": '[\n  {\n    "a":1,\n    "bb":"x"\n  },\n  {\n    "a":22,\n    "bb":"yy"\n  },\n  {\n    "a":3,\n    "bb":null\n  }\n]',
+         "opts": {"wrap": 15, "table": True}},
+    ]},
+    {"value": {"rows": [{"b": 1, "a": 2.5}, {"a": 10, "b": 20}]}, "tests": [
+        {"json": '{\n  "rows":[\n    {"a":2.5,"b":1},\n    {"a":10, "b":20}\n  ]\n}', "opts": {"wrap": 20, "table": True, "sort": True}},
+        {"json": '{\n  "rows":[\n    {"b":1,"a":2.5},\n    {"a":10,"b":20}\n  ]\n}', "opts": {"wrap": 20, "table": True}},
+    ]},
 ]
 
 
@@ -295,3 +355,166 @@ CUSTOM_JSON_TESTS: list[dict[str, Any]] = [
     {"value": CustomJsonClass("hello"), "tests": [{"json": '{"custom":"hello"}'}]},
     {"value": [CustomJsonClass(1), CustomJsonClass(2)], "tests": [{"json": '[{"custom":1},{"custom":2}]'}]},
 ]
+
+
+class Point:
+    """Test class serialized through a converter added with register_type."""
+    def __init__(self, x: Any, y: Any) -> None:
+        self.x = x
+        self.y = y
+
+
+class Point3D(Point):
+    """Subclass of a registered class, which uses the same converter."""
+
+
+def point_to_json(point: Point) -> Any:
+    return [point.x, point.y]
+
+
+def round_cents(amount: decimal.Decimal) -> decimal.Decimal:
+    """Converter for a built-in type that returns the same type, which is then handled as usual."""
+    return amount.quantize(decimal.Decimal("0.01"))
+
+
+# (class, converter) pairs passed to register_type before running REGISTERED_TYPE_TESTS
+REGISTERED_TYPES: list[tuple[type, Any]] = [(Point, point_to_json), (decimal.Decimal, round_cents)]
+
+REGISTERED_TYPE_TESTS: list[dict[str, Any]] = [
+    {"value": Point(1, 2), "tests": [{"json": "[1,2]"}]},
+    {"value": {"a": Point(1, 2), "b": Point3D(3, 4)}, "tests": [
+        {"json": '{"a":[1,2],"b":[3,4]}'},
+        {"json": '{\n  "a":[1,2],\n  "b":[3,4]\n}', "opts": {"wrap": 12}},
+    ]},
+    {"value": Point(Point(1, 2), 3.0), "tests": [{"json": "[[1.0,2.0],3.0]", "opts": {"force_floats": True}}]},
+    {"value": [decimal.Decimal("2.5"), decimal.Decimal("3.14159"), decimal.Decimal("1.005")], "tests": [
+        {"json": "[2.5,3.14,1]"},
+        {"json": "[\n  2.50,\n  3.14,\n  1\n]", "opts": {"wrap": 10, "decimals": 2}},
+    ]},
+]
+
+
+@dataclasses.dataclass
+class LineItem:
+    """Dataclass nested inside another, and in a list."""
+    sku: str
+    qty: int
+    tags: list[str] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class Order:
+    id: int
+    lines: list[LineItem]
+    total: float = 0.0
+
+
+@dataclasses.dataclass
+class Empty:
+    pass
+
+
+class Slotted:
+    """Class with __slots__ and no __dict__, one of them private, serialized through slot_fields."""
+    __slots__ = ("x", "__secret")
+
+    def __init__(self, x: Any) -> None:
+        self.x = x
+        self.__secret = -x
+
+
+class SlottedChild(Slotted):
+    """Adds a slot that may be left unset."""
+    __slots__ = "label"
+
+
+class Struct:
+    """Class whose fields are listed for an adapter added with register_field_adapter."""
+    __struct_fields__ = ("b", "a")
+
+    def __init__(self, a: Any, b: Any) -> None:
+        self.a = a
+        self.b = b
+
+
+def struct_fields(cls: type) -> Any:
+    return getattr(cls, "__struct_fields__", None)
+
+
+def slotted_fields(cls: type) -> Any:
+    return slot_fields(cls) if issubclass(cls, Slotted) else None
+
+
+Pair = collections.namedtuple("Pair", "left right")
+
+labelled = SlottedChild(2)
+labelled.label = "two"
+
+# Adapters passed to register_field_adapter before running FIELD_TESTS
+FIELD_ADAPTERS = [struct_fields, slotted_fields]
+
+FIELD_TESTS: list[dict[str, Any]] = [
+    {"value": Order(7, [LineItem("a1", 2, ["x"]), LineItem("b2", 1)], 12.5), "tests": [
+        {"json": '{"id":7,"lines":[{"sku":"a1","qty":2,"tags":["x"]},{"sku":"b2","qty":1,"tags":[]}],"total":12.5}', "opts": {"wrap": False}},
+        {"json": '{\n  "id":7,\n  "lines":[\n    {"qty":2,"sku":"a1","tags":["x"]},\n    {"qty":1,"sku":"b2","tags":[]}\n  ],\n  "total":12.5\n}',
+         "opts": {"wrap": 40, "sort": True}},
+    ]},
+    {"value": [Empty(), Pair(1, Pair(2, 3))], "tests": [{"json": '[{},{"left":1,"right":{"left":2,"right":3}}]'}]},
+    {"value": [Slotted(1), SlottedChild(3), labelled], "tests": [
+        {"json": '[{"x":1},{"x":3},{"x":2,"label":"two"}]', "opts": {"wrap": False}},
+    ]},
+    {"value": Struct([1, 2], Struct(None, True)), "tests": [{"json": '{"b":{"b":true,"a":null},"a":[1,2]}'}]},
+]
+
+if attrs is not None:
+    @attrs.define
+    class Point2:
+        x: int
+        y: int
+
+    @attrs.frozen
+    class Segment:
+        start: Point2
+        end: Point2
+
+    FIELD_TESTS.append(
+        {"value": Segment(Point2(0, 1), Point2(2, 3)), "tests": [
+            {"json": '{"start":{"x":0,"y":1},"end":{"x":2,"y":3}}'},
+            {"json": '{\n  "start":{"x":0,"y":1},\n  "end":{"x":2,"y":3}\n}', "opts": {"wrap": 30}},
+        ]}
+    )
+
+
+# NumPy test cases, only run when NumPy is installed
+NUMPY_TESTS: list[dict[str, Any]] = [] if np is None else [
+    {"value": np.array([1, 2, 3]), "tests": [
+        {"json": "[1,2,3]"},
+        {"json": "[1.0,2.0,3.0]", "opts": {"force_floats": True}},
+    ]},
+    {"value": np.array([[0.5, 1.0], [np.inf, np.nan]]), "tests": [
+        {"json": '[[0.5,1],[9e9999,"NaN"]]'},
+        {"json": "[\n  [0.5,1],\n  [9e9999,\"NaN\"]\n]", "opts": {"wrap": 20}},
+    ]},
+    {"value": np.array([0.1, 2.25], dtype=np.float32), "tests": [
+        {"json": "[0.1,2.25]"},
+        {"json": "[0.10,2.25]", "opts": {"decimals": 2}},
+        {"json": "[0.1,2.2]", "opts": {"decimals": 1, "trim_trailing_zeros": True}},
+    ]},
+    # float32 arrays are converted a chunk of rows at a time, including
+    # views whose rows are not contiguous
+    {"value": np.full((3, 5000), 0.1, dtype=np.float32), "tests": [
+        {"json": "[" + ",".join(["[" + ",".join(["0.1"] * 5000) + "]"] * 3) + "]", "opts": {"wrap": False}},
+    ]},
+    {"value": np.arange(1, 10001, dtype=np.float32) / 10, "tests": [
+        {"json": "[" + ",".join(str(i / 10) if i % 10 else str(i // 10) for i in range(1, 10001)) + "]", "opts": {"wrap": False}},
+    ]},
+    {"value": np.array([[0.1, 0.2], [0.3, 0.4]], dtype=np.float32).T, "tests": [
+        {"json": "[[0.1,0.3],[0.2,0.4]]"},
+    ]},
+    {"value": [np.array(0.1, dtype=np.float16), np.zeros((2, 0), dtype=np.float32)], "tests": [
+        {"json": "[0.1,[[],[]]]"},
+    ]},
+    {"value": {"i": np.int64(7), "f": np.float32(0.1), "d": np.float64(2.0), "b": np.bool_(True)}, "tests": [
+        {"json": '{"b":true,"d":2,"f":0.1,"i":7}', "opts": {"sort": True}},
+    ]},
+]